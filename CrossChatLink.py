@@ -6,15 +6,157 @@
 import interface
 import links
 import logging
+import os
+import sys
+import socket
+import signal
+import shutil
+import subprocess
+import tempfile
+import argparse
+import xml.etree.ElementTree as ElementTree
 import threading
 import queue
 import shlex
 import time
 
+import utils
+import handoff
+import snapshot
+import metrics
+import profiler
+import history
+import reconnect
+import shards
+import filters
+import plugins
+import routing
+
 VERSION = "CrossChatLink v0.1.0"
 VERSION_NO = "1"
 CONFIG_FILE = "config.xml"
 LOG_FILE = "ccl.log"
+LOG_FORMAT = "%(asctime)s-%(levelname)s: %(message)s (%(filename)s)"
+SNAPSHOT_FILE = "ccl.snapshot"
+FILTER_FILE = "filters.json" #rules of the filter policies (saved whenever they change)
+METRICS_FILE = "ccl.prom"
+METRICS_INTERVAL = 15 #seconds between writes of the metrics file
+PROFILE_DIR = "profiles"
+HISTORY_DIR = "history"
+HISTORY_RETENTION = 30 #days to keep the message history for
+BACKLOG_MESSAGES = 20 #most messages to replay to a link that reconnects or is newly linked
+BACKLOG_SECONDS = 600 #oldest messages to replay (seconds)
+ECHO_CACHE_SIZE = 4096 #most sent messages to remember for spotting echoes
+ECHO_TTL = 30 #how long after sending a message an echo of it is expected (seconds)
+PROFILE_MAX_TIME = 600 #longest a profiler can be left running (seconds)
+SHARD_RING_SIZE = 4 * 1024 * 1024 #bytes in each ring between two shards
+SHARD_TIMEOUT = 30 #longest to wait for a shard to answer a command or stop (seconds)
+PLUGIN_DIR = "plugins"
+PLUGIN_WORKERS = 4 #threads running plugin hooks
+PLUGIN_QUEUE_SIZE = 1000 #most plugin hook calls waiting for a worker (more are rejected)
+PLUGIN_MAX_STUCK = 4 #most workers to replace while they're stuck running a hook over its budget
+
+#startup connection limits
+CONNECT_PER_HOST = 2 #connection attempts in progress to a single host
+CONNECT_MAX_ACTIVE = 16 #connection attempts in progress overall
+CONNECT_HOST_INTERVAL = 1.0 #seconds between connection attempts to a single host
+CONNECT_TIMEOUT = 30 #seconds to wait for a link to connect before moving on
+
+HANDOFF_TIMEOUT = 30 #seconds to wait for the new process when upgrading
+
+#connection types and the classes that implement them
+LINK_TYPES = {"nmdc": links.NMDC, "adc": links.ADC, "irc": links.IRC}
+
+def _str_to_bool(val):
+    """Converts a config file boolean to a bool"""
+    return val.strip().lower() in ["y", "yes", "true", "1"]
+
+def _lower(val):
+    """Converts a config file name (eg. of a filter policy) to the lowercase used for names"""
+    return val.strip().lower()
+
+def _pacing(val):
+    """Checks a config file pacing mode"""
+    val = val.strip().lower()
+    if val not in ["fixed", "adaptive"]:
+        raise ValueError("Pacing must be 'fixed' or 'adaptive' (not '{}')".format(val))
+    return val
+
+#connection attributes that can be set from the config file and how to convert them
+LINK_ATTRS = {"server": str, "nick": str, "passwd": str, "prefix": str,
+              "auto_connect": _str_to_bool, "auto_reconnect": _str_to_bool, "op_control": _str_to_bool,
+              "mc_rate": float, "pm_rate": float, "pacing": _pacing, "filter_policy": _lower, "digest": float,
+              "transitive": _str_to_bool, "ignore_links": str,
+              "share": str, "slots": str, "client": str,
+              "ident_text": str, "channels": str}
+
+#changes to these attributes only take effect after reconnecting
+RECONNECT_ATTRS = ["server", "nick", "passwd"]
+
+#commands passed on to the shards in sharded mode : position of the connection parameter
+#(the command is only run in the shard with that connection), or None to run it in all of them
+SHARD_COMMANDS = {"status": 1, "stats": 1, "latency": 1, "profile": None, "history": 2, "search": 2,
+                  "connect": 1, "disconnect": 1, "reconnect": 1, "link": None, "unlink": None, "viewusers": 1,
+                  "setuser": 1, "addconnection": 1, "delconnection": 1, "reload": None, "setconnection": 1,
+                  "filter": None, "plugin": None}
+
+def _split_names(names):
+    """Converts a comma separated list of connection names to a list"""
+    return [x.strip().lower() for x in names.split(",") if x.strip()]
+
+def _shard_file(filename, index):
+    """Returns the name of a shard's copy of a file/directory (eg. ccl.prom -> ccl.shard0.prom)"""
+    root, ext = os.path.splitext(filename)
+    return "{}.shard{}{}".format(root, index, ext)
+
+def read_config(filename):
+    """
+    Reads an XML config file into a dict of connection name : spec.
+    Specs are dicts like {"type": type, "attrs": {attribute: value}, "links": [names], "users": [[nick, pm, mc, ctrl]]}
+
+    <config>
+      <connection name="hub" type="nmdc">
+        <server>127.0.0.1:411</server>
+        <nick>Nick</nick>
+        ...
+        <link>irc</link>
+        <user nick="Someone" pm="y" mc="n" ctrl="u"/>
+      </connection>
+    </config>
+    """
+    specs = dict()
+    root = ElementTree.parse(filename).getroot()
+    for con in root.iter("connection"):
+        name = con.get("name", "").lower()
+        con_type = con.get("type", "").lower()
+        if name == "" or name in specs:
+            raise ValueError("Connection names must be given and unique ('{}')".format(name))
+        if con_type not in LINK_TYPES:
+            raise ValueError("'{}' is not a valid connection type".format(con_type))
+
+        spec = {"type": con_type, "attrs": dict(), "links": [], "users": []}
+        for elem in con:
+            text = elem.text or ""
+            if elem.tag in LINK_ATTRS:
+                spec["attrs"][elem.tag] = LINK_ATTRS[elem.tag](text)
+            elif elem.tag == "connect_cmd":
+                spec["attrs"].setdefault("connect_cmds", []).append(text)
+            elif elem.tag == "link":
+                spec["links"].append(text.strip().lower())
+            elif elem.tag == "user":
+                user = [elem.get("nick", "").strip()] + [elem.get(x, "u").strip().upper() for x in ["pm", "mc", "ctrl"]]
+                if user[0] == "":
+                    raise ValueError("A user of connection '{}' has no nick".format(name))
+                if any(x not in ["Y", "N", "U"] for x in user[1:]):
+                    raise ValueError("The pm/mc/ctrl settings of user '{}' on connection '{}' must be 'y', 'n' or 'u'".format(user[0], name))
+                spec["users"].append(user)
+            else:
+                raise ValueError("Unknown setting '{}' for connection '{}'".format(elem.tag, name))
+        for x in ["server", "nick", "passwd", "prefix"]:
+            if x not in spec["attrs"]:
+                raise ValueError("Connection '{}' is missing the '{}' setting".format(name, x))
+        specs[name] = spec
+    return specs
 
 class CrossChatLink(threading.Thread):
     """
@@ -36,10 +178,29 @@ class CrossChatLink(threading.Thread):
              "status":{
                 ADMIN + OP: ["status [connection]", "Displays the connection status. If no connection is specified, a general overview is displayed", [0, 1]],
                 USER: ["status", "Displays a general overview of the connections status", [0]]},
+             "stats":{
+                ADMIN + OP: ["stats [connection]", "Displays traffic statistics. If no connection is specified, an overview of all connections and commands is displayed", [0, 1]]},
+             "latency":{
+                ADMIN + OP: ["latency [source [target]]", "Displays the delay of relayed messages (from being received to being sent).\n"
+                             "Specify a source and target to see where the time was spent", [0, 1, 2]]},
+             "profile":{
+                ADMIN: ["profile 'start' [seconds] ['sample'|'cprofile'] | 'stop' | 'dump'",
+                        "Profiles the program. 'start' samples the stacks of the link and command threads (or with 'cprofile',\n"
+                        "traces the command thread) for the given time (default 60s). 'stop' stops it, 'stop' and 'dump'\n"
+                        "write the results to the '" + PROFILE_DIR + "' directory and display the top functions", [1, 2, 3]]},
+             "history":{
+                ADMIN + OP: ["history <minutes> [connection]", "Displays the messages relayed in the last <minutes> minutes (the most recent 50).\n"
+                             "If a connection is specified, only messages from it are displayed", [1, 2]]},
+             "search":{
+                ADMIN + OP: ["search <text> [connection]", "Searches the message history for <text> (the most recent 50 matches are displayed).\n"
+                             "If a connection is specified, only messages from it are searched", [1, 2]]},
              "exit":{
                 ADMIN: ["exit", "Terminates your admin connection", [0]]},
              "shutdown":{
                 ADMIN: ["shutdown", "Stops the program", [0]]},
+             "upgrade":{
+                ADMIN: ["upgrade", "Starts a new copy of the program (eg. after an update is applied) and hands the connections over to it.\n"
+                        "Connections stay up, but your admin session will be disconnected", [0]]},
              "connect":{
                 ADMIN: ["connect <connection>", "Connects the specified connection", [1]]},
              "disconnect":{
@@ -69,41 +230,278 @@ class CrossChatLink(threading.Thread):
                         "Sets up a new connection. Connection properties can be further refined with 'setconnection'", [6]]},
              "delconnection":{
                 ADMIN: ["delconnection <connection>", "Deletes the specified connection", [0]]},
+             "reload":{
+                ADMIN: ["reload [file]", "Reloads the configuration file (or the specified file) and applies any changes.\n"
+                        "Settings left out of the file are kept. Only connections with a changed server, nick or password are reconnected", [0, 1]]},
+             "filter":{
+                ADMIN: ["filter ['add' <policy> 'drop'|'replace' 'word'|'regex' <pattern> [replacement]] | ['del' <policy> <rule>] | ['use' <connection> <policy>|'none']",
+                        "Manages the filters for relayed messages. With no parameters, lists the policies, their rules and the time spent filtering.\n"
+                        "'add' adds a rule to a policy: messages matching a 'drop' rule aren't relayed, 'replace' rules replace the matching text\n"
+                        "(with '***' unless a replacement is given). 'word' patterns match whole words (ignoring case), 'regex' patterns are\n"
+                        "regular expressions. 'del' deletes a rule (numbered as listed). 'use' filters the messages relayed to a connection with a policy", [0, 3, 5, 6]]},
+             "plugin":{
+                ADMIN: ["plugin ['enable'|'disable' <plugin>]", "Manages the plugins (loaded from the '" + PLUGIN_DIR + "' directory). With no parameters, lists the plugins\n"
+                        "and their hooks with the calls, time spent, timeouts (calls over the time budget), rejections (calls dropped because\n"
+                        "the workers were busy) and errors. 'disable' stops calling a plugin's hooks, 'enable' starts again (this also\n"
+                        "brings back filters disabled for running over their budget)", [0, 2]]},
              "setconnection":{
                 ADMIN: ["setconnection <connection> [property [value]]", "Sets the <property> of the <connection> to <value>.\n"
                         "If <value> is omitted, it displays the current value. If <property> and <value> are omitted, it displays a list of properties", [1, 2, 3]]}
              }
     
-    def __init__(self):
+    def __init__(self, admin_socket = None, shard = None, workers = False):
+        """
+        shard is (index, count, rings, pipe) when running as one of the workers in sharded mode,
+        workers is set in the parent, which only runs the admin interface (see start_shards)
+        """
         super(CrossChatLink, self).__init__()
         self._stop_req = threading.Event()
         
-        logging.info ("Starting " + VERSION)
+        logging.info("Starting %s", VERSION)
+
+        #each shard keeps its own files
+        files = [HISTORY_DIR, METRICS_FILE, SNAPSHOT_FILE, FILTER_FILE]
+        if shard != None:
+            files = [_shard_file(x, shard[0]) for x in files]
+        history_dir, metrics_file, self.snapshot_file, filter_file = files
 
         #stores commands to process
         self._command_queue = queue.Queue()
 
-        #create the telnet thread
-        self.admin_interface = interface.Admin(self)
-        self.admin_interface.start()
+        #the parent in sharded mode has no connections, so no reconnects, history or metrics file either
+        #retries connections that drop
+        self.reconnects = None if workers else reconnect.ReconnectScheduler()
+
+        #messages recently sent to each link (to recognise them if they're echoed back)
+        self.echoes = utils.EchoCache(ECHO_CACHE_SIZE, ECHO_TTL)
+
+        #archive of relayed messages
+        self.history = None if workers else history.HistoryStore(history_dir, HISTORY_RETENTION)
+
+        #metrics (written to a file periodically for scraping)
+        self.metrics = metrics.Registry()
+        self._metrics_writer = None if workers else metrics.Writer(self.metrics, metrics_file, METRICS_INTERVAL)
+
+        for thread in [self.reconnects, self.history, self._metrics_writer]:
+            if thread != None:
+                thread.start()
+
+        #content filters applied to relayed messages
+        self.filters = filters.FilterSet(self.metrics, filter_file)
+
+        #delivery sets of the links that relay transitively
+        self.routes = routing.RouteTable()
+        #config specs of the connections in other shards (sharded mode), kept up to date by the shards that own them
+        self._remote_specs = dict()
+        #name : (links, ignored links) last sent to the other shards for the connections in this one
+        self._published_routes = dict()
 
         #create the initial connection dict
         self.connections = dict()
 
-    def load_config(self):
+        #plugins (their hooks run in a pool of worker threads, off the relay path)
+        self.plugins = plugins.PluginManager(self.metrics, PLUGIN_WORKERS, PLUGIN_QUEUE_SIZE, PLUGIN_MAX_STUCK)
+        self.plugins.load(PLUGIN_DIR, plugins.PluginAPI(self))
+
+        #sharded mode: the parent runs the workers (see start_shards), the workers run the links
+        self.shards = None
+        self.router = None
+        if shard != None:
+            self.router = shards.Router(self, *shard[:3])
+            self.router.start()
+
+        #create the telnet thread (workers get their commands from the parent)
+        if shard != None:
+            self.admin_interface = shards.ShardInterface(self, shard[3])
+        else:
+            self.admin_interface = interface.Admin(self, admin_socket)
+        self.admin_interface.start()
+
+        #shared connections for IRC links on the same server
+        self.irc_pool = links.IRCPool()
+
+        #shared DNS cache for the links
+        self.resolver = utils.Resolver()
+        #(links connected, links started, seconds taken) once the links have been brought up on startup
+        self._startup_result = None
+        #brings up the links on startup (see auto_connect)
+        self._startup = None
+
+        #set once the connections have been handed over to another process
+        self._handed_off = False
+
+        #active profiler (if any)
+        self._profiler = None
+        #thread ident : name of the threads the sampling profiler samples, replaced by the command thread
+        self._profiled_threads = dict()
+
+    def load_config(self, filename = CONFIG_FILE):
         """Loads the configuration file and sets up the links"""
         logging.debug("Loading configuration data")
-        #TODO: load XML file with settings in it
-        #TODO: create/configure the link threads
+        if os.path.exists(filename):
+            specs = read_config(filename)
+        else:
+            #testing
+            specs = {"nmdc": {"type": "nmdc", "attrs": {"server": "127.0.0.1:443", "nick": "Nick", "passwd": "aPass", "prefix": "[NMDC]"},
+                              "links": ["adc", "irc"], "users": []},
+                     "adc": {"type": "adc", "attrs": {"server": "127.0.0.1:443", "nick": "Nick", "passwd": "aPass", "prefix": "[ADC]"},
+                             "links": ["irc"], "users": []},
+                     "irc": {"type": "irc", "attrs": {"server": "127.0.0.1:6667", "nick": "Nick", "passwd": "aPass", "prefix": "[IRC]"},
+                             "links": ["nmdc"], "users": []}}
         logging.debug("Setting up links")
+        self.apply_config(specs, False)
+
+    def start_shards(self, count, log_level):
+        """Runs the links in count worker processes, this process just runs the admin interface"""
+        self.shards = shards.ShardManager(count, run_shard, (log_level,), SHARD_RING_SIZE, SHARD_TIMEOUT)
 
-        #testing
-        self.connections["nmdc"] = links.NMDC(self, "127.0.0.1:443", "Nick", "aPass", "[NMDC]")
-        self.connections["adc"] = links.ADC(self, "127.0.0.1:443", "Nick", "aPass", "[ADC]")
-        self.connections["irc"] = links.IRC(self, "127.0.0.1:6667", "Nick", "aPass", "[IRC]")
-        self.connections["nmdc"].add_links("nmdc", ["adc", "irc"])
-        self.connections["adc"].add_links("adc", ["irc"])
-        self.connections["irc"].add_links("irc", ["nmdc"])
+    def known_link(self, name):
+        """Checks if there's a connection with the name (in any shard)"""
+        return name in self.connections or (self.router != None and name in self.router.remote)
+
+    def apply_config(self, specs, start_new = True):
+        """
+        Makes the connections match the config specs, only touching what changed.
+        Links whose server, nick or password changed are reconnected, new links are started if start_new is set.
+        Returns a list of lines describing the changes
+        """
+        report = []
+
+        if self.router != None:
+            #links in other shards are only relayed to
+            self.router.remote = set(x for x in specs if not self.router.owns(x))
+            self._remote_specs = dict((x, specs[x]) for x in self.router.remote)
+            specs = dict((x, specs[x]) for x in specs if self.router.owns(x))
+
+        #removed connections (or ones that changed type and have to be recreated)
+        for name in sorted(self.connections):
+            if name not in specs or type(self.connections[name]) != LINK_TYPES[specs[name]["type"]]:
+                link = self.connections.pop(name)
+                self.metrics.remove(link=name)
+                self.reconnects.cancel(link)
+                for other in self.connections.values():
+                    other.del_links([name])
+                if link.is_alive():
+                    link.join()
+                report.append("Removed connection '{}'".format(name))
+
+        #new connections
+        added = []
+        for name in sorted(specs):
+            if name not in self.connections:
+                spec = specs[name]
+                attrs = dict(spec["attrs"])
+                args = [attrs.pop(x) for x in ["server", "nick", "passwd", "prefix"]]
+                self.connections[name] = LINK_TYPES[spec["type"]](self, *args, users = spec["users"], **attrs)
+                self.connections[name].name = name
+                self.metrics.add_link(name, self.connections[name])
+                added.append(name)
+                report.append("Added connection '{}'".format(name))
+
+        #changes to existing connections
+        for name in sorted(specs):
+            spec = specs[name]
+            link = self.connections[name]
+            changed = []
+
+            if name not in added:
+                #attributes that aren't in the config are left as they are
+                for attr in sorted(spec["attrs"]):
+                    val = spec["attrs"][attr]
+                    if getattr(link, attr) != val:
+                        setattr(link, attr, val)
+                        changed.append(attr)
+
+                if link.static_users.as_list() != sorted(spec["users"]):
+                    link.static_users = utils.UserData(spec["users"])
+                    changed.append("users")
+
+            #links can only be set up once all the connections exist
+            wanted = [x for x in spec["links"] if self.known_link(x) and x != name]
+            if sorted(link.links) != sorted(set(wanted)):
+                link.del_links(list(link.links))
+                link.add_links(name, wanted)
+                if name not in added:
+                    changed.append("links")
+
+            if changed:
+                report.append("Changed connection '{}': {}".format(name, ", ".join(changed)))
+                if link.is_alive() and any(x in changed for x in RECONNECT_ATTRS):
+                    link.reconnect()
+                    report.append("Reconnecting '{}'".format(name))
+
+        #link objects may have been replaced, or moved to other shards
+        self.update_delivery()
+        for link in self.connections.values():
+            link.update_routes()
+
+        #a missing policy would let everything through unfiltered
+        for name in sorted(self.connections):
+            policy = self.connections[name].filter_policy
+            if policy and self.filters.get(policy) == None:
+                logging.error("Connection '%s' uses the filter '%s', which doesn't exist. Messages relayed to it aren't filtered", name, policy)
+                report.append("WARNING: Connection '{}' uses the filter '{}', which doesn't exist (messages relayed to it aren't filtered)".format(name, policy))
+
+        if start_new:
+            for name in added:
+                if self.connections[name].auto_connect:
+                    self.connections[name].start()
+        return report
+
+    def _route_entry(self, name):
+        """Returns the (links, ignored links) of a connection for the route table, None if it doesn't exist"""
+        link = self.connections.get(name)
+        if link != None:
+            return (link.links, _split_names(link.ignore_links))
+        #links in other shards are only known from the config
+        spec = self._remote_specs.get(name)
+        if spec != None:
+            return (spec["links"], _split_names(spec["attrs"].get("ignore_links", "")))
+        return None
+
+    def update_delivery(self, names = None):
+        """
+        Updates the route table with the links of the connections (all of them if names isn't given)
+        and republishes the routes of the links whose delivery sets changed
+        """
+        if names == None:
+            names = self.routes.names() | set(self.connections) | set(self._remote_specs)
+        entries = dict((x, self._route_entry(x)) for x in names)
+        changed = self.routes.update(entries)
+        for name in changed:
+            link = self.connections.get(name)
+            if link != None and link.transitive:
+                link.update_routes()
+
+        if self.router != None:
+            #the other shards' route tables cover the links in this one too
+            for name, entry in entries.items():
+                if not self.router.owns(name):
+                    continue
+                if entry != None:
+                    entry = (tuple(entry[0]), tuple(entry[1]))
+                if self._published_routes.get(name) != entry:
+                    self.router.publish_routes(name, entry)
+                    if entry == None:
+                        del self._published_routes[name]
+                    else:
+                        self._published_routes[name] = entry
+
+    def remote_routes(self, name, entry):
+        """Called (on the command thread) when a connection in another shard changed its links or ignored links"""
+        if self.router == None or self.router.owns(name):
+            return
+        if entry == None:
+            self._remote_specs.pop(name, None)
+            self.router.remote = self.router.remote - set([name])
+        else:
+            #copied, the spec may be shared with the config
+            spec = dict(self._remote_specs.get(name, {"users": []}))
+            spec["links"] = list(entry[0])
+            spec["attrs"] = dict(spec.get("attrs", {}), ignore_links = ",".join(entry[1]))
+            self._remote_specs[name] = spec
+            self.router.remote = self.router.remote | set([name])
+        self.update_delivery([name])
 
     def save_config(self):
         """Saves the current configuration to a file"""
@@ -114,9 +512,307 @@ class CrossChatLink(threading.Thread):
     def auto_connect(self):
         """Starts the links that are set to autoconnect"""
         logging.debug ("Autoconnecting links...")
+        to_start = [x for x in self.connections.values() if x.auto_connect]
+
+        #links that took over a connection from a previous process are already connected
+        for link in [x for x in to_start if x.wait_connected(0)]:
+            link.start()
+            to_start.remove(link)
+
+        #the links are brought up in the background, so commands can be run in the meantime
+        self._startup = utils.StartupScheduler(self.resolver, to_start, CONNECT_PER_HOST, CONNECT_MAX_ACTIVE,
+                                               CONNECT_HOST_INTERVAL, CONNECT_TIMEOUT, self._startup_done)
+        self._startup.start()
+
+    def _startup_done(self, connected, total, taken):
+        """Called by the startup scheduler once all the links have had a connection attempt"""
+        self._startup_result = (connected, total, taken)
+        logging.info("%d/%d links connected on startup in %.2fs", connected, total, taken)
+
+    def connect_result(self, link, ok):
+        """Called by the links when they connect (ok) or a connection attempt fails"""
+        startup = self._startup
+        if startup != None:
+            startup.attempt_finished(link, ok)
+
+    def link_report(self, kind):
+        """
+        Returns the data about the connections in this process for the 'status' or 'stats' table,
+        so the tables of the shards can be combined (see _status_table and _stats_table)
+        """
+        if kind == "status":
+            startup = None
+            if self._startup_result != None:
+                connected, total, taken = self._startup_result
+                startup = (total, total, connected, taken)
+            elif self._startup != None:
+                startup = (self._startup.finished, self._startup.total, None, None)
+            rows, retries = [], []
+            for con_name in sorted(self.connections):
+                con_obj = self.connections[con_name]
+                con_type = "IRC" if type(con_obj) == links.IRC else ("NMDC" if type(con_obj) == links.NMDC else "ADC")
+                rows.append((con_name, con_type, con_obj.server, con_obj.connection_state, list(con_obj.links)))
+                wait, attempt = self.reconnects.next_attempt(con_obj.reconnect_key())
+                if wait != None:
+                    retries.append("{} in {:.0f}s (attempt {})".format(con_name, wait, attempt))
+            return {"startup": startup, "rows": rows, "retries": retries}
+        elif kind == "stats":
+            names = ["messages_in", "messages_out", "bytes_in", "bytes_out", "drops", "reconnects", "stalls"]
+            rows = []
+            for con_name in sorted(self.connections):
+                con_obj = self.connections[con_name]
+                vals = [getattr(con_obj.metrics, x).value for x in names]
+                depths = [con_obj.queue_depth_func(x)() for x in [con_obj.MAIN, con_obj.PM]]
+                rows.append([con_name] + vals[:4] + depths + vals[4:])
+            return {"rows": rows}
+        raise ValueError("Unknown report '{}'".format(kind))
+
+    def _status_table(self, reports, missing = ()):
+        """Makes the 'status' table from the link_report("status") of each shard (or just this process)"""
+        #line sperator
+        sep = "+{0:-<9}+{0:-<5}+{0:-<28}+{0:-<6}+{0:-<9}+{0:-<9}+".format("")
+        #header
+        temp_ret = ["General status:"]
+        startups = [x["startup"] for x in reports if x["startup"] != None]
+        if startups and all(x[2] != None for x in startups):
+            temp_ret.append("{}/{} links connected on startup in {:.2f}s".format(sum(x[2] for x in startups), sum(x[1] for x in startups),
+                                                                                 max(x[3] for x in startups)))
+        elif startups:
+            temp_ret.append("Connecting links on startup: {}/{} attempts done".format(sum(x[0] for x in startups), sum(x[1] for x in startups)))
+        temp_ret.append("\n{0}\n|{1:9}|{2:5}|{3:28}|{4:6}|{5:9}|{6:9}|\n{0}".format(sep, "Name", "Type", "Server", "State", "Links out", "Links in"))
+        rows = sorted(x for report in reports for x in report["rows"])
+        for con_name, con_type, server, state, links_out in rows:
+            #links in can be from any shard
+            links_in = [x[0] for x in rows if con_name in x[4]]
+            #add connection data
+            for i in range (0, max(len(links_in), len(links_out), 1)):
+                link_out = links_out[i] if i < len(links_out) else ""
+                link_in = links_in[i] if i < len(links_in) else ""
+                if i == 0:
+                    #first line
+                    temp_ret.append("|{:9}|{:5}|{:28}|{:6}|{:9}|{:9}|".format(con_name, con_type, server, state, link_out, link_in))
+                else:
+                    #secondary lines
+                    temp_ret.append("|{0:9}|{0:5}|{0:28}|{0:6}|{1:9}|{2:9}|".format("", link_out, link_in))
+            #seperator
+            temp_ret.append(sep)
+
+        #pending reconnects
+        retries = sorted(x for report in reports for x in report["retries"])
+        if retries:
+            temp_ret.append("\nReconnecting: " + ", ".join(retries))
+        temp_ret.extend("ERROR: No response from shard {}".format(x) for x in missing)
+        return "\n".join(temp_ret)
+
+    def _stats_table(self, reports, missing = ()):
+        """Makes the 'stats' table from the link_report("stats") of each shard (or just this process)"""
+        sep = "+{0:-<9}+{0:-<8}+{0:-<8}+{0:-<10}+{0:-<10}+{0:-<6}+{0:-<6}+{0:-<6}+{0:-<6}+{0:-<6}+".format("")
+        rslt = ["Link statistics:\n", sep,
+                "|{:9}|{:8}|{:8}|{:10}|{:10}|{:6}|{:6}|{:6}|{:6}|{:6}|".format("Name", "Msgs in", "Msgs out", "Bytes in", "Bytes out", "Q main", "Q PM", "Drops", "Recon", "Stalls"),
+                sep]
+        for row in sorted(x for report in reports for x in report["rows"]):
+            rslt.append("|{:9}|{:8}|{:8}|{:10}|{:10}|{:6}|{:6}|{:6}|{:6}|{:6}|".format(*row))
+        rslt.append(sep)
+        rslt.extend("ERROR: No response from shard {}".format(x) for x in missing)
+
+        #the commands are all run by this process
+        rslt.append("\nCommands:")
+        counts = self.metrics.values("ccl_commands_total")
+        latencies = self.metrics.values("ccl_command_seconds")
+        for labels in sorted(counts):
+            snap = latencies[labels].snapshot()
+            rslt.append("{}: {} (average {:.1f}ms)".format(dict(labels)["command"], counts[labels].value,
+                                                          1000 * snap[2] / max(snap[1], 1)))
+        return "\n".join(rslt)
+
+    def export_state(self, socks):
+        """Returns the runtime state of the program (see Link.export_state)"""
+        state = {"version": VERSION_NO, "links": dict(), "admin": len(socks)}
+        socks.append(self.admin_interface.server_socket())
+        for name, link in self.connections.items():
+            state["links"][name] = link.export_state(socks)
+        return state
+
+    def import_state(self, state, socks):
+        """Takes over the connections in the state exported by another process"""
+        used = set([state["admin"]])
+        for name, link_state in state["links"].items():
+            if name in self.connections and self.connections[name].import_state(link_state, socks):
+                used.add(link_state["sock"])
+            else:
+                logging.warning("Couldn't resume connection '%s', its settings changed", name)
+
+        #close any connections that weren't taken over
+        for i, sock in enumerate(socks):
+            if i not in used:
+                sock.close()
+
+    def load_snapshot(self, filename = None):
+        """Restores the runtime state saved by save_snapshot (if there is one)"""
+        filename = filename or self.snapshot_file
+        if not os.path.exists(filename):
+            return
+        start = time.monotonic()
+        try:
+            states = snapshot.load(filename)
+        except (IOError, ValueError, snapshot.SnapshotError) as e:
+            logging.error("Couldn't load snapshot: %s", e)
+            return
+
+        restored = 0
+        for name, state in states.items():
+            if name in self.connections and self.connections[name].import_state(state, []):
+                restored += 1
+        logging.info("Restored %d/%d links from snapshot in %.3fs", restored, len(states), time.monotonic() - start)
+        #so the same messages aren't restored (and sent) again if the program stops without saving one
+        try:
+            os.replace(filename, filename + ".loaded")
+        except OSError as e:
+            logging.error("Couldn't move the loaded snapshot aside: %s", e)
+
+    def save_snapshot(self, filename = None):
+        """Saves the runtime state of the links (users, undelivered messages) to be restored on startup"""
+        filename = filename or self.snapshot_file
+        states = dict((x, self.connections[x].export_state([])) for x in self.connections)
+        try:
+            snapshot.write(filename, states)
+        except IOError as e:
+            logging.error("Couldn't save snapshot: %s", e)
+
+    def upgrade(self):
+        """
+        Starts a new copy of the program and hands the connections over to it.
+        Returns None on success, otherwise an error message (and the program keeps running)
+        """
+        if self.shards != None:
+            return "ERROR: Can't upgrade while running in shards"
+        #a private directory, so no other user can connect to the socket first
+        directory = tempfile.mkdtemp(prefix="ccl-handoff-")
+        path = os.path.join(directory, "handoff.sock")
+
+        logging.info("Handing connections over to a new process")
+        listener = None
+        child = None
+        socks = []
+        state = None
+        try:
+            listener = handoff.listen(path)
+            listener.settimeout(HANDOFF_TIMEOUT)
+            child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--resume", path,
+                                      "--log", logging.getLevelName(logging.getLogger().getEffectiveLevel())])
+            conn = listener.accept()[0]
+            conn.settimeout(HANDOFF_TIMEOUT)
+            #the IRC sessions mustn't read from the connections once they're handed over
+            if not self.irc_pool.hold(HANDOFF_TIMEOUT):
+                raise handoff.HandoffError("The IRC sessions didn't stop")
+            state = self.export_state(socks)
+            handoff.send_state(conn, state, socks)
+            conn.close()
+        except (socket.error, OSError, handoff.HandoffError) as e:
+            logging.error("Handoff failed: %s", e)
+            #the new process mustn't run alongside this one
+            if child != None:
+                child.kill()
+                child.wait()
+            #put back anything taken out of the links
+            if state != None:
+                for name, link_state in state["links"].items():
+                    self.connections[name].import_state(link_state, socks)
+            self.irc_pool.release()
+            return "ERROR: Couldn't hand over to a new process: {}".format(e)
+        finally:
+            if listener != None:
+                listener.close()
+            shutil.rmtree(directory, True)
+
+        #the new process owns the connections now, exit without touching them
         for link in self.connections.values():
-            if link.auto_connect:
-                link.start()
+            link.detach()
+        self._handed_off = True
+        return None
+
+    def _update_profiled_threads(self):
+        """
+        Works out the threads to profile (on the command thread, which owns the connections).
+        The sampler thread reads the dict, it's replaced rather than changed
+        """
+        threads = dict(("link-" + name, link.ident) for name, link in self.connections.items())
+        threads["command"] = self.ident
+        threads["admin"] = self.admin_interface.ident
+        self._profiled_threads = dict((ident, name) for name, ident in threads.items() if ident != None)
+
+    def _profile_report(self):
+        """Writes the profile to disk and returns a summary of it"""
+        prof = self._profiler
+        sampling = isinstance(prof, profiler.SamplingProfiler)
+        filename = os.path.join(PROFILE_DIR, "profile-{}.{}".format(time.strftime("%Y%m%d-%H%M%S", time.localtime(prof.started)),
+                                                                     "collapsed" if sampling else "pstats"))
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            prof.write(filename)
+        except (IOError, OSError) as e:
+            return "ERROR: Couldn't write profile: {}".format(e)
+
+        if sampling:
+            rslt = ["Wrote {} samples to '{}'\nTop functions (own samples/total samples):".format(prof.samples, filename)]
+            rslt.extend("{:6} {:6}  {}".format(own, total, func) for func, own, total in prof.top())
+        else:
+            rslt = ["Wrote profile to '{}'\nTop functions (own time/total time):".format(filename)]
+            rslt.extend("{:8.3f}s {:8.3f}s  {}".format(own, total, func) for func, own, total in prof.top())
+        return "\n".join(rslt)
+
+    def _format_history(self, msgs, title):
+        """Formats messages from the history for display"""
+        if len(msgs) == 0:
+            return "No messages found"
+        return "\n".join([title] + ["[{}] {}: {}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)), link, text)
+                                   for when, link, text in msgs])
+
+    def replay_backlog(self, target, sources = None, since = None):
+        """
+        Sends the recent messages from the links that relay to target (or just the specified sources)
+        to it. If since (monotonic time) is given, only messages after it are replayed.
+        Runs on the command thread (links post it there, see post)
+        """
+        seconds = BACKLOG_SECONDS
+        if since != None:
+            seconds = min(seconds, time.monotonic() - since)
+        if sources == None:
+            sources = [x for x in self.connections if target in self.connections[x].targets]
+
+        link = self.connections.get(target)
+        for source in sources:
+            msgs = self.connections[source].backlog.recent(BACKLOG_MESSAGES, seconds)
+            #the backlog keeps the messages flagged as replays, every target shares them
+            for msg in msgs:
+                if link != None:
+                    link.deliver(msg)
+                else:
+                    #target is in another shard
+                    self.router.forward([target], msg)
+            if msgs:
+                logging.debug("Replayed %d messages from %s to %s", len(msgs), source, target)
+
+    def _link(self, source, target):
+        """Links source ---> target and replays source's recent messages to target"""
+        if source not in self.connections:
+            return "ERROR: '{}' is in another shard".format(source)
+        if target in self.connections[source].links:
+            return "'{}' is already linked to '{}'".format(source, target)
+        self.connections[source].add_links(source, [target])
+        self.update_delivery([source])
+        self.replay_backlog(target, [source])
+        return "Linked '{}' ---> '{}'".format(source, target)
+
+    def _unlink(self, source, target):
+        """Unlinks source ---> target"""
+        if source not in self.connections:
+            return "ERROR: '{}' is in another shard".format(source)
+        if target not in self.connections[source].links:
+            return "'{}' isn't linked to '{}'".format(source, target)
+        self.connections[source].del_links([target])
+        self.update_delivery([source])
+        return "Unlinked '{}' ---> '{}'".format(source, target)
 
     def link_structure(self, connection, split_both):
         """
@@ -159,6 +855,10 @@ class CrossChatLink(threading.Thread):
         
         self._command_queue.put_nowait((command, source, user, usr_lvl))
 
+    def post(self, func, *args):
+        """Runs func(*args) on the command thread (the only thread that changes the connections)"""
+        self._command_queue.put_nowait((func, args))
+
     def _do_command(self, cmd, source, usr_lvl):
         """Does actions required by a command and returns the resulting response"""        
         num_cmds = len(cmd)
@@ -190,6 +890,23 @@ class CrossChatLink(threading.Thread):
         #case-insensitive commands
         cmd[0] = cmd[0].lower()
 
+        #in sharded mode the connections are in the workers
+        if self.shards != None and cmd[0] in SHARD_COMMANDS:
+            if cmd[0] in ["link", "unlink"] and num_cmds == 4:
+                #each direction is changed in the shard with the source connection
+                pairs = {"->": [(2, 3)], "<-": [(3, 2)], "<->": [(2, 3), (3, 2)]}.get(cmd[1])
+                if pairs == None:
+                    return "ERROR: Link direction must be '<-', '->', or '<->'"
+                return "\n".join(self.shards.command([cmd[0], "->", cmd[a].lower(), cmd[b].lower()], cmd[a].lower()) for a, b in pairs)
+            if cmd[0] == "filter" and num_cmds == 4 and cmd[1].lower() == "use":
+                return self.shards.command(cmd, cmd[2].lower())
+            if cmd[0] in ["status", "stats"] and num_cmds == 1:
+                #one table for the links in all the shards
+                reports, missing = self.shards.gather(cmd[0])
+                return (self._status_table if cmd[0] == "status" else self._stats_table)(reports, missing)
+            pos = SHARD_COMMANDS[cmd[0]]
+            return self.shards.command(cmd, cmd[pos].lower() if pos != None and pos < num_cmds else None)
+
         #command entered can be executed, start processing it
         if cmd[0] == "help":
             if num_cmds == 1:
@@ -222,43 +939,137 @@ class CrossChatLink(threading.Thread):
 
         elif cmd[0] == "status":
             if num_cmds == 1:
-                #line sperator
-                sep = "+{0:-<9}+{0:-<5}+{0:-<28}+{0:-<6}+{0:-<9}+{0:-<9}+".format("")
-                #header
-                temp_ret = ["General status:\n\n{0}\n|{1:9}|{2:5}|{3:28}|{4:6}|{5:9}|{6:9}|\n{0}".format(sep, "Name", "Type", "Server", "State", "Links out", "Links in")]
-                for con_name in sorted(self.connections):
-                    #add connection data
-                    con_obj = self.connections[con_name]
-                    link_struct = self.link_structure(con_name, False)
-                    num_links = max(len(link_struct["in"]), len(link_struct["out"]))
-                    
-                    for i in range (0, num_links):
-                        link_out = link_struct["out"][i] if i < len(link_struct["out"]) else ""
-                        link_in = link_struct["in"][i] if i < len(link_struct["in"]) else ""
-                        if i == 0:
-                            #first line
-                            con_type = "IRC" if type(con_obj) == links.IRC else ("NMDC" if type(con_obj) == links.NMDC else "ADC")
-                            temp_ret.append("|{:9}|{:5}|{:28}|{:6}|{:9}|{:9}|".format(con_name, con_type, con_obj.server, con_obj.connection_state, link_out, link_in))
-                        else:
-                            #secondary lines
-                            temp_ret.append("|{0:9}|{0:5}|{0:28}|{0:6}|{1:9}|{2:9}|".format("", link_out, link_in))
-                    #seperator
-                    temp_ret.append(sep)
-                return "\n".join(temp_ret)
+                return self._status_table([self.link_report("status")])
             else:
                 cmd[1] = cmd[1].lower()
                 if cmd[1] in self.connections:
                     con_obj = self.connections[cmd[1]]
                     con_type = "IRC" if type(con_obj) == links.IRC else ("NMDC" if type(con_obj) == links.NMDC else "ADC")
+                    wait, attempt = self.reconnects.next_attempt(con_obj.reconnect_key())
                     return "Status for {} connection '{}':\n\n".format(con_type, cmd[1]) + \
+                        "State: {}{}\n".format(con_obj.connection_state, "" if wait == None else
+                                              " (reconnect attempt {} in {:.0f}s)".format(attempt, wait)) + \
                         "Server: {}\nNick: {}\nPassword: {}\nPrefix: {}\n".format(con_obj.server, con_obj.nick, con_obj.passwd, con_obj.prefix) + \
                         "Connect on startup: {}\nAuto reconnect: {}\nPost rate (main): {}\nPost rate (private): {}\n".format(con_obj.auto_connect, con_obj.auto_reconnect, con_obj.mc_rate, con_obj.pm_rate) + \
+                        ("Pacing: adaptive ({:.2f}s per line, {} flood warnings)\n".format(con_obj.pacer.penalty, con_obj.pacer.floods)
+                         if con_obj.pacing == "adaptive" else "Pacing: fixed\n") + \
+                        "Filter: {}{}\n".format(con_obj.filter_policy or "none", " (doesn't exist, messages aren't filtered)"
+                                                if con_obj.filter_policy and self.filters.get(con_obj.filter_policy) == None else "") + \
+                        "Relays to: {}{}\n".format(", ".join(sorted(con_obj.targets)) or "none", " (transitive)" if con_obj.transitive else "") + \
+                        ("Ignores: {}\n".format(", ".join(_split_names(con_obj.ignore_links))) if con_obj.ignore_links else "") + \
+                        ("Digest: after {}s queued{}\n".format(con_obj.digest, " (merging now)" if con_obj.digesting else "")
+                         if con_obj.digest > 0 else "Digest: off\n") + \
                         ("Channels to join: {}\nIdent text: {}\nConnect command(s):\n{}".format(con_obj.channels, con_obj.ident_text, con_obj.connect_cmds) if con_type == "IRC" \
                         else "Reported share: {}\nReported slots: {}\nReported client: {}".format(con_obj.share, con_obj.slots, con_obj.client))
                 else:
                     return "ERROR: No connection named '{}'".format(cmd[1])
 
-        #exit and shutdown have already been processed
+        elif cmd[0] == "reload":
+            filename = cmd[1] if num_cmds == 2 else CONFIG_FILE
+            start = time.monotonic()
+            try:
+                specs = read_config(filename)
+            except (IOError, ElementTree.ParseError, ValueError) as e:
+                return "ERROR: Couldn't load '{}': {}".format(filename, e)
+            report = self.apply_config(specs)
+            taken = time.monotonic() - start
+            logging.info("Reloaded config from %s in %.3fs (%d changes)", filename, taken, len(report))
+            return "\n".join(["Reloaded '{}' in {:.3f}s".format(filename, taken)] + (report or ["No changes"]))
+
+        elif cmd[0] == "stats":
+            if num_cmds == 1:
+                return self._stats_table([self.link_report("stats")])
+            else:
+                cmd[1] = cmd[1].lower()
+                if cmd[1] in self.connections:
+                    con_obj = self.connections[cmd[1]]
+                    return "Statistics for connection '{}':\n\n".format(cmd[1]) + \
+                        "\n".join("{}: {}".format(help_text, getattr(con_obj.metrics, x).value)
+                                  for x, (name, help_text) in sorted(metrics.LinkMetrics.COUNTERS.items())) + \
+                        "".join("\nQueued ({}): {}".format(x, con_obj.queue_depth_func(i)()) for i, x in enumerate(con_obj.LANES))
+                else:
+                    return "ERROR: No connection named '{}'".format(cmd[1])
+
+        elif cmd[0] == "latency":
+            for x in range(1, num_cmds):
+                cmd[x] = cmd[x].lower()
+                if cmd[x] not in self.connections:
+                    return "ERROR: No connection named '{}'".format(cmd[x])
+
+            if num_cmds < 3:
+                sep = "+{0:-<9}+{0:-<9}+{0:-<9}+{0:-<9}+{0:-<9}+{0:-<9}+{0:-<9}+".format("")
+                rslt = ["Relay latency (ms):\n", sep,
+                        "|{:9}|{:9}|{:9}|{:9}|{:9}|{:9}|{:9}|".format("Source", "Target", "Messages", "50%", "90%", "99%", "Max"), sep]
+                for target in sorted(self.connections):
+                    for source in sorted(self.connections):
+                        hists = self.connections[target].latency(source)
+                        if hists == None or (num_cmds == 2 and source != cmd[1]):
+                            continue
+                        total = hists[2]
+                        rslt.append("|{:9}|{:9}|{:9}|{:9.1f}|{:9.1f}|{:9.1f}|{:9.1f}|".format(source, target, total.count,
+                                    *[1000 * total.percentile(x) for x in [50, 90, 99]] + [total.max / 1000.0]))
+                rslt.append(sep)
+                return "\n".join(rslt)
+            else:
+                hists = self.connections[cmd[2]].latency(cmd[1])
+                if hists == None:
+                    return "No messages have been relayed from '{}' to '{}'".format(cmd[1], cmd[2])
+                rslt = ["Relay latency from '{}' to '{}' over {} messages (ms):\n".format(cmd[1], cmd[2], hists[2].count)]
+                for title, hist in zip(["Parsing and fan-out", "Waiting in queue", "Total"], hists):
+                    rslt.append("{}: 50% {:.1f}, 90% {:.1f}, 99% {:.1f}, max {:.1f}".format(title,
+                                *[1000 * hist.percentile(x) for x in [50, 90, 99]] + [hist.max / 1000.0]))
+                return "\n".join(rslt)
+
+        elif cmd[0] == "profile":
+            cmd[1] = cmd[1].lower()
+            if cmd[1] == "start":
+                if self._profiler != None and self._profiler.running:
+                    return "ERROR: A profiler is already running, stop it first"
+                try:
+                    duration = float(cmd[2]) if num_cmds > 2 else 60
+                except ValueError:
+                    return "ERROR: Invalid time '{}'".format(cmd[2])
+                if duration <= 0 or duration > PROFILE_MAX_TIME:
+                    return "ERROR: Time must be between 0 and {} seconds".format(PROFILE_MAX_TIME)
+                mode = cmd[3].lower() if num_cmds > 3 else "sample"
+                if mode == "sample":
+                    self._update_profiled_threads()
+                    self._profiler = profiler.SamplingProfiler(lambda: self._profiled_threads, duration=duration)
+                    self._profiler.start()
+                elif mode == "cprofile":
+                    self._profiler = profiler.CProfileSession(duration)
+                else:
+                    return "ERROR: Profiling mode must be 'sample' or 'cprofile'"
+                logging.info("Started %s profiler for %ss", mode, duration)
+                return "Started {} profiler for {}s".format(mode, duration)
+            elif cmd[1] in ["stop", "dump"] and num_cmds == 2:
+                if self._profiler == None:
+                    return "ERROR: The profiler hasn't been started"
+                if cmd[1] == "stop":
+                    self._profiler.stop()
+                return self._profile_report()
+            else:
+                return "ERROR: 'profile' command must specify 'start', 'stop' or 'dump'"
+
+        elif cmd[0] in ["history", "search"]:
+            link = None
+            if num_cmds == 3:
+                link = cmd[2].lower()
+                if link not in self.connections:
+                    return "ERROR: No connection named '{}'".format(link)
+
+            start = time.monotonic()
+            if cmd[0] == "history":
+                try:
+                    minutes = float(cmd[1])
+                except ValueError:
+                    return "ERROR: Invalid number of minutes '{}'".format(cmd[1])
+                msgs = self.history.query(time.time() - minutes * 60, link=link)
+            else:
+                msgs = self.history.query(link=link, text=cmd[1])
+            return self._format_history(msgs, "Found {} messages in {:.3f}s:\n".format(len(msgs), time.monotonic() - start))
+
+        #exit, shutdown and upgrade have already been processed
         elif cmd[0] == "connect":
             cmd[1] = cmd[1].lower()
             if cmd[1] in self.connections:
@@ -291,8 +1102,8 @@ class CrossChatLink(threading.Thread):
                 cmd[1] = cmd[1].lower()
                 if source == cmd[1]:
                     return "ERROR: No local links"
-                if cmd[1] in self.connections:
-                    return "TODO: Link source connection ('{}') ---> {}".format(source, cmd[1])
+                if self.known_link(cmd[1]):
+                    return self._link(source, cmd[1])
                 else:
                     return "ERROR: No connection named '{}'".format(cmd[1])
             else:
@@ -302,35 +1113,35 @@ class CrossChatLink(threading.Thread):
                 if cmd[2] == cmd[3]:
                     return "ERROR: No local links"
                 for x in range(2, 4):
-                    if cmd[x] not in self.connections:
+                    if not self.known_link(cmd[x]):
                         return "ERROR: No connection named '{}'".format(cmd[x])
                 if cmd[1] == "->":
-                    return "TODO: Link '{}' ---> '{}'".format(*cmd[2:])
+                    return self._link(cmd[2], cmd[3])
                 elif cmd[1] == "<-":
-                    return "TODO: Link '{}' <--- '{}'".format(*cmd[2:])
+                    return self._link(cmd[3], cmd[2])
                 elif cmd[1] == "<->":
-                    return "TODO: Link '{}' <---> '{}'".format(*cmd[2:])
+                    return self._link(cmd[2], cmd[3]) + "\n" + self._link(cmd[3], cmd[2])
                 else:
                     return "ERROR: Link direction must be '<-', '->', or '<->'"
 
         elif cmd[0] == "unlink":
             if num_cmds == 2:
                 cmd[1] = cmd[1].lower()
-                if cmd[1] in self.connections:
-                    return "TODO: Unlink source connection ('{}') ---> {}".format(source, cmd[1])
+                if self.known_link(cmd[1]):
+                    return self._unlink(source, cmd[1])
                 else:
                     return "ERROR: No connection named '{}'".format(cmd[1])
             else:
                 for x in range(2, 4):
                     cmd[x] = cmd[x].lower()
-                    if cmd[x] not in self.connections:
+                    if not self.known_link(cmd[x]):
                         return "ERROR: No connection named '{}'".format(cmd[x])
                 if cmd[1] == "->":
-                    return "TODO: Unlink '{}' ---> '{}'".format(*cmd[2:])
+                    return self._unlink(cmd[2], cmd[3])
                 elif cmd[1] == "<-":
-                    return "TODO: Unlink '{}' <--- '{}'".format(*cmd[2:])
+                    return self._unlink(cmd[3], cmd[2])
                 elif cmd[1] == "<->":
-                    return "TODO: Unlink '{}' <---> '{}'".format(*cmd[2:])
+                    return self._unlink(cmd[2], cmd[3]) + "\n" + self._unlink(cmd[3], cmd[2])
                 else:
                     return "ERROR: Unlink direction must be '<-', '->', or '<->'"
 
@@ -379,6 +1190,66 @@ class CrossChatLink(threading.Thread):
             else:
                 return "ERROR: No connection named '{}'".format(cmd[1])
             
+        elif cmd[0] == "filter":
+            if num_cmds == 1:
+                rslt = []
+                for policy in self.filters.policies():
+                    users = sorted(x for x in self.connections if self.connections[x].filter_policy == policy.name)
+                    count, spent = self.filters.time_spent(policy.name)
+                    rslt.append("Filter '{}' (used by: {}, {} messages filtered in {:.1f}ms):".format(policy.name, ", ".join(users) or "none",
+                                                                                                   count, spent * 1000))
+                    rslt.extend("  {}. {}".format(i + 1, x) for i, x in enumerate(policy.rules))
+                return "\n".join(rslt) if rslt else "No filters set up"
+
+            cmd[1] = cmd[1].lower()
+            cmd[2] = cmd[2].lower()
+            if cmd[1] == "add" and num_cmds > 5:
+                try:
+                    rule = filters.Rule(cmd[3].lower(), cmd[4].lower(), *cmd[5:])
+                except ValueError as e:
+                    return "ERROR: {}".format(e)
+                self.filters.add_rule(cmd[2], rule)
+                return "Added rule to filter '{}': {}".format(cmd[2], rule)
+            elif cmd[1] == "del" and num_cmds == 4:
+                try:
+                    self.filters.del_rule(cmd[2], int(cmd[3]) - 1)
+                except (ValueError, IndexError):
+                    return "ERROR: No rule '{}' in filter '{}'".format(cmd[3], cmd[2])
+                return "Deleted rule {} from filter '{}'".format(cmd[3], cmd[2])
+            elif cmd[1] == "use" and num_cmds == 4:
+                if cmd[2] not in self.connections:
+                    return "ERROR: No connection named '{}'".format(cmd[2])
+                policy = "" if cmd[3].lower() == "none" else cmd[3].lower()
+                self.connections[cmd[2]].filter_policy = policy
+                return "Messages relayed to '{}' are filtered with: {}".format(cmd[2], policy or "none") + \
+                    (" (it has no rules yet)" if policy and self.filters.get(policy) == None else "")
+            else:
+                return "ERROR: Incorrect parameters for 'filter', try 'help filter' for more info"
+
+        elif cmd[0] == "plugin":
+            if num_cmds == 1:
+                pool = self.plugins.pool
+                rslt = ["Workers: {} ({} stuck), {} calls waiting".format(pool.size, pool.stuck, pool.waiting())]
+                for name, hooks in self.plugins.plugins():
+                    rslt.append("Plugin '{}' ({}):".format(name, "enabled" if any(x.enabled for x in hooks) else "disabled"))
+                    for hook in hooks:
+                        count, total, spent = hook.seconds.snapshot()
+                        rslt.append("  {:8} {} calls in {:.1f}ms, {} timeouts, {} rejected, {} errors (budget {:.1f}ms{})".format(
+                                    hook.kind + ":", total, spent * 1000, hook.timeouts.value, hook.rejected.value, hook.errors.value,
+                                    hook.budget * 1000, "" if hook.enabled else ", disabled"))
+                    if not hooks:
+                        rslt.append("  no hooks")
+                return "\n".join(rslt) if len(rslt) > 1 else "No plugins loaded"
+
+            cmd[1] = cmd[1].lower()
+            if cmd[1] not in ["enable", "disable"]:
+                return "ERROR: Incorrect parameters for 'plugin', try 'help plugin' for more info"
+            try:
+                self.plugins.set_enabled(cmd[2].lower(), cmd[1] == "enable")
+            except KeyError:
+                return "ERROR: No plugin named '{}'".format(cmd[2])
+            return "Plugin '{}' {}d".format(cmd[2].lower(), cmd[1])
+
         elif cmd[0] == "setconnection":
             #setconnection <connection> [property [value]]
             cmd[1] = cmd[1].lower()
@@ -386,12 +1257,13 @@ class CrossChatLink(threading.Thread):
                 return "ERROR: No connection named '{}'".format(cmd[1])
 
             #set availible attributes
-            attrs = ["server", "nick", "passwd", "auto_connect", "auto_reconnect", "mc_rate", "pm_rate", "op_control"]
-            temp = type(self.connections[cmd[1]])
+            link = self.connections[cmd[1]]
+            attrs = ["server", "nick", "passwd", "auto_connect", "auto_reconnect", "mc_rate", "pm_rate", "pacing", "filter_policy", "digest", "transitive", "ignore_links", "op_control"]
+            temp = type(link)
             if temp == links.ADC or temp == links.NMDC:
                 attrs.extend(["share", "slots", "client"])
             else:
-                attrs.extend(["ident_text", "channels", "connect_cmds"])
+                attrs.extend(["ident_text", "channels"])
                 
             if num_cmds == 2:
                 #return a list of attributes
@@ -400,20 +1272,34 @@ class CrossChatLink(threading.Thread):
                 cmd[2] = cmd[2].lower()
                 #display current setting
                 if cmd[2] in attrs:
-                    return "'{}' attribute of '{}' is: {}".format(cmd[2], cmd[1], getattr(self.connections[cmd[1]], cmd[2]))
+                    return "'{}' attribute of '{}' is: {}".format(cmd[2], cmd[1], getattr(link, cmd[2]))
                 else:
                     return "ERROR: No attribute '{}' for connection '{}'".format(cmd[2], cmd[1])
             else:
                 cmd[2] = cmd[2].lower()
                 #set attribute
                 if cmd[2] in attrs:
-                    return "TODO: Set '{}' attribute of connection '{}' to: {}".format(cmd[2], cmd[1], cmd[3])
+                    try:
+                        val = LINK_ATTRS[cmd[2]](cmd[3])
+                    except ValueError as e:
+                        return "ERROR: {}".format(e)
+                    setattr(link, cmd[2], val)
+                    rslt = ["Set '{}' attribute of connection '{}' to: {}".format(cmd[2], cmd[1], val)]
+                    if cmd[2] in ["transitive", "ignore_links"]:
+                        self.update_delivery([cmd[1]])
+                        link.update_routes()
+                    elif cmd[2] == "filter_policy" and val and self.filters.get(val) == None:
+                        rslt.append("WARNING: The filter '{}' doesn't exist (messages relayed to '{}' aren't filtered)".format(val, cmd[1]))
+                    elif cmd[2] in RECONNECT_ATTRS and link.is_alive():
+                        link.reconnect()
+                        rslt.append("Reconnecting '{}'".format(cmd[1]))
+                    return "\n".join(rslt)
                 else:
                     return "ERROR: No attribute '{}' for connection '{}'".format(cmd[2], cmd[1])
                                                                 
         
 
-        logging.critical("helpDB incorrectly configured, let {} through, but it didn't match any if statements".format(cmd[0]))
+        logging.critical("helpDB incorrectly configured, let %s through, but it didn't match any if statements", cmd[0])
         
     def _process_queue(self):
         """Takes the next item from the queue and processes it"""
@@ -422,23 +1308,31 @@ class CrossChatLink(threading.Thread):
             temp = self._command_queue.get(True, 5)
         except queue.Empty as e:
             return False
+        #work posted by other threads
+        if callable(temp[0]):
+            temp[0](*temp[1])
+            return True
         #unpack the tuple
         command, source, user, usr_lvl = temp
+        start = time.monotonic()
 
         #post-response flags (processed *after* sending data to client)
-        shutdown, disconnect = False, False
+        shutdown, disconnect, upgrade = False, False, False
 
         #split the command up into tokens
         try:
             params = shlex.split(command)
         except ValueError:
             return True
-        logging.debug("Command recieved: " + str(params))
+        logging.debug("Command recieved: %s", params)
 
         #Check for post-response actions
         if len(params) == 1 and params[0] == "shutdown" and usr_lvl == self.ADMIN:
             shutdown = True
             response = "Shutting down the server..."
+        elif len(params) == 1 and params[0] == "upgrade" and usr_lvl == self.ADMIN:
+            upgrade = True
+            response = "Handing connections over to a new process..."
         elif len(params) == 1 and params[0] == "exit" and usr_lvl == self.ADMIN:
             disconnect = True
             response = "You are being disconnected (server is still running)"
@@ -446,16 +1340,33 @@ class CrossChatLink(threading.Thread):
             #general command processing
             response = self._do_command(params, source, usr_lvl)
 
+        #only count valid commands (don't want to make a metric for every typo)
+        name = params[0].lower() if len(params) > 0 and params[0].lower() in self.helpDB else "invalid"
+        self.metrics.counter("ccl_commands_total", "Commands processed", command=name).inc()
+        self.metrics.histogram("ccl_command_seconds", "Time taken to process commands", command=name).observe(time.monotonic() - start)
+
         #send the response
         if source == None: #admin interface
             self.admin_interface.msg_queue.put_nowait(response)
             if disconnect:
                 self.admin_interface.disconnect_client()
         elif source in self.connections:
-            self.connections[source].send_PM(response, user)
+            self.connections[source].send_PM(response, user, reply = True)
         else:
             logging.warning("Attempted to send command response to invalid link")
 
+        #in sharded mode the plugins in the parent see the commands, not the workers they're passed on to
+        if self.router == None:
+            self.plugins.command(params, source, user, usr_lvl, response)
+
+        #upgrade (the new process takes over, so this one exits)
+        if upgrade:
+            response = self.upgrade()
+            if response == None:
+                shutdown = True
+            else:
+                self.admin_interface.msg_queue.put_nowait(response)
+
         #shutdown
         if shutdown:
             self.stop()
@@ -467,8 +1378,26 @@ class CrossChatLink(threading.Thread):
         logging.info("Shutting down admin interface")
         self.admin_interface.join()
         logging.info("Shutting down links")
+        if self._startup != None:
+            self._startup.join()
         for link in self.connections.values():
             link.join()
+        if self.shards != None:
+            self.shards.stop()
+        if self._profiler != None:
+            self._profiler.stop()
+        if not self._handed_off:
+            self.save_snapshot()
+        self.resolver.stop()
+        if self.reconnects != None:
+            self.reconnects.join()
+        self.plugins.stop()
+        if self.history != None:
+            self.history.join()
+        if self._metrics_writer != None:
+            self._metrics_writer.join()
+        if self.router != None:
+            self.router.join()
         logging.info("All threads terminated, exiting")
 
     def stop(self):
@@ -480,30 +1409,65 @@ class CrossChatLink(threading.Thread):
         """Proccesses the actions sent to it"""
         while not self._stop_req.isSet():
             self._process_queue()
+            #enforce the time limit of a cProfile session (it can only be stopped from this thread)
+            if isinstance(self._profiler, profiler.CProfileSession):
+                self._profiler.check()
+            #pick up links that were added or started while sampling
+            elif self._profiler != None and self._profiler.running:
+                self._update_profiled_threads()
 
         logging.info("Shutting down...")
         self.shutdown()
         
 
+def run_shard(index, count, rings, conn, log_level):
+    """Runs the links of one shard (the worker processes started by start_shards)"""
+    #the parent tells the workers when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_listener = utils.setup_logging(_shard_file(LOG_FILE, index), log_level, LOG_FORMAT)
+    instance = CrossChatLink(shard = (index, count, rings, conn))
+    instance.load_config()
+    instance.load_snapshot()
+    instance.auto_connect()
+    instance.start()
+    instance.join()
+    log_listener.stop()
+
+
 if __name__ == "__main__":
-    # specify --log=DEBUG/INFO/WARN/ERROR/CRITICAL as a param (defaults to WARN)
-    try:
-        temp = int(getattr(logging, loglevel.upper(), None))
-    except Exception as e:
-        temp = logging.DEBUG
+    parser = argparse.ArgumentParser(description=VERSION)
+    parser.add_argument("--log", default="WARN", help="Logging level (DEBUG/INFO/WARN/ERROR/CRITICAL, defaults to WARN)")
+    #used internally when upgrading
+    parser.add_argument("--resume", metavar="SOCKET", help=argparse.SUPPRESS)
+    parser.add_argument("--shards", type=int, default=1, help="Number of worker processes to run the links in (defaults to 1, no workers)")
+    args = parser.parse_args()
+    temp = getattr(logging, args.log.upper(), logging.WARN)
         
-    logging.basicConfig(filename=LOG_FILE, level=temp, format="%(asctime)s-%(levelname)s: %(message)s (%(filename)s)")
+    #records are written to the file by a background thread
+    log_listener = utils.setup_logging(LOG_FILE, temp, LOG_FORMAT)
     logging.critical("Program started")
     print("Program started, press CTRL-C to exit")
 
-    instance = CrossChatLink()
-    instance.load_config()
-    instance.auto_connect()
+    #take over from a previous process
+    state, socks = None, []
+    if args.resume != None:
+        state, socks = handoff.receive_state(args.resume, HANDOFF_TIMEOUT)
+
+    instance = CrossChatLink(socks[state["admin"]] if state != None else None, workers = args.shards > 1)
+    if args.shards > 1:
+        instance.start_shards(args.shards, temp)
+    else:
+        instance.load_config()
+        if state != None:
+            instance.import_state(state, socks)
+        else:
+            instance.load_snapshot()
+        instance.auto_connect()
     instance.start()
 
     #Wait until the main thread exits (or throws an exception)
     try:
-        while instance.isAlive():
+        while instance.is_alive():
             instance.join(2)
     except:
         print("Exiting...")
@@ -511,6 +1475,7 @@ if __name__ == "__main__":
         instance.join()
 
     logging.critical("Program exited succesfully")
+    log_listener.stop()
     print("Program exited succesfully")
 
     
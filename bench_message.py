@@ -0,0 +1,96 @@
+
+import time
+import tracemalloc
+import argparse
+
+import links
+import utils
+import message
+
+#Measures the cost of relaying a message to a set of links, with the line built by every
+#target (str) or once per link type, encoding and framing (message.Message)
+
+class _History():
+    def add(self, link, text, when = None):
+        pass
+
+class _Program():
+    """The parts of the program the links use when relaying"""
+
+    def __init__(self):
+        self.connections = dict()
+        self.echoes = utils.EchoCache()
+        self.history = _History()
+        self.router = None
+
+def _setup(targets):
+    program = _Program()
+    types = [links.NMDC, links.ADC, links.IRC]
+    for i in range(targets + 1):
+        link = types[i % len(types)](program, "localhost", "Bot", "", "")
+        link.name = "link{}".format(i)
+        link._disconnected_at = None
+        if isinstance(link, links.IRC):
+            link.channels = "#chat"
+        program.connections[link.name] = link
+    source = program.connections["link0"]
+    source._links = [x for x in program.connections if x != "link0"]
+    return program, source
+
+def _relay(program, source, text, count, use_message):
+    """Relays count messages from the source, as a Message or a str"""
+    for i in range(count):
+        msg = message.Message(source.name, "alice", "<alice> {} {}".format(text, i))
+        for target in source._links:
+            link = program.connections[target]
+            program.echoes.add(target, msg.text)
+            if use_message:
+                link.send_chat(msg)
+            else:
+                link.send_chat(msg.text, msg.trace())
+
+def _distinct_lines(program):
+    """Returns the number of different line objects in the mainchat queues"""
+    return len(set(id(x[0]) for link in program.connections.values() for x in link._queues[link.MAIN].queue))
+
+def _clear(program):
+    for link in program.connections.values():
+        for num in [link.MAIN, link.PM]:
+            link._clear_queue(num)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark relaying messages as str vs message.Message")
+    parser.add_argument("--targets", type=int, default=12, help="Number of links each message is sent to")
+    parser.add_argument("--count", type=int, default=2000, help="Number of messages relayed")
+    parser.add_argument("--text", default="some text with <escapes> & $pecial characters|in it", help="Text of the messages")
+    args = parser.parse_args()
+
+    program, source = _setup(args.targets)
+    print("{} messages to {} links".format(args.count, args.targets))
+    for name, use_message in [("str", False), ("Message", True)]:
+        #warm up (caches, interned strings)
+        _relay(program, source, args.text, 10, use_message)
+        _clear(program)
+
+        start = time.perf_counter()
+        _relay(program, source, args.text, args.count, use_message)
+        elapsed = time.perf_counter() - start
+        lines = _distinct_lines(program)
+        _clear(program)
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        _relay(program, source, args.text, args.count, use_message)
+        peak = tracemalloc.get_traced_memory()[1]
+        stats = tracemalloc.take_snapshot().compare_to(before, "filename")
+        tracemalloc.stop()
+        _clear(program)
+
+        blocks = sum(x.count_diff for x in stats)
+        size = sum(x.size_diff for x in stats)
+        print("{:8}: {:.1f}us, {:.1f} lines built, {:.1f} blocks ({:.0f} bytes) queued, {:.0f} bytes peak per message".format(
+              name, elapsed / args.count * 1000000, lines / args.count, blocks / args.count, size / args.count, peak / args.count))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+
+import re
+import os
+import json
+import time
+import threading
+import logging
+
+#Content filters for relayed messages. A policy is a list of rules that drop or rewrite
+#messages. The drop rules and the replace rules of a policy are each compiled into one regex
+#(an alternation with a named group per rule) so a message is scanned at most twice however
+#many rules there are. Links name the policy applied to the messages relayed to them (see
+#Link.filter_policy). The policies are saved to a file whenever they change.
+
+class Rule():
+    """A filter rule: a pattern and what to do with messages that match it"""
+
+    #actions
+    DROP = "drop" #the message isn't relayed
+    REPLACE = "replace" #the matching text is replaced
+
+    #pattern types
+    WORD = "word" #whole words/phrases (case-insensitive)
+    REGEX = "regex" #regular expression
+
+    def __init__(self, action, kind, pattern, replacement = "***"):
+        if action not in [self.DROP, self.REPLACE]:
+            raise ValueError("Filter action must be '{}' or '{}'".format(self.DROP, self.REPLACE))
+        if kind not in [self.WORD, self.REGEX]:
+            raise ValueError("Filter pattern type must be '{}' or '{}'".format(self.WORD, self.REGEX))
+        if pattern == "":
+            raise ValueError("Filter pattern can't be empty")
+        self.action = action
+        self.kind = kind
+        self.pattern = pattern
+        self.replacement = replacement
+        if kind == self.WORD:
+            self.regex = r"(?i:(?<!\w){}(?!\w))".format(re.escape(pattern))
+        else:
+            #the rules are combined into one regex, so numbered backreferences can't be used
+            self.regex = "(?:{})".format(pattern)
+            try:
+                re.compile(self.regex)
+            except re.error as e:
+                raise ValueError("Invalid regex '{}': {}".format(pattern, e))
+
+    def __str__(self):
+        return "{} {} '{}'".format(self.action, self.kind, self.pattern) + \
+            (" -> '{}'".format(self.replacement) if self.action == self.REPLACE else "")
+
+
+class Policy():
+    """
+    A named list of rules, compiled into matchers. Policies aren't changed once made.
+    Drop rules are checked first (against the original text), so a replace rule can't hide a
+    match of a drop rule. Replace rules are applied leftmost match first, where several match
+    at the same place the first rule wins
+    """
+
+    def __init__(self, name, rules = ()):
+        self.name = name
+        self.rules = tuple(rules)
+        self._drop = self._compile(Rule.DROP)
+        self._replace = self._compile(Rule.REPLACE)
+
+    def _compile(self, action):
+        """Compiles the rules with the action into one regex (None if there aren't any)"""
+        rules = [(i, x) for i, x in enumerate(self.rules) if x.action == action]
+        if not rules:
+            return None
+        return re.compile("|".join("(?P<_f{}>{})".format(i, x.regex) for i, x in rules))
+
+    def apply(self, text):
+        """Returns the text with the replace rules applied, or None if a drop rule matches"""
+        if self._drop != None and self._drop.search(text) != None:
+            return None
+        if self._replace == None:
+            return text
+        return self._replace.sub(lambda match: self.rules[int(match.lastgroup[2:])].replacement, text)
+
+
+class FilterSet():
+    """
+    The filter policies used by the links, with metrics of what they did and how long it took.
+    If a filename is given, the policies are loaded from it and saved to it whenever they change
+    """
+
+    def __init__(self, registry, filename = None):
+        self._registry = registry
+        self._filename = filename
+        self._lock = threading.Lock()
+        #policy name : (Policy, time histogram, dropped counter, rewritten counter)
+        #entries are replaced as a whole when the rules change, so they can be read without locking
+        self._policies = dict()
+        if filename != None and os.path.exists(filename):
+            self._load()
+
+    def _load(self):
+        """Reads the policies from the file"""
+        try:
+            with open(self._filename, encoding="utf-8") as f:
+                data = json.load(f)
+            for name, rules in data.items():
+                for action, kind, pattern, replacement in rules:
+                    self._add(name, Rule(action, kind, pattern, replacement))
+        except (IOError, ValueError, TypeError) as e:
+            logging.error("Couldn't load the filters from %s: %s", self._filename, e)
+
+    def _save(self):
+        """Writes the policies to the file (via a temp file so it's never left half written, hold _lock)"""
+        if self._filename == None:
+            return
+        data = dict((name, [[x.action, x.kind, x.pattern, x.replacement] for x in entry[0].rules])
+                    for name, entry in self._policies.items())
+        temp = self._filename + ".tmp"
+        try:
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(temp, self._filename)
+        except IOError as e:
+            logging.error("Couldn't save the filters to %s: %s", self._filename, e)
+
+    def policies(self):
+        """Returns a list of the policies, sorted by name"""
+        with self._lock:
+            return [self._policies[x][0] for x in sorted(self._policies)]
+
+    def get(self, name):
+        """Returns the policy with the name (None if there isn't one)"""
+        entry = self._policies.get(name)
+        return entry[0] if entry != None else None
+
+    def time_spent(self, name):
+        """Returns the (number of messages, total seconds) filtered by a policy"""
+        entry = self._policies.get(name)
+        if entry == None:
+            return (0, 0.0)
+        snap = entry[1].snapshot()
+        return (snap[1], snap[2])
+
+    def add_rule(self, name, rule):
+        """Adds a rule to a policy (creating it if needed)"""
+        with self._lock:
+            self._add(name, rule)
+            self._save()
+
+    def _add(self, name, rule):
+        """Adds a rule to a policy (hold _lock, or be loading)"""
+        old = self._policies.get(name)
+        if old == None:
+            old = (Policy(name),
+                   self._registry.histogram("ccl_filter_seconds", "Time spent filtering relayed messages", policy=name),
+                   self._registry.counter("ccl_filter_dropped_total", "Relayed messages dropped by the filter", policy=name),
+                   self._registry.counter("ccl_filter_rewritten_total", "Relayed messages rewritten by the filter", policy=name))
+        self._policies[name] = (Policy(name, old[0].rules + (rule,)),) + old[1:]
+
+    def del_rule(self, name, index):
+        """Deletes a rule (by index) from a policy, deleting the policy once it has no rules left"""
+        with self._lock:
+            old = self._policies.get(name)
+            if old == None or not 0 <= index < len(old[0].rules):
+                raise IndexError("No rule {} in filter '{}'".format(index + 1, name))
+            rules = old[0].rules[:index] + old[0].rules[index + 1:]
+            if rules:
+                self._policies[name] = (Policy(name, rules),) + old[1:]
+            else:
+                del self._policies[name]
+                self._registry.remove(policy=name)
+            self._save()
+
+    def apply(self, name, msg, decisions):
+        """
+        Returns the message.Message to relay to a link using the policy name: msg itself, a rewritten
+        copy, or None if it's dropped. decisions is kept for the length of one message, so each
+        policy only runs once per message however many links use it
+        """
+        try:
+            return decisions[name]
+        except KeyError:
+            pass
+
+        entry = self._policies.get(name)
+        rslt = msg
+        if entry != None:
+            policy, spent, dropped, rewritten = entry
+            start = time.perf_counter()
+            text = policy.apply(msg.text)
+            spent.observe(time.perf_counter() - start)
+            if text == None:
+                dropped.inc()
+                rslt = None
+            elif text != msg.text:
+                rewritten.inc()
+                rslt = msg.copy(text)
+        decisions[name] = rslt
+        return rslt
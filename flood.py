@@ -0,0 +1,57 @@
+
+import threading
+import time
+import logging
+
+class Pacer():
+    """
+    Paces lines the way servers count them for flood control (like an ircd's "2 seconds per line
+    with a burst"): every line adds a penalty to a clock, and lines can be sent while the clock
+    is less than burst seconds ahead of real time.
+    The penalty adapts (AIMD): it doubles (up to max_penalty) whenever the server complains about
+    flooding, and comes back down by step after every clean_lines lines sent without complaints
+    (down to min_penalty), so it settles just under what the server will take.
+    One flood usually sets off several warnings, so the penalty only goes up once per min_interval seconds
+    """
+
+    def __init__(self, penalty, burst, min_penalty, max_penalty, step, clean_lines = 20, min_interval = 10.0):
+        self.penalty = penalty
+        self.burst = burst
+        self.min_penalty = min_penalty
+        self.max_penalty = max_penalty
+        self.step = step
+        self.clean_lines = clean_lines
+        self.min_interval = min_interval
+        self.floods = 0
+        self._lock = threading.Lock()
+        self._clock = 0
+        self._clean = 0
+        self._last_flood = None
+
+    def delay(self, now):
+        """Returns how long to wait before the next line can be sent"""
+        return max(self._clock - self.burst - now, 0)
+
+    def sent(self, now):
+        """Records a line being sent"""
+        with self._lock:
+            self._clock = max(self._clock, now) + self.penalty
+            self._clean += 1
+            if self._clean >= self.clean_lines:
+                self._clean = 0
+                self.penalty = max(self.penalty - self.step, self.min_penalty)
+
+    def flood(self, reason):
+        """Slows down after the server warned about (or kicked/disconnected us for) flooding"""
+        now = time.monotonic()
+        with self._lock:
+            self.floods += 1
+            if self._last_flood != None and now - self._last_flood < self.min_interval:
+                logging.info("Flood warning (%s) soon after the last one, not slowing down further", reason)
+                return
+            self._last_flood = now
+            self.penalty = min(self.penalty * 2, self.max_penalty)
+            #let the server's count drain before sending anything else
+            self._clock = now + self.burst + self.penalty
+            self._clean = 0
+        logging.warning("Flood warning (%s), slowing down to %.2fs per line", reason, self.penalty)
@@ -0,0 +1,148 @@
+
+import socket
+import struct
+import array
+import logging
+
+import snapshot
+
+#Hands the program state and live sockets over to a new process through a unix socket.
+#The old process listens, the new one connects and receives:
+#  - a header (magic, version, payload length) followed by the state
+#  - the file descriptors, in batches sent as SCM_RIGHTS ancillary data
+#and then acknowledges so the old process knows it can exit without closing anything.
+#
+#State layout (big-endian, strings are a length (H) followed by utf-8 data):
+#  index of the admin socket (I), program version (string), number of links (H)
+#  per link: name (string), connection state (B), index of its socket (i, -1 for none)
+#  followed by the state of the links in the snapshot format (see snapshot.py)
+
+MAGIC = b"CCLH"
+VERSION = 1
+_HEADER = struct.Struct("!4sII")
+#stay below the kernel's limit on descriptors per message
+_FDS_PER_MSG = 200
+_ACK = b"OK"
+
+_H = struct.Struct("!H")
+_STATE = struct.Struct("!I")
+_LINK = struct.Struct("!Bi")
+
+class HandoffError(Exception):
+    """Raised when the state can't be handed over"""
+
+
+def _pack_str(out, val):
+    data = val.encode("utf-8")
+    out.append(_H.pack(len(data)))
+    out.append(data)
+
+def _unpack_str(buf, pos):
+    """Returns (the string at pos, the position after it)"""
+    size = _H.unpack_from(buf, pos)[0]
+    pos += _H.size
+    if pos + size > len(buf):
+        raise HandoffError("Handoff state is truncated")
+    return buf[pos:pos + size].decode("utf-8"), pos + size
+
+def _pack_state(state):
+    """Returns the program state (see CrossChatLink.export_state) as bytes"""
+    out = [_STATE.pack(state["admin"])]
+    _pack_str(out, state["version"])
+    out.append(_H.pack(len(state["links"])))
+    for name in sorted(state["links"]):
+        link = state["links"][name]
+        _pack_str(out, name)
+        out.append(_LINK.pack(link["connection_state"], -1 if link["sock"] == None else link["sock"]))
+    out.append(snapshot.dumps(state["links"]))
+    return b"".join(out)
+
+def _unpack_state(buf):
+    """Reads the program state packed by _pack_state, raises HandoffError if it's invalid"""
+    try:
+        state = {"admin": _STATE.unpack_from(buf, 0)[0]}
+        state["version"], pos = _unpack_str(buf, _STATE.size)
+        count = _H.unpack_from(buf, pos)[0]
+        pos += _H.size
+        extra = dict()
+        for i in range(count):
+            name, pos = _unpack_str(buf, pos)
+            extra[name] = _LINK.unpack_from(buf, pos)
+            pos += _LINK.size
+        state["links"] = snapshot.loads(memoryview(buf)[pos:])
+    except (struct.error, UnicodeDecodeError, snapshot.SnapshotError) as e:
+        raise HandoffError("Invalid handoff state ({})".format(e))
+    if set(extra) != set(state["links"]):
+        raise HandoffError("Invalid handoff state (the links don't match)")
+    for name, (connection_state, sock) in extra.items():
+        state["links"][name]["connection_state"] = connection_state
+        state["links"][name]["sock"] = None if sock < 0 else sock
+    return state
+
+def listen(path):
+    """Creates the unix socket the new process will connect to"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    return sock
+
+def _recv_exact(conn, size):
+    """Receives exactly size bytes"""
+    data = []
+    while size > 0:
+        chunk = conn.recv(size)
+        if not chunk:
+            raise HandoffError("Connection closed during handoff")
+        data.append(chunk)
+        size -= len(chunk)
+    return b"".join(data)
+
+def send_state(conn, state, socks):
+    """
+    Sends the state and sockets to the new process and waits for it to acknowledge.
+    The state refers to sockets by their index in socks
+    """
+    payload = _pack_state(state)
+    conn.sendall(_HEADER.pack(MAGIC, VERSION, len(payload)) + payload)
+
+    fds = [x.fileno() for x in socks]
+    conn.sendall(struct.pack("!I", len(fds)))
+    for i in range(0, len(fds), _FDS_PER_MSG):
+        batch = fds[i:i + _FDS_PER_MSG]
+        conn.sendmsg([bytes([len(batch)])], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", batch))])
+
+    if _recv_exact(conn, len(_ACK)) != _ACK:
+        raise HandoffError("New process didn't acknowledge the handoff")
+    logging.info("Handed off %d bytes of state and %d sockets", len(payload), len(fds))
+
+def receive_state(path, timeout = 30):
+    """
+    Connects to the old process and receives the state and sockets from it.
+    Returns a (state, [sockets]) tuple
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(path)
+        magic, version, size = _HEADER.unpack(_recv_exact(conn, _HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise HandoffError("Incompatible handoff (version {})".format(version))
+        state = _unpack_state(_recv_exact(conn, size))
+
+        num_fds = struct.unpack("!I", _recv_exact(conn, 4))[0]
+        fds = array.array("i")
+        while len(fds) < num_fds:
+            msg, ancdata, flags, addr = conn.recvmsg(1, socket.CMSG_SPACE(_FDS_PER_MSG * fds.itemsize))
+            if not msg:
+                raise HandoffError("Connection closed during handoff")
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+
+        conn.sendall(_ACK)
+    finally:
+        conn.close()
+
+    socks = [socket.socket(fileno=x) for x in fds]
+    logging.info("Received %d bytes of state and %d sockets", size, len(socks))
+    return (state, socks)
@@ -0,0 +1,266 @@
+
+import threading
+import queue
+import os
+import re
+import mmap
+import array
+import bisect
+import time
+import logging
+
+import utils
+
+#Archive of relayed messages.
+#Messages are written by a background thread into segments. Each segment is made of:
+#  <start>.log: one line per message: "<time>\t<link>\t<text>\n" (utf-8, newlines in the text escaped)
+#  <start>.idx: two native uint64s per message: time in microseconds, offset of the line << 16 | link id
+#Link ids index into links.txt (one name per line). Segments are rotated by size and age
+#and deleted once they are older than the retention period.
+
+_LINK_BITS = 16
+
+class _Segment():
+    """A segment of the archive"""
+
+    def __init__(self, path, start):
+        self.path = path
+        self.start = start
+        self.end = start
+
+    def load_index(self):
+        """Reads the index, returns the (times, packed offsets/link ids) arrays"""
+        idx = array.array("Q")
+        with open(self.path + ".idx", "rb") as f:
+            data = f.read()
+        idx.frombytes(data[:len(data) - len(data) % (2 * idx.itemsize)])
+        if len(idx):
+            self.end = idx[-2] / 1000000.0
+        return idx[0::2], idx[1::2]
+
+    def remove(self):
+        for x in [".log", ".idx"]:
+            try:
+                os.remove(self.path + x)
+            except OSError:
+                pass
+
+
+class HistoryStore(threading.Thread):
+    """
+    Stores relayed messages and searches them.
+    add() only queues the message, the writing is done by this thread
+    """
+
+    def __init__(self, directory, retention = 30, segment_size = 16 * 1024 * 1024, segment_age = 86400, flush_interval = 1.0):
+        super(HistoryStore, self).__init__()
+        self._dir = directory
+        self.retention = retention #days
+        self._segment_size = segment_size
+        self._segment_age = segment_age
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(100000)
+        self._stop_req = threading.Event()
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        #link name : id
+        self._links_file = os.path.join(directory, "links.txt")
+        self._link_ids = dict()
+        self._link_names = []
+        if os.path.exists(self._links_file):
+            with open(self._links_file, encoding="utf-8") as f:
+                self._link_names = [x.rstrip("\n") for x in f]
+            self._link_ids = dict((x, i) for i, x in enumerate(self._link_names))
+
+        self._segments = []
+        for x in sorted(os.listdir(directory)):
+            if x.endswith(".log"):
+                try:
+                    seg = _Segment(os.path.join(directory, x[:-4]), int(x[:-4]) / 1000.0)
+                except ValueError:
+                    continue
+                seg.load_index()
+                self._segments.append(seg)
+
+        self._current = None
+        self._log = None
+        self._idx = None
+        self._offset = 0
+
+    def add(self, link, text, when = None):
+        """Queues a relayed message (sent at the time when, defaults to now) to be archived (never blocks)"""
+        try:
+            self._queue.put_nowait((when or time.time(), link, text))
+        except queue.Full:
+            self.dropped += 1
+
+    def _link_id(self, name):
+        link_id = self._link_ids.get(name)
+        if link_id == None:
+            link_id = len(self._link_names)
+            with open(self._links_file, "a", encoding="utf-8") as f:
+                f.write(name + "\n")
+            self._link_names.append(name)
+            self._link_ids[name] = link_id
+        return link_id
+
+    def _needs_rotate(self, now, pending):
+        """Checks if the current segment is too big or old (pending bytes are about to be written to it)"""
+        return (self._current == None or self._offset + pending >= self._segment_size or
+                now - self._current.start >= self._segment_age)
+
+    def _rotate(self, now):
+        """Starts a new segment"""
+        self._close_segment()
+
+        seg = _Segment(os.path.join(self._dir, "{:016d}".format(int(now * 1000))), now)
+        self._log = open(seg.path + ".log", "ab")
+        self._idx = open(seg.path + ".idx", "ab")
+        self._offset = 0
+        self._current = seg
+        with self._lock:
+            self._segments.append(seg)
+        self._expire(now)
+
+    def _close_segment(self):
+        if self._log != None:
+            self._log.close()
+            self._idx.close()
+            self._log = self._idx = None
+
+    def _expire(self, now):
+        """Deletes segments older than the retention period"""
+        cutoff = now - self.retention * 86400
+        with self._lock:
+            #the end of a segment is the start of the next one
+            old = [x for i, x in enumerate(self._segments[:-1]) if self._segments[i + 1].start < cutoff]
+            self._segments = self._segments[len(old):]
+        for x in old:
+            logging.info("Deleting history segment %s", x.path)
+            x.remove()
+
+    def _write(self, items):
+        lines = []
+        index = array.array("Q")
+        pending = 0
+        for when, link, text in items:
+            if self._needs_rotate(when, pending):
+                self._flush(lines, index)
+                lines, index, pending = [], array.array("Q"), 0
+                self._rotate(when)
+
+            line = "{:.3f}\t{}\t{}\n".format(when, link, text.replace("\\", "\\\\").replace("\n", "\\n")).encode("utf-8")
+            index.append(int(when * 1000000))
+            index.append(((self._offset + pending) << _LINK_BITS) | self._link_id(link))
+            lines.append(line)
+            pending += len(line)
+        self._flush(lines, index)
+
+    def _flush(self, lines, index):
+        if not lines:
+            return
+        data = b"".join(lines)
+        self._log.write(data)
+        self._log.flush()
+        self._idx.write(index.tobytes())
+        self._idx.flush()
+        self._offset += len(data)
+        self._current.end = index[-2] / 1000000.0
+
+    def run(self):
+        while True:
+            stopping = self._stop_req.wait(self._flush_interval)
+            items = []
+            try:
+                while True:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if items:
+                try:
+                    self._write(items)
+                except IOError as e:
+                    logging.error("Couldn't write history: %s", e)
+            elif self._current != None and self._needs_rotate(time.time(), 0):
+                #start a new segment once the current one is too old, even if it's quiet
+                self._close_segment()
+                self._current = None
+                self._expire(time.time())
+            if stopping:
+                break
+        self._close_segment()
+
+    def join(self, timeout=None):
+        """Override join to write out everything queued and stop the thread"""
+        self._stop_req.set()
+        super(HistoryStore, self).join(timeout)
+
+    def query(self, start = 0, end = None, link = None, text = None, limit = 50):
+        """
+        Returns up to limit (most recent) messages between the start and end times as a list of
+        (time, link, text). Can be restricted to messages from one link and/or containing some text
+        """
+        end = end or time.time() + 1
+        link_id = self._link_ids.get(link) if link != None else None
+        if link != None and link_id == None:
+            return []
+        pattern = re.compile(re.escape(text.encode("utf-8")), re.IGNORECASE) if text else None
+
+        with self._lock:
+            segs = list(self._segments)
+        rslt = []
+        #newest segments first, stop once there are enough results
+        for i in range(len(segs) - 1, -1, -1):
+            seg = segs[i]
+            seg_end = segs[i + 1].start if i + 1 < len(segs) else end
+            if seg.start > end or seg_end < start:
+                continue
+            rslt = self._query_segment(seg, start, end, link_id, pattern, limit - len(rslt)) + rslt
+            if len(rslt) >= limit:
+                break
+        return rslt
+
+    def _query_segment(self, seg, start, end, link_id, pattern, limit):
+        times, packed = seg.load_index()
+        if not times:
+            return []
+        lo = bisect.bisect_left(times, int(start * 1000000))
+        hi = bisect.bisect_right(times, int(end * 1000000))
+        if lo >= hi:
+            return []
+
+        link_mask = (1 << _LINK_BITS) - 1
+        offsets = [x >> _LINK_BITS for x in packed]
+        with open(seg.path + ".log", "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if pattern != None:
+                    #scan the data for matches and map them back to lines
+                    matches = []
+                    for m in pattern.finditer(data, offsets[lo], offsets[hi] if hi < len(offsets) else size):
+                        rec = bisect.bisect_right(offsets, m.start()) - 1
+                        if not matches or matches[-1] != rec:
+                            matches.append(rec)
+                else:
+                    matches = range(lo, hi)
+
+                if link_id != None:
+                    matches = [x for x in matches if packed[x] & link_mask == link_id]
+
+                rslt = []
+                for rec in reversed(matches):
+                    line_end = offsets[rec + 1] if rec + 1 < len(offsets) else size
+                    when, link, text = data[offsets[rec]:line_end].decode("utf-8", "replace").rstrip("\n").split("\t", 2)
+                    text = utils.escape_replace(text, "\\", {"\\": "\\", "n": "\n"})
+                    #the pattern can also match the time/link name
+                    if pattern != None and pattern.search(text.encode("utf-8")) == None:
+                        continue
+                    rslt.append((float(when), link, text))
+                    if len(rslt) >= limit:
+                        break
+        return list(reversed(rslt))
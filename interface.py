@@ -5,13 +5,18 @@ import queue
 
 import miniboa
 
+#most characters of output that can wait for the client, and how long it can go
+#without reading any of it, before it's disconnected (so a stuck client can't use up memory)
+MAX_OUTPUT = 1024 * 1024
+WRITE_TIMEOUT = 60
+
 #Client connected via telnet
 _admin_client = None
 
 #connect and disconnect handlers
 def on_connect(client):
     global _admin_client
-    logging.info("Client connected from {}".format(client.addrport()))
+    logging.info("Client connected from %s", client.addrport())
     _admin_client = client
     _admin_client.send("Welcome to the CrossChatLink admin interface!"
                          "\n\nType 'help' for a list of commands\n\n")
@@ -25,14 +30,20 @@ class Admin (threading.Thread):
     Provides an admin interface via a telnet server
     """
 
-    def __init__(self, program):
+    def __init__(self, program, server_socket = None):
         super(Admin, self).__init__()
         self._program = program
         self._server = miniboa.TelnetServer(23, "127.0.0.1", on_connect,
-                                                 on_disconnect, 1, 0.3)
+                                                 on_disconnect, 1, 0.3, server_socket,
+                                                 MAX_OUTPUT, WRITE_TIMEOUT, self._on_slow_client)
         self._stop_req = threading.Event()
         self.msg_queue = queue.Queue()
         
+    def _on_slow_client(self, client, reason):
+        """Called when the client is disconnected for not reading its output"""
+        self._program.metrics.counter("ccl_admin_slow_disconnects_total", "Admin clients disconnected for not reading their output",
+                                      reason=reason).inc()
+
     def _process_commands(self):
         """Recieves a line from the client and proccesses it (assumes valid client)"""
         if _admin_client.active and _admin_client.cmd_ready:
@@ -64,6 +75,10 @@ class Admin (threading.Thread):
             pass
         return False
 
+    def server_socket(self):
+        """The listening socket of the telnet server"""
+        return self._server.server_socket
+
     def run(self):
         """Starts the telnet server"""
         logging.info ("Starting telnet server")
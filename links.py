@@ -1,25 +1,70 @@
 
 import threading
 import socket
+import select
+import re
 import queue
 import logging
+import time
 
 import utils
+import metrics
+import flood
+import message
+
+#an IRC channel (# network wide or & local to the server) and its key, in the channels setting
+_IRC_CHANNEL = re.compile(r"([#&][^\s,]+)(?:[ \t]+([^\s,#&][^\s,]*))?")
+
+def _recv_lines(sock, buffer, delim, timeout):
+    """
+    Waits up to timeout seconds for data from a socket. Returns (the complete lines received,
+    including the delimiter, the rest of the data). Raises socket.error if the connection closed
+    """
+    if not select.select([sock], [], [], timeout)[0]:
+        return [], buffer
+    data = sock.recv(4096)
+    if not data:
+        raise socket.error("Connection closed by the server")
+    lines = (buffer + data).split(delim)
+    return [x + delim for x in lines[:-1]], lines[-1]
 
 class Link(threading.Thread):
     """Holds properties and methods common to DC and IRC links"""
 
-    #For accessing the correct queues
+    #For accessing the correct queues (output lanes)
     MAIN = 0
     PM = 1
+    RESPONSE = 2 #responses to commands
+    CONTROL = 3 #raw protocol lines (keepalives etc.)
+    LANES = ["main", "pm", "response", "control"]
+    #share of the connection each lane gets while they're all backlogged (control lines always go first)
+    LANE_WEIGHTS = [1, 2, 4]
+
+    #longest line (bytes) digest mode makes by merging messages, and what goes between them
+    DIGEST_LEN = 1024
+    DIGEST_SEP = " | "
 
     #Connection states
     DISCONNECTED = 0
     CONNECTING = 1
     CONNECTED = 2
+
+    #Port to use if the server doesn't specify one
+    DEFAULT_PORT = None
+
+    #seconds to wait for the server to take the connection
+    CONNECT_TIMEOUT = 30
+    #seconds without sending anything before a keepalive is sent
+    KEEPALIVE = 120
+
+    #formatting used in messages ("dc" or "irc"), messages are converted between them (see _transcode)
+    DIALECT = None
+
+    #flood control model of the servers, for adaptive pacing (see flood.Pacer)
+    PACING = {"penalty": 1.0, "burst": 5.0, "min_penalty": 0.25, "max_penalty": 30.0, "step": 0.05}
     
 
-    def __init__(self, program, server, nick, passwd, prefix, links, auto_connect, auto_reconnect, mc_rate, pm_rate, op_control, users):
+    def __init__(self, program, server, nick, passwd, prefix, links, auto_connect, auto_reconnect, mc_rate, pm_rate, op_control, users, pacing = "fixed", filter_policy = "", digest = 0, transitive = False, ignore_links = ""):
         super(Link, self).__init__()
 
         if type(self) == Link:
@@ -27,22 +72,69 @@ class Link(threading.Thread):
 
         #linkback to main
         self._program = program
+        #name of the connection (set by the program)
+        self.name = None
         
         #settings
         self.server = server
         self.nick = nick
         self.passwd = passwd
         self.prefix = prefix
-        self._links = links
+        #names of the links to broadcast to, replaced (not changed in place) when they change
+        self._links = list(links)
+        #snapshot of the broadcast targets: (link objects, names of links in other shards).
+        #Broadcasts read it without locking, the writers publish a new one (see update_routes)
+        self._routes = ((), ())
+        self._links_lock = threading.Lock()
         self.auto_connect = auto_connect
         self.auto_reconnect = auto_reconnect
         self.mc_rate = mc_rate
         self.pm_rate = pm_rate
+        #"fixed" uses mc_rate/pm_rate, "adaptive" learns the server's flood limit
+        self.pacing = pacing
+        #name of the filter policy applied to messages relayed to the link ("" for none)
+        self.filter_policy = filter_policy
+        #seconds a chat message can wait in the queue before messages from the same source are merged (0 = never)
+        self.digest = digest
+        #relay to every link reachable through the links (not just the direct ones), see routing.RouteTable
+        self.transitive = transitive
+        #names of the links (comma separated) whose messages aren't relayed to this one when they relay transitively
+        self.ignore_links = ignore_links
         self.op_control = op_control
         self._connection_state = self.DISCONNECTED
+        self._connected = threading.Event()
+        self._reconnect_req = threading.Event()
+        self._stop_req = threading.Event()
+        #resolved socket address of the server
+        self.address = None
+        #socket connected to the server (None when disconnected)
+        self._sock = None
+        #set when the connection has been handed over to another process
+        self._detached = False
         self.static_users = utils.UserData(users)
         self._dynamic_users = utils.UserData()
-        self._queues = [queue.Queue(), queue.Queue()]
+        self._queues = [queue.Queue() for x in self.LANES]
+        #earliest time the next message can be sent in main/pm (see mc_rate/pm_rate, responses go at the pm rate)
+        self._next_post = [0, 0]
+        self._stalled = [False for x in self.LANES]
+        #weighted fair queuing: virtual time, the virtual finish time of the last message sent from each lane
+        #and of the message waiting at the front of each lane (None until the lane is looked at)
+        self._vtime = 0.0
+        self._finish = [0.0 for x in self.LANES]
+        self._tags = [None for x in self.LANES]
+        #digest mode: whether messages are being merged, and the message taken off the main queue that didn't fit
+        self._digesting = False
+        self._carry = None
+        self._pacer = flood.Pacer(**self.PACING)
+        self.metrics = metrics.LinkMetrics()
+        #time the line being parsed was received
+        self._last_recv = None
+        #source link name : [fan-out, queued, total] latency histograms of messages relayed to this link
+        self._latency = dict()
+        #recent messages from this link (replayed to links that missed them)
+        self.backlog = utils.Backlog()
+        #when the connection was lost (None if it hasn't been)
+        self._disconnected_at = None
         #self._timers = [utils.RepeatingTimer(), utils.RepeatingTimer()]
 
     def _get_con_state(self):
@@ -56,9 +148,73 @@ class Link(threading.Thread):
         else:
             return "???"
         
+    def _set_state(self, state):
+        """Changes the connection state, waking anything waiting for the link to connect"""
+        old_state = self._connection_state
+        self._connection_state = state
+        if state == self.CONNECTED:
+            self._connected.set()
+            self._program.connect_result(self, True)
+            self._program.reconnects.connected(self)
+            #catch up on what was missed while disconnected
+            if self._disconnected_at != None:
+                self._program.post(self._program.replay_backlog, self.name, None, self._disconnected_at)
+                self._disconnected_at = None
+        else:
+            self._connected.clear()
+            if old_state == self.CONNECTED and state == self.DISCONNECTED:
+                self._disconnected_at = time.monotonic()
+                #don't flood the chat with everything that piled up, the backlog is replayed instead
+                self._clear_queue(self.MAIN)
+                #protocol lines were for the old connection
+                self._clear_queue(self.CONTROL)
+
+    def _connection_lost(self, retry = True):
+        """
+        Called by the protocol code when the connection drops or couldn't be made.
+        retry is False if the retries are scheduled for the connection rather than the link (IRC sessions)
+        """
+        self._sock = None
+        self._set_state(self.DISCONNECTED)
+        self._program.connect_result(self, False)
+        if retry and self.auto_reconnect and not self._detached:
+            self._program.reconnects.connection_lost(self)
+
+    def reconnect_key(self):
+        """Returns what the reconnect scheduler retries to reconnect the link"""
+        return self
+
+    def _missed(self, trace):
+        """
+        Checks if a relayed message (trace isn't None) arrived while disconnected.
+        These aren't queued, the backlog is replayed on reconnect instead
+        """
+        if trace != None and self._disconnected_at != None:
+            self.metrics.drops.inc()
+            return True
+        return False
+
+    def _clear_queue(self, num):
+        """Drops everything in a lane"""
+        self._tags[num] = None
+        if num == self.MAIN and self._carry != None:
+            self._carry = None
+            self.metrics.drops.inc()
+        try:
+            while True:
+                self._queues[num].get_nowait()
+                self.metrics.drops.inc()
+        except queue.Empty:
+            pass
+
+    def wait_connected(self, timeout=None):
+        """Blocks until the link is connected. Returns False if the timeout expired first"""
+        return self._connected.wait(timeout)
+
     def _set_links(self, myID, links):
         """Set the links (property method)"""
-        self._links = []
+        with self._links_lock:
+            self._links = []
         self.add_links(myID, links)
 
     def _get_links(self):
@@ -69,7 +225,9 @@ class Link(threading.Thread):
         """Stops the connection from broadcasting to the specified link(s)"""
         if not isinstance(links, list):
             raise TypeError("Links specified must be in a list")
-        self._links[:] = [t for t in self._links if t not in links]
+        with self._links_lock:
+            self._links = [t for t in self._links if t not in links]
+            self._publish_routes()
             
     def add_links(self, myID, links):
         """
@@ -78,12 +236,41 @@ class Link(threading.Thread):
         """
         if not isinstance(links, list):
             raise TypeError("Links specified must be in a list")
-        for x in links:
-            #not already added and valid link
-            if x != myID and x not in self._links and (x in self._program.connections):
-                self._links.append(x)
-            else:
-                logger.warning("Link {} not added (already added or invalid)".format(x))
+        with self._links_lock:
+            new = list(self._links)
+            for x in links:
+                #not already added and valid link
+                if x != myID and x not in new and self._program.known_link(x):
+                    new.append(x)
+                else:
+                    logging.warning("Link %s not added (already added or invalid)", x)
+            self._links = new
+            self._publish_routes()
+
+    def update_routes(self):
+        """Publishes a new snapshot of the broadcast targets (called when the connections change)"""
+        with self._links_lock:
+            self._publish_routes()
+
+    def _publish_routes(self):
+        """Looks up the link objects to broadcast to, links that no longer exist are deleted (hold _links_lock)"""
+        connections = self._program.connections
+        remote = self._program.router.remote if self._program.router != None else ()
+        missing = [x for x in self._links if x not in connections and x not in remote]
+        for x in missing:
+            logging.error("Link %s doesn't exist (deleting it)", x)
+        if missing:
+            self._links = [x for x in self._links if x not in missing]
+        targets = self._links
+        if self.transitive:
+            targets = [x for x in self._program.routes.delivery_set(self.name) if x in connections or x in remote]
+        self._routes = (tuple(connections[x] for x in targets if x in connections),
+                        tuple(x for x in targets if x not in connections))
+
+    def _get_targets(self):
+        """Returns the names of the links messages are relayed to (the links, or with transitive, all the reachable ones)"""
+        local, remote = self._routes
+        return [x.name for x in local] + list(remote)
 
     def user_perm (self, nick, perm):
         """Check permissions on the user"""
@@ -93,70 +280,391 @@ class Link(threading.Thread):
                                        (perm != UserData.CTRL or self.op_control) and
                                        self._dynamic_users.attr(nick, perm) == UserData.YES)
 
-    def _broadcast_message(self, nick, text, fmt):
+    def _broadcast_message(self, nick, text = None, fmt = None):
         """
-        Broadcasts a message to other links.
-        Format string should have {0} and {1} in it for nick and message respectively
+        Broadcasts a message to other links, either a message.Message (in place of the nick) or
+        the nick and text with a format string that has {0} and {1} in it for them respectively
         """
+        msg = None
+        if isinstance(nick, message.Message):
+            msg = nick
+            nick, text = msg.nick, msg.text
         
-        #Apply formatting and unescape text
-        #(recieving link will escape it according to connection type)
-        msg = self._unescape(fmt.format(nick, text))
+        #don't relay our own posts (hubs echo them back), they would loop around the links
+        if nick in self._own_ids() or self._program.echoes.check(self.name, self._unescape(text) if msg == None else text):
+            self.metrics.echoes.inc()
+            return
 
-        #to store invalid links
-        del_links = []
+        if msg == None:
+            #Apply formatting and unescape text
+            #(recieving links escape and encode it according to connection type, once per type)
+            msg = message.Message(self.name, nick, self._unescape(fmt.format(nick, text)), self._last_recv, dialect = self.DIALECT)
+        self.metrics.messages_in.inc()
+        msg = self._program.plugins.filter(msg)
+        if msg == None:
+            return
+        self._program.history.add(self.name, msg.text, msg.timestamp)
+        self.backlog.add(msg.replay())
 
-        #send message to all links
-        for target in self._links:
-            if (target in self._program.connections):
-                self._program.connections[target].send_chat(msg)
-            else:
-                del_links.append(target)
-                logger.error("Tried to send message to a link that doesn't exist (deleting it)")
+        #send message to all links (in this shard and others), each filter policy is only run once
+        local, remote = self._routes
+        decisions = dict()
+        for target in local:
+            target.deliver(msg, decisions)
+        if remote:
+            self._program.router.forward(remote, msg)
+        self._program.plugins.message(msg)
+
+    def deliver(self, msg, decisions = None):
+        """
+        Sends a message.Message relayed from another link to the mainchat, after the link's filter.
+        decisions holds the filter results for the message, shared by the links it's sent to
+        """
+        if self.filter_policy:
+            msg = self._program.filters.apply(self.filter_policy, msg, decisions if decisions != None else dict())
+            if msg == None:
+                self.metrics.filtered.inc()
+                return
+        self._program.echoes.add(self.name, self._transcoded(msg))
+        self.send_chat(msg)
 
-        #delete invalid links
-        for x in del_links:
-            del self._links[x]
+    def _encode_text(self, text):
+        """Escapes and encodes the text of a message"""
+        return self._escape(text).encode(self._encoding, "replace")
+
+    def _encoded(self, msg):
+        """
+        Returns the escaped, encoded text of msg (a message.Message or str).
+        Messages keep it for the other links of the same type and encoding
+        """
+        if isinstance(msg, message.Message):
+            return msg.encoded((type(self), self._encoding), self._encode_message)
+        return self._encode_text(msg)
+
+    def _encode_message(self, msg):
+        return self._encode_text(self._transcoded(msg))
+
+    def _transcoded(self, msg):
+        """Returns the text of a message.Message with its formatting converted for the link (once per message and dialect)"""
+        if msg.dialect == None or msg.dialect == self.DIALECT:
+            return msg.text
+        return msg.encoded(("text", self.DIALECT), self._transcode)
+
+    def _transcode(self, msg):
+        """Returns the text of a message.Message (from another dialect) with its formatting converted for the link"""
+        return msg.text
+
+    def _own_ids(self):
+        """Returns the names the bot goes by on the server (its own messages come from these)"""
+        return (self.nick,)
+
+    def _recv_line(self, line):
+        """Called with each line (bytes) received from the server, decodes it and hands it to the parser"""
+        self.metrics.bytes_in.inc(len(line))
+        self._last_recv = time.monotonic()
+        line = line.decode(self._encoding, "replace")
+        reason = self._flood_signal(line)
+        if reason != None:
+            self.flood_warning(reason)
+        self._parse_line(line)
+        self._last_recv = None
+
+    def _record_latency(self, trace, sent):
+        """Records the latencies of a relayed message once it has been written to the socket"""
+        source, received, queued = trace
+        hists = self._latency.get(source)
+        if hists == None:
+            hists = [metrics.LatencyHistogram() for x in range(3)]
+            self._latency[source] = hists
+        hists[0].record(queued - received)
+        hists[1].record(sent - queued)
+        hists[2].record(sent - received)
+
+    def latency(self, source):
+        """
+        Returns the [fan-out, queued, total] latency histograms for messages relayed from source
+        (None if nothing has been relayed yet)
+        """
+        return self._latency.get(source)
+
+    def _waiting(self, num):
+        """Checks if there's anything to send in a lane"""
+        return self._queues[num].qsize() > 0 or (num == self.MAIN and self._carry != None)
+
+    def queue_depth_func(self, num):
+        """Returns a function that gives the number of messages waiting in a lane"""
+        return self._queues[num].qsize
+
+    def reconnect(self):
+        """Asks the link to drop its connection and connect again (picks up changed settings)"""
+        logging.debug("Reconnect requested")
+        self._reconnect_req.set()
+
+    def send_control(self, line):
+        """Queues a raw protocol line (bytes), sent ahead of everything else"""
+        self._queues[self.CONTROL].put_nowait((line, None))
+
+    def _process_queues(self):
+        """
+        Sends the next message from the lanes. Control lines go first, the other lanes share the
+        connection by weight (weighted fair queuing), skipping lanes held back by the post rate.
+        Returns True if a message was sent
+        """
+        if self._sock == None:
+            return False
+        if self._process_queue(self.CONTROL):
+            return True
+
+        #the lane whose next message finishes first (in virtual time) goes next, ties go to the higher priority.
+        #Lanes that were empty start from the current virtual time, so they can't save up a share
+        for num in [self.RESPONSE, self.PM, self.MAIN]:
+            if self._tags[num] == None and self._waiting(num):
+                self._tags[num] = max(self._vtime, self._finish[num]) + 1.0 / self.LANE_WEIGHTS[num]
+        for finish, num in sorted((x, -i) for i, x in enumerate(self._tags) if x != None):
+            num = -num
+            if self._process_queue(num):
+                self._vtime = max(self._vtime, finish - 1.0 / self.LANE_WEIGHTS[num])
+                self._finish[num] = finish
+                self._tags[num] = None
+                return True
+        return False
 
     def _process_queue(self, num):
         """
-        Sends a message in the chat/pm queue to the link.
-        Messages are assumed to be fully formatted, escaped and converted to bytes
+        Sends a message in a lane to the link.
+        Messages are assumed to be fully formatted, escaped and converted to bytes,
+        and queued with their trace (see _broadcast_message) or None.
+        Returns True if a message was sent
         """
         
-        #TODO: time check when called/call from timer
-        if not num in [self.MAIN, self.PM]:
+        if not num in range(len(self.LANES)):
             raise ValueError("Invalid queue number")
         
-        if self._queues[num].qsize() == 0:
+        if not self._waiting(num) or self._sock == None:
             return False
-        try:
-            line = self._queues[num].get_nowait()   
-        except queue.Empty as e:
+
+        #hold the message back until the post rate allows it (protocol lines can't wait)
+        now = time.monotonic()
+        #responses go at the pm rate
+        rate = self.MAIN if num == self.MAIN else self.PM
+        if num == self.CONTROL:
+            held = False
+        elif self.pacing == "adaptive":
+            held = self.pacer.delay(now) > 0
+        else:
+            held = now < self._next_post[rate]
+        if held:
+            if not self._stalled[num]:
+                self._stalled[num] = True
+                self.metrics.stalls.inc()
             return False
+        self._stalled[num] = False
+
+        if num == self.MAIN and self._carry != None:
+            (line, trace), self._carry = self._carry, None
+        else:
+            try:
+                line, trace = self._queues[num].get_nowait()
+            except queue.Empty as e:
+                return False
+        traces = [trace]
+        if num == self.MAIN and self.digest > 0:
+            line, traces = self._digest(line, trace, now)
 
         if not isinstance(line, bytes):
             raise ValueError("Queued messages must have already been encoded to bytes")
 
-        #TODO: send bytes to socket
+        try:
+            self._sock.sendall(line)
+        except socket.error as e:
+            logging.error("Couldn't send message to %s: %s", self.name, e)
+            self.metrics.drops.inc(len(traces))
+            return False
+
+        self.metrics.messages_out.inc()
+        self.metrics.bytes_out.inc(len(line))
+        if self.pacing == "adaptive":
+            self.pacer.sent(now)
+        elif num != self.CONTROL:
+            self._next_post[rate] = now + (self.mc_rate if num == self.MAIN else self.pm_rate)
+        if len(traces) > 1:
+            #the hub echoes the merged line back, not the messages in it
+            self._program.echoes.add(self.name, self._unescape(self._split_line(line)[1].decode(self._encoding, "replace")))
+        now = time.monotonic()
+        for trace in traces:
+            if trace != None:
+                self._record_latency(trace, now)
+        return True
+
+    def _digest(self, line, trace, now):
+        """
+        Digest mode (entered once a message has waited longer than the digest setting, left once the
+        main queue is empty): merges the messages from the same source that follow the line into it,
+        up to the line limit. Returns the line and the traces of the messages in it
+        """
+        traces = [trace]
+        if trace == None:
+            return line, traces
+        if not self._digesting:
+            if now - trace[2] < self.digest:
+                return line, traces
+            self._digesting = True
+            logging.info("Messages to %s are %.1fs behind, merging them", self.name, now - trace[2])
+
+        parts = self._split_line(line)
+        if parts != None:
+            head, body, tail = parts
+            bodies = [body]
+            sep = self._escape(self.DIGEST_SEP).encode(self._encoding)
+            size = len(line)
+            limit = self._line_limit()
+            while True:
+                try:
+                    item = self._queues[self.MAIN].get_nowait()
+                except queue.Empty:
+                    break
+                parts = self._split_line(item[0]) if item[1] != None and item[1][0] == trace[0] else None
+                if parts == None or parts[0] != head or parts[2] != tail or size + len(sep) + len(parts[1]) > limit:
+                    #sent next
+                    self._carry = item
+                    break
+                bodies.append(parts[1])
+                traces.append(item[1])
+                size += len(sep) + len(parts[1])
+            if len(bodies) > 1:
+                self.metrics.digested.inc(len(bodies))
+                line = head + sep.join(bodies) + tail
+
+        if self._carry == None and self._queues[self.MAIN].qsize() == 0:
+            self._digesting = False
+            logging.info("Messages to %s have caught up", self.name)
+        return line, traces
+
+    def _split_line(self, line):
+        """Splits a queued chat line into its (head, text, tail) so lines can be merged (None if it can't be)"""
+        return None
+
+    def _line_limit(self):
+        """Returns the longest line (bytes) digest mode can make"""
+        return self.DIGEST_LEN
+
+    def _get_pacer(self):
+        """Get the pacer of the connection, used by adaptive pacing (property method)"""
+        return self._pacer
+
+    def _get_digesting(self):
+        """Get whether queued messages are being merged (digest mode, property method)"""
+        return self._digesting
+
+    def _flood_signal(self, line):
+        """Checks if a line from the server is a flood warning/kick, returns the reason or None"""
+        return None
+
+    def flood_warning(self, reason):
+        """Called when the server warns about (or kicks/disconnects us for) flooding"""
+        self.metrics.floods.inc()
+        if self.pacing == "adaptive":
+            self.pacer.flood(reason)
+
+    def _session_state(self):
+        """Returns a dict of protocol specific session state (for handing the connection over)"""
+        return dict()
+
+    def _restore_session(self, state):
+        """Restores the protocol specific session state returned by _session_state"""
+        pass
+
+    def export_state(self, socks):
+        """
+        Returns the runtime state of the link so another process can take over the connection.
+        Pending messages are removed from the queues. The link's socket is appended to socks
+        and referred to by its index
+        """
+        pending = []
+        for q in self._queues:
+            #traces use this process's clock, so they don't go along with the messages
+            items = []
+            if q == self._queues[self.MAIN] and self._carry != None:
+                items.append(self._carry[0])
+                self._carry = None
+            try:
+                while True:
+                    items.append(q.get_nowait()[0])
+            except queue.Empty:
+                pass
+            pending.append(items)
+
+        state = {"type": type(self).__name__, "server": self.server, "nick": self.nick,
+                 "connection_state": self._connection_state,
+                 "dynamic_users": self._dynamic_users.as_list(),
+                 "queues": pending,
+                 "session": self._session_state(),
+                 "sock": None}
+        if self._sock != None:
+            #links that share a connection (IRC sessions) hand it over once
+            same = [i for i, x in enumerate(socks) if x is self._sock]
+            state["sock"] = same[0] if same else len(socks)
+            if not same:
+                socks.append(self._sock)
+        return state
+
+    def import_state(self, state, socks):
+        """
+        Takes over a connection from the state exported by another process.
+        Returns False if the state doesn't belong to a link with the same type and server/nick
+        """
+        if state["type"] != type(self).__name__ or state["server"] != self.server or state["nick"] != self.nick:
+            return False
+
+        self._dynamic_users = utils.UserData(state["dynamic_users"])
+        for num, (q, items) in enumerate(zip(self._queues, state["queues"])):
+            #protocol lines only make sense on the connection they were meant for
+            if num == self.CONTROL and state["sock"] == None:
+                continue
+            for x in items:
+                q.put_nowait((x, None))
+        self._restore_session(state["session"])
+        if state["sock"] != None:
+            self._sock = socks[state["sock"]]
+            self._set_state(state["connection_state"])
+        return True
+
+    def _reconcile_users(self, nicks):
+        """
+        Called with the full user list once it has been received from the server.
+        Drops state restored from a snapshot for users that are no longer online
+        """
+        self._dynamic_users.retain(nicks)
+
+    def detach(self):
+        """Stops the link without closing the connection (it has been handed over to another process)"""
+        self._detached = True
+        self._sock = None
 
     def join(self, timeout=None):
-        """Override join to close all connections and wait until the thread terminates"""
-        #TODO: disconnecting and closing connections
-        super(Link, self).join(timeout)
+        """Override join to close the connection (unless detached) and wait until the thread terminates"""
+        self._stop_req.set()
+        if self.is_alive():
+            super(Link, self).join(timeout)
 
     #set property
     links = property(_get_links, _set_links)
+    targets = property(_get_targets)
     connection_state = property(_get_con_state)
+    pacer = property(_get_pacer)
+    digesting = property(_get_digesting)
 
 ##################################################################################################
 class DC (Link):
     """Superclass for all DC hub connections"""
 
+    DIALECT = "dc"
+
     def __init__(self, program, server, nick, passwd, prefix, links, share, slots, client, auto_connect, auto_reconnect,
-                 mc_rate, pm_rate, op_control, users):
+                 mc_rate, pm_rate, op_control, users, pacing, filter_policy, digest, transitive, ignore_links):
 
-        super(DC, self).__init__(program, server, nick, passwd, prefix, links, auto_connect, auto_reconnect, mc_rate, pm_rate, op_control, users)
+        super(DC, self).__init__(program, server, nick, passwd, prefix, links, auto_connect, auto_reconnect, mc_rate, pm_rate, op_control, users,
+                                 pacing, filter_policy, digest, transitive, ignore_links)
 
         if type(self) == DC:
             raise Exception("DC must be subclassed")
@@ -164,39 +672,146 @@ class DC (Link):
         self.share = share
         self.slots = slots
         self.client = client
+        #(nick, encoded text before the message, encoded text after it) in mainchat
+        self._mc_frame = None
+
+    def send_chat(self, text, trace = None):
+        """
+        Sends a message (a message.Message or str) to the mainchat queue
+        trace is the (source link, received, queued) times of relayed messages (Messages have their own)
+        """
+        if trace == None and isinstance(text, message.Message):
+            trace = text.trace()
+        if self._missed(trace):
+            return
+
+        if self._mc_frame == None or self._mc_frame[0] != self.nick:
+            head, tail = self._mc_format.split("{1}")
+            self._mc_frame = (self.nick, head.format(self.nick).encode(self._encoding, "replace"), tail.encode(self._encoding))
 
-    def send_chat(self, text):
-        """Sends a message to the mainchat queue"""
-        #escape and format the message
-        text = self._escape(text)
-        msg = self._mc_format.format(self.nick, text)
+        #the line is built once per link type, encoding and framing, links that frame it the same queue the same bytes
+        if isinstance(text, message.Message):
+            line = text.encoded(("line", type(self), self._encoding, self._mc_frame[1]), self._frame_chat)
+        else:
+            line = self._frame_chat(text)
+
+        #add to queue
+        self._queues[self.MAIN].put_nowait((line, trace))
 
-        #encode and add to queue
-        self.queues[self.MAIN].put_nowait(msg.encode(self._encoding, "replace"))
+    def _frame_chat(self, text):
+        """Returns the mainchat line (bytes) for a message.Message or str"""
+        return b"".join([self._mc_frame[1], self._encoded(text), self._mc_frame[2]])
     
-    def send_PM (self, text, user):
+    def send_PM (self, text, user, reply = False):
         """
-        Sends a private message to the PM queue
+        Sends a private message (a message.Message or str) to the PM queue,
+        or the response queue if it's a reply to a command.
         For ADC links, the parameter is the SID of the user, not the nick
         """
-        #escape and format the message
-        text = self._escape(text)
-        msg = self._pm_format.format(user, self._myID(), text)
+        #format around the escaped text
+        head, tail = self._pm_format.split("{2}")
+        msg = b"".join([head.format(user, self._ID()).encode(self._encoding, "replace"), self._encoded(text),
+                        tail.format(user, self._ID()).encode(self._encoding, "replace")])
+
+        #add to queue
+        self._queues[self.RESPONSE if reply else self.PM].put_nowait((msg, None))
+
+    def _transcode(self, msg):
+        """Hubs don't understand IRC formatting codes, they're removed"""
+        return utils.strip_irc_formatting(msg.text)
+
+    def _split_line(self, line):
+        if self._mc_frame == None or not line.startswith(self._mc_frame[1]) or not line.endswith(self._mc_frame[2]):
+            return None
+        return (self._mc_frame[1], line[len(self._mc_frame[1]):len(line) - len(self._mc_frame[2])], self._mc_frame[2])
+
+    def _connect(self):
+        """Connects to the hub and starts logging in (the protocol code sets the link connected once it's in)"""
+        self._set_state(self.CONNECTING)
+        try:
+            host, port = utils.split_server(self.server, self.DEFAULT_PORT)
+            self.address = self._program.resolver.resolve(host, port, self.CONNECT_TIMEOUT)
+            sock = socket.create_connection(self.address[:2], self.CONNECT_TIMEOUT)
+        except Exception as e:
+            logging.warning("Couldn't connect %s to %s: %s", self.name, self.server, e)
+            self._connection_lost()
+            return
+        #protocol lines left from an attempt that didn't get in
+        self._clear_queue(self.CONTROL)
+        self._login()
+        self._sock = sock
 
-        #encode and add to queue
-        self.queues[self.PM].put_nowait(msg.encode(self._encoding, "replace")) 
+    def _disconnect(self):
+        """Closes the connection"""
+        sock, self._sock = self._sock, None
+        if sock != None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        self._set_state(self.DISCONNECTED)
+
+    def _login(self):
+        """Queues what the client says first when it connects (nothing, by default)"""
+        pass
+
+    def run(self):
+        """
+        Reads the lines from the hub for the parser and sends the queued messages.
+        A reconnect request drops the connection and opens a new one
+        """
+        #a connection taken over from another process is used as it is
+        if self._sock == None:
+            self._connect()
+        delim = self._delim.encode(self._encoding)
+        buffer = b""
+        last_sent = time.monotonic()
+        while not self._stop_req.is_set():
+            if self._reconnect_req.is_set():
+                self._reconnect_req.clear()
+                self.metrics.reconnects.inc()
+                self._disconnect()
+                self._connect()
+                buffer = b""
+            sock = self._sock
+            if sock == None:
+                self._stop_req.wait(0.05)
+                continue
+            sent = self._process_queues()
+            now = time.monotonic()
+            if sent:
+                last_sent = now
+            elif now - last_sent >= self.KEEPALIVE and self._connection_state == self.CONNECTED:
+                #hubs drop clients that stay quiet for too long, an empty command keeps the connection up
+                self.send_control(delim)
+                last_sent = now
+            try:
+                lines, buffer = _recv_lines(sock, buffer, delim, 0 if sent else 0.05)
+            except socket.error as e:
+                if self._sock is sock:
+                    logging.warning("Lost the connection of %s: %s", self.name, e)
+                    sock.close()
+                    self._connection_lost()
+                continue
+            for line in lines:
+                self._recv_line(line)
+        if not self._detached:
+            self._disconnect()
 
         
 ##################################################################################################
 class NMDC (DC):
     """For connecting to NMDC hubs"""
 
+    _delim = "|"
+    DEFAULT_PORT = 411
+
     def __init__(self, program, server, nick, passwd, prefix, links = [], share = "10737418240", slots = "5", client = "CrossChatLink",
-                 auto_connect = True, auto_reconnect = True, mc_rate = 0, pm_rate = 0, op_control = True, users = None):
+                 auto_connect = True, auto_reconnect = True, mc_rate = 0, pm_rate = 0, op_control = True, users = None, pacing = "fixed", filter_policy = "", digest = 0, transitive = False, ignore_links = ""):
         logging.debug("Configuring a new NMDC link")
         
         super(NMDC, self).__init__(program, server, nick, passwd, prefix, links, share, slots, client, auto_connect, auto_reconnect,
-                 mc_rate, pm_rate, op_control, users)
+                 mc_rate, pm_rate, op_control, users, pacing, filter_policy, digest, transitive, ignore_links)
 
         #formatting constants
         self._mc_format = "<{0}> {1}|" #to/msg
@@ -207,15 +822,18 @@ class NMDC (DC):
                                          5: "&#5;", # ENQ
                                          36: "&#36;", #$
                                          124: "&#124;"}) #|
+        #nicks of the ops (from $OpList) and the name of the hub, flood warnings are only taken from them
+        self._ops = set()
+        self._hub_name = None
 
-    def _ID():
+    def _ID(self):
         """The ID of the bot (ADC = SID, NMDC = nick)"""
         return self.nick
 
     def _escape(self, msg):
         """Returns an escaped version of msg"""
         #TODO: test this works (issues with spaces at least)
-        return temp.translate(self._escape_map)
+        return msg.translate(self._escape_map)
 
     def _unescape(self, msg):
         """Returns an unescaped version of msg"""
@@ -225,14 +843,55 @@ class NMDC (DC):
         msg = msg.replace("&#124;", chr(124))
         return msg
     
+    def _session_state(self):
+        """Returns a dict of protocol specific session state (for handing the connection over)"""
+        #snapshots only hold strings (nicks can't contain "$")
+        return {"ops": "$$".join(sorted(self._ops)), "hub_name": self._hub_name}
+
+    def _restore_session(self, state):
+        """Restores the protocol specific session state returned by _session_state"""
+        self._ops = set(x for x in state.get("ops", "").split("$$") if x)
+        self._hub_name = state.get("hub_name")
+
+    def _flood_signal(self, line):
+        """
+        Hubs warn/kick with $ForceMove, or a PM or a kick message from the hub or an op mentioning flooding.
+        Anyone can say "flood", so messages from other users don't count
+        """
+        lower = line.lower()
+        if "flood" not in lower:
+            return None
+        if line.startswith("$ForceMove"):
+            return line.rstrip("|")[:100]
+        pm_head = "$To: {} From: ".format(self.nick)
+        if line.startswith(pm_head):
+            sender = line[len(pm_head):].split(" ", 1)[0]
+        elif line.startswith("<") and "kick" in lower and self.nick.lower() in lower:
+            sender = line[1:].split(">", 1)[0]
+        else:
+            return None
+        if sender in self._ops or sender == self._hub_name:
+            return line.rstrip("|")[:100]
+        return None
+
     def _parse_line(self, line):
         """Parses a line recived from the server"""
-        #TODO: Implement NMDC protocol
-        pass
+        line = line.rstrip("|")
+        if line.startswith("$OpList "):
+            self._ops = set(x for x in line[len("$OpList "):].split("$$") if x)
+        elif line.startswith("$HubName "):
+            self._hub_name = line[len("$HubName "):]
+        elif line == "$Hello " + self.nick and self._connection_state != self.CONNECTED:
+            #the hub accepted our nick, we're logged in
+            self._set_state(self.CONNECTED)
+        elif line.startswith("$NickList "):
+            #the full user list, sent when we log in
+            self._reconcile_users([self._unescape(x) for x in line[len("$NickList "):].split("$$") if x])
+        #TODO: Implement the rest of the NMDC protocol
 
     def run(self):
         logging.info("NMDC thread initilized")
-        #TODO: connect, recieve, and process data
+        super(NMDC, self).run()
 
 
 ##################################################################################################
@@ -240,26 +899,52 @@ class ADC (DC):
     """For connecting to ADC hubs"""
 
     _delim = "\n"
+    DEFAULT_PORT = 412
     
     def __init__(self, program, server, nick, passwd, prefix, links = [], share = "10737418240", slots = "5", client = "CrossChatLink",
-                 auto_connect = True, auto_reconnect = True, mc_rate = 0, pm_rate = 0, op_control = True, users = None):
+                 auto_connect = True, auto_reconnect = True, mc_rate = 0, pm_rate = 0, op_control = True, users = None, pacing = "fixed", filter_policy = "", digest = 0, transitive = False, ignore_links = ""):
         logging.debug("Configuring a new ADC link")
         
         super(ADC, self).__init__(program, server, nick, passwd, prefix, links, share, slots, client, auto_connect, auto_reconnect,
-                 mc_rate, pm_rate, op_control, users)
+                 mc_rate, pm_rate, op_control, users, pacing, filter_policy, digest, transitive, ignore_links)
 
         #formatting constants
         self._mc_format = "BMSG {0} {1}\n" #to/msg
         self._pm_format = "DMSG {1} {0} {2} PM{1}\n" #to/from/msg
         self._encoding = "utf-8"
 
+        #nick : SID
         self._user_SIDs = dict()
         self._SID = None
+        #nicks in the user list while it's being received after logging in (None once it has been)
+        self._listing = None
 
-    def _ID():
+    def _ID(self):
         """The ID of the bot (ADC = SID, NMDC = nick)"""
         return self._SID
 
+    def _own_ids(self):
+        """Messages are from a SID, but allow for the nick too"""
+        return (self.nick, self._SID)
+
+    def _session_state(self):
+        """Returns a dict of protocol specific session state (for handing the connection over)"""
+        return {"SID": self._SID, "user_SIDs": dict(self._user_SIDs)}
+
+    def _restore_session(self, state):
+        """Restores the protocol specific session state returned by _session_state"""
+        self._SID = state["SID"]
+        self._user_SIDs = state["user_SIDs"]
+
+    def _reconcile_users(self, nicks):
+        """
+        Called with the full user list once it has been received from the server.
+        Drops state restored from a snapshot for users that are no longer online
+        """
+        super(ADC, self)._reconcile_users(nicks)
+        nicks = set(nicks)
+        self._user_SIDs = dict((x, self._user_SIDs[x]) for x in self._user_SIDs if x in nicks)
+
     def _escape(self, msg):
         """Returns an escaped version of msg"""
         #TODO: str.translate()?
@@ -272,24 +957,499 @@ class ADC (DC):
         """Returns an unescaped version of msg"""
         return utils.escape_replace(msg, "\\", {"\\": "\\\\", "s": " ", "n": "\n"})
         
+    def _flood_signal(self, line):
+        """Hubs warn with a STA, or disconnect with a QUI for our SID, mentioning flooding"""
+        if (line.startswith("ISTA ") or (self._SID != None and line.startswith("IQUI " + self._SID))) and "flood" in line.lower():
+            return self._unescape(line.rstrip("\n"))[:100]
+        return None
+
+    def _login(self):
+        """ADC clients start by saying which features they support"""
+        self.send_control(b"HSUP ADBASE ADTIGR\n")
+
     def _parse_line(self, line):
         """Parses a line recived from the server"""
-        #TODO: Implement ADC protocol
-        pass
+        parts = line.rstrip("\n").split(" ")
+        if parts[0] == "ISID" and len(parts) > 1:
+            self._SID = parts[1]
+            self._listing = set()
+        elif parts[0] == "BINF" and len(parts) > 1:
+            nicks = [self._unescape(x[2:]) for x in parts[2:] if x.startswith("NI")]
+            if nicks:
+                self._user_SIDs[nicks[0]] = parts[1]
+                if self._listing != None:
+                    self._listing.add(nicks[0])
+            #the hub ends the user list with our own INF
+            if parts[1] == self._SID and self._listing != None:
+                listing, self._listing = self._listing, None
+                self._reconcile_users(listing)
+                self._set_state(self.CONNECTED)
+        elif parts[0] == "IQUI" and len(parts) > 1:
+            self._user_SIDs = dict((x, y) for x, y in self._user_SIDs.items() if y != parts[1])
+        #TODO: Implement the rest of the ADC protocol
     
     def run(self):
         logging.info("ADC thread initilized")
-        #TODO: connect, recieve, and process data
+        super(ADC, self).run()
+
+##################################################################################################
+class IRCSession (threading.Thread):
+    """
+    A connection to an IRC server, shared by all the IRC links with the same server, nick and password.
+    Lines from the server are routed to the links by channel. Output from all the links goes
+    through this thread so the server's flood limits apply to the connection as a whole
+    """
+
+    #longest user and host names (RFC 2812 defaults), until the server says in ISUPPORT
+    USERLEN = 10
+    HOSTLEN = 63
+
+    #Port to use if the server doesn't specify one
+    DEFAULT_PORT = 6667
+
+    def __init__(self, program, key):
+        super(IRCSession, self).__init__()
+        self.daemon = True
+        self._program = program
+        self.key = key
+        self.server = key[0]
+        #the reconnect scheduler retries the session as a whole, not each of its links
+        self.name = "{}@{}".format(key[1], key[0])
+        self._lock = threading.Lock()
+        self._links = []
+        self._joined = set()
+        #raw protocol lines of the connection (JOIN/PART/PONG), sent before anything the links queue.
+        #Lines of a link (its connect commands) go in the link's control lane
+        self._control = queue.Queue()
+        self._sock = None
+        #whether the server has welcomed us on the connection (the links are connected)
+        self._registered = False
+        self._next_send = 0
+        self._rotation = 0
+        self._stop_req = threading.Event()
+        self._reconnect_req = threading.Event()
+        #whether to close the connection when stopped (not if it was handed over to another process)
+        self._close = True
+        #set to pause the IO on the connection while it's handed over, and by the thread once it's paused
+        self._hold = threading.Event()
+        self._held = threading.Event()
+        #received data that isn't a full line yet
+        self._buffer = b""
+        #flood control of the connection for links with adaptive pacing
+        self.pacer = flood.Pacer(**IRC.PACING)
+        self._reset_server_info()
+
+    def _reset_server_info(self):
+        """Forgets what the server told us (it can change after a reconnect)"""
+        #command : max targets (None for no limit), from ISUPPORT TARGMAX/MAXTARGETS
+        self._targmax = dict()
+        self._max_targets = 1
+        self._userlen = self.USERLEN
+        self._hostlen = self.HOSTLEN
+        #our nick!user@host (encoded) as the server sees it, if the server said
+        self._mask = None
+        self._budget = None
+
+    def server_info(self):
+        """
+        Returns what the server told us, the channels joined and the partial line received, for handing
+        the connection over (as strings, see snapshot). The session must be held (see hold)
+        """
+        with self._lock:
+            return {"targmax": dict((k, "" if v == None else str(v)) for k, v in self._targmax.items()),
+                    "max_targets": "" if self._max_targets == None else str(self._max_targets),
+                    "userlen": str(self._userlen), "hostlen": str(self._hostlen),
+                    "mask": None if self._mask == None else self._mask.decode("latin-1"),
+                    "joined": ",".join(sorted(self._joined)),
+                    "buffer": self._buffer.decode("latin-1")}
+
+    def _restore_server_info(self, info):
+        """Takes over the state returned by server_info in another process (hold _lock)"""
+        self._targmax = dict((k, int(v) if v else None) for k, v in info["targmax"].items())
+        self._max_targets = int(info["max_targets"]) if info["max_targets"] else None
+        self._userlen = int(info["userlen"])
+        self._hostlen = int(info["hostlen"])
+        self._mask = None if info["mask"] == None else info["mask"].encode("latin-1")
+        self._budget = None
+        self._joined = set(x for x in info["joined"].split(",") if x)
+        self._buffer = info["buffer"].encode("latin-1")
+
+    def max_targets(self, cmd):
+        """Returns how many targets the server takes in one cmd (None for no limit)"""
+        return self._targmax.get(cmd, self._max_targets)
+
+    def line_budget(self):
+        """
+        Returns how many bytes of a line can be used (including the \r\n), leaving room for
+        the ":nick!user@host " prefix the server adds when relaying it
+        """
+        if self._budget == None:
+            if self._mask != None:
+                overhead = len(self._mask) + 2
+            else:
+                nick = self.key[1].encode("utf-8")
+                overhead = len(nick) + self._userlen + self._hostlen + IRC.PREFIX_SEPS
+            self._budget = IRC.LINE_LEN - overhead
+        return self._budget
+
+    def _server_info(self, parts):
+        """Handles the welcome and ISUPPORT numerics (parts is the line split on spaces)"""
+        if parts[1] == b"001":
+            #the welcome usually ends with our full nick!user@host
+            mask = parts[-1].lstrip(b":")
+            self._mask = mask if b"!" in mask and b"@" in mask else None
+            self._budget = None
+        elif parts[1] == b"005":
+            for token in parts[3:]:
+                if token.startswith(b":"):
+                    break
+                name, eq, val = token.decode("utf-8", "replace").partition("=")
+                if name == "TARGMAX":
+                    for item in val.split(","):
+                        cmd, colon, num = item.partition(":")
+                        self._targmax[cmd.upper()] = int(num) if num.isdigit() else None
+                elif name == "MAXTARGETS" and val.isdigit():
+                    self._max_targets = int(val)
+                elif name in ("USERLEN", "HOSTLEN") and val.isdigit():
+                    setattr(self, "_" + name.lower(), int(val))
+                    self._budget = None
+
+    def add_link(self, link):
+        """Adds a link to the session (if it isn't in it), joining its channels"""
+        with self._lock:
+            if link not in self._links:
+                self._links.append(link)
+            #a connection taken over from another process (before the session started)
+            if self._sock == None and link._sock != None and not self.is_alive():
+                self._sock = link._sock
+                self._registered = link.wait_connected(0)
+                if link._server_info:
+                    self._restore_server_info(link._server_info)
+            registered = self._registered
+            if registered:
+                link._sock = self._sock
+        #not holding the lock, setting the state calls back into the program
+        if registered and not link.wait_connected(0):
+            link._set_state(link.CONNECTED)
+            link._send_connect_cmds()
+        #a connection taken over from another process joins the channels once all its links are in (see run)
+        if self.ident != None:
+            self.update_channels()
+
+    def remove_link(self, link):
+        """Removes a link from the session, leaving channels no other link needs. Returns the number of links left"""
+        with self._lock:
+            if link in self._links:
+                self._links.remove(link)
+            left = len(self._links)
+        link._sock = None
+        if not link._detached:
+            link._set_state(link.DISCONNECTED)
+        self.update_channels()
+        return left
+
+    def update_channels(self):
+        """Joins/parts channels so the session is in every channel its links want"""
+        with self._lock:
+            #servers ignore JOINs before the welcome, which joins the channels (see _welcomed)
+            if not self._registered:
+                return
+            wanted = dict()
+            for link in self._links:
+                wanted.update(link._channel_keys())
+            for channel in sorted(set(wanted) - self._joined):
+                self._control.put_nowait("JOIN {}{}\r\n".format(channel, " " + wanted[channel] if wanted[channel] else "").encode("utf-8"))
+            for channel in sorted(self._joined - set(wanted)):
+                self._control.put_nowait("PART {}\r\n".format(channel).encode("utf-8"))
+            self._joined = set(wanted)
+
+    def reconnect(self):
+        """Asks the session to drop the connection and connect again"""
+        self._reconnect_req.set()
+
+    def hold(self, timeout):
+        """
+        Stops the IO on the connection (leaving it open) so it can be handed over to another process.
+        Returns False if the session didn't stop in time
+        """
+        self._hold.set()
+        return not self.is_alive() or self._held.wait(timeout)
+
+    def release(self):
+        """Carries on with the IO stopped by hold (the handover failed)"""
+        self._held.clear()
+        self._hold.clear()
+
+    def _connection_lost(self, links):
+        """Tells the links the connection dropped (or couldn't be made) and schedules one retry for all of them"""
+        for link in links:
+            link._connection_lost(False)
+        if any(x.auto_reconnect and not x._detached for x in links):
+            self._program.reconnects.connection_lost(self)
+
+    def _connect(self):
+        """Connects to the server and registers (the links are connected once the server welcomes us)"""
+        self._reset_server_info()
+        with self._lock:
+            links = list(self._links)
+            #channels are joined again once registered
+            self._joined = set()
+        #protocol lines were for the old connection
+        try:
+            while True:
+                self._control.get_nowait()
+        except queue.Empty:
+            pass
+        for link in links:
+            link._set_state(link.CONNECTING)
+
+        nick, passwd = self.key[1], self.key[2]
+        ident = links[0].ident_text.split(" ")[0] if links and links[0].ident_text.strip() else "CrossChatLink"
+        lines = (["PASS " + passwd] if passwd else []) + ["NICK " + nick, "USER {0} 0 * :{0}".format(ident)]
+        try:
+            host, port = utils.split_server(self.server, self.DEFAULT_PORT)
+            address = self._program.resolver.resolve(host, port, IRC.CONNECT_TIMEOUT)
+            sock = socket.create_connection(address[:2], IRC.CONNECT_TIMEOUT)
+            sock.sendall("".join(x + "\r\n" for x in lines).encode("utf-8"))
+        except (OSError, ValueError) as e:
+            logging.warning("Couldn't connect to %s: %s", self.server, e)
+            self._connection_lost(links)
+            return
+        self._sock = sock
+
+    def _disconnect(self, lost = False):
+        """Closes the connection, lost is True if it dropped (the links retry if they're set to)"""
+        with self._lock:
+            sock, self._sock = self._sock, None
+            self._registered = False
+            links = list(self._links)
+        if sock != None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        if lost:
+            self._connection_lost(links)
+            return
+        for link in links:
+            link._sock = None
+            link._set_state(link.DISCONNECTED)
+
+    def _welcomed(self):
+        """Called when the server accepts the registration, connects the links and joins their channels"""
+        with self._lock:
+            self._registered = True
+            links = list(self._links)
+        self._program.reconnects.connected(self)
+        for link in links:
+            link._sock = self._sock
+            link._set_state(link.CONNECTED)
+            link._send_connect_cmds()
+        self.update_channels()
+
+    def _flood_signal(self, parts):
+        """
+        Checks if a line (split on spaces) is a flood warning: an excess flood ERROR, RPL_TRYAGAIN,
+        a server notice or a kick of our nick mentioning flooding. Returns the reason or None
+        """
+        if parts[0] == b"ERROR":
+            return parts[-1].lstrip(b":").decode("utf-8", "replace") if b"flood" in parts[-1].lower() else None
+        if len(parts) < 3:
+            return None
+        if parts[1] == b"263":
+            return "server load too heavy"
+        text = parts[-1].lower()
+        if b"flood" not in text:
+            return None
+        if parts[1] == b"NOTICE" and b"!" not in parts[0]:
+            return parts[-1].decode("utf-8", "replace")
+        if parts[1] == b"KICK" and parts[2].split(b" ")[1:2] == [self.key[1].encode("utf-8")]:
+            return parts[-1].decode("utf-8", "replace")
+        return None
+
+    def _route(self, line):
+        """Hands a line (bytes) received from the server to the links it's for"""
+        if line.startswith(b"PING "):
+            self._control.put_nowait(b"PONG " + line[5:])
+            return
+
+        #everything after the command, with the trailing parameter split off
+        parts = line.split(b" ", 2) if line.startswith(b":") else line.split(b" ", 1)
+        if len(parts) > 1:
+            parts = parts[:-1] + parts[-1].split(b" :", 1)
+        reason = self._flood_signal(parts)
+        if reason != None:
+            with self._lock:
+                links = list(self._links)
+            for link in links:
+                link.metrics.floods.inc()
+            if any(x.pacing == "adaptive" for x in links):
+                self.pacer.flood(reason)
+
+        parts = line.split(b" ", 3)
+        if len(parts) > 2 and parts[1] in (b"001", b"005"):
+            self._server_info(line.split(b" "))
+            if parts[1] == b"001":
+                self._welcomed()
+
+        #lines about a channel (the target, or a later parameter in replies like NAMES) go to the links in the channel,
+        #lines to a nick go to the links with that nick, and the rest (or lines to a nick no link has) to every link
+        params = line.rstrip(b"\r\n").split(b" :", 1)[0].split(b" ")[2 if line.startswith(b":") else 1:]
+        with self._lock:
+            encoding = self._links[0]._encoding if self._links else "utf-8"
+            channels = [x for x in params if x[:1] in (b"#", b"&")]
+            if channels:
+                channel = channels[0].decode(encoding, "replace").lower()
+                targets = [x for x in self._links if channel in x._channel_keys()]
+            else:
+                nick = params[0].decode(encoding, "replace").lower() if params else None
+                targets = [x for x in self._links if x.nick.lower() == nick] or list(self._links)
+        for link in targets:
+            link._recv_line(line)
+
+    def _send_next(self):
+        """Sends the next line, taking turns between the links. Returns False if nothing was sent"""
+        if self._sock == None:
+            return False
+        try:
+            line = self._control.get_nowait()
+            self._sock.sendall(line)
+            return True
+        except queue.Empty:
+            pass
+        except socket.error as e:
+            logging.error("Couldn't send to %s: %s", self.server, e)
+            return False
+
+        now = time.monotonic()
+        if now < self._next_send:
+            return False
+        with self._lock:
+            links = list(self._links)
+        for i in range(len(links)):
+            link = links[(self._rotation + i) % len(links)]
+            if link._process_queues():
+                self._rotation = (self._rotation + i + 1) % len(links)
+                #the server's flood limit applies to the whole connection (adaptive links share the session's pacer)
+                self._next_send = now + max([0] + [max(x.mc_rate, x.pm_rate) for x in links if x.pacing == "fixed"])
+                return True
+        return False
+
+    def stop(self, close = True):
+        """Stops the session, closing the connection unless close is False"""
+        self._close = close
+        self._stop_req.set()
+        self._program.reconnects.cancel(self)
+
+    def run(self):
+        logging.info("IRC session to %s initilized", self.server)
+        if self._sock == None:
+            self._connect()
+        else:
+            self.update_channels()
+        while not self._stop_req.is_set():
+            if self._hold.is_set():
+                self._held.set()
+                self._stop_req.wait(0.05)
+                continue
+            if self._reconnect_req.is_set():
+                self._reconnect_req.clear()
+                with self._lock:
+                    links = list(self._links)
+                for link in links:
+                    link.metrics.reconnects.inc()
+                self._disconnect()
+                self._connect()
+                self._buffer = b""
+            sock = self._sock
+            if sock == None:
+                self._stop_req.wait(0.05)
+                continue
+            try:
+                lines, self._buffer = _recv_lines(sock, self._buffer, b"\n", 0 if self._send_next() else 0.05)
+            except socket.error as e:
+                logging.warning("Lost the connection to %s: %s", self.server, e)
+                self._disconnect(True)
+                continue
+            for line in lines:
+                self._route(line)
+        if self._close:
+            self._disconnect()
+
+
+class IRCPool():
+    """Shares IRC sessions between links with the same server, nick and password"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #(server, nick, password) : IRCSession
+        self._sessions = dict()
+
+    def attach(self, link, start = True):
+        """
+        Adds a link to the session for its server/nick/password (creating one if needed), returns the session.
+        The session is started unless start is False
+        """
+        key = link._session_key()
+        with self._lock:
+            session = self._sessions.get(key)
+            if session == None:
+                session = IRCSession(link._program, key)
+                self._sessions[key] = session
+            session.add_link(link)
+            if start and session.ident == None:
+                session.start()
+        return session
+
+    def detach(self, link, session):
+        """Removes a link from a session, stopping the session if it was the last link"""
+        with self._lock:
+            if session.remove_link(link) == 0:
+                session.stop(not link._detached)
+                if self._sessions.get(session.key) == session:
+                    del self._sessions[session.key]
+
+    def sessions(self):
+        """Returns a list of the active sessions"""
+        with self._lock:
+            return list(self._sessions.values())
+
+    def hold(self, timeout):
+        """Stops the IO of all the sessions so their connections can be handed over, returns False if one didn't stop in time"""
+        end = time.monotonic() + timeout
+        return all([x.hold(max(end - time.monotonic(), 0)) for x in self.sessions()])
+
+    def release(self):
+        """Carries on with the IO of the sessions (the handover failed)"""
+        for session in self.sessions():
+            session.release()
 
 ##################################################################################################
 class IRC (Link):
 
+    DEFAULT_PORT = IRCSession.DEFAULT_PORT
+    DIALECT = "irc"
+
+    #max length of a line (including the \r\n)
+    LINE_LEN = 512
+    #the ':', '!', '@' and ' ' of the ":nick!user@host " prefix the server adds to relayed lines
+    PREFIX_SEPS = 4
+    #room the prefix takes beyond the nick, before the session knows better
+    PREFIX_LEN = IRCSession.USERLEN + IRCSession.HOSTLEN + PREFIX_SEPS
+
+    #ircd flood control: 2 seconds per line, up to 10 seconds ahead
+    PACING = {"penalty": 2.0, "burst": 10.0, "min_penalty": 0.5, "max_penalty": 30.0, "step": 0.1}
+
     def __init__(self, program, server, nick, passwd, prefix, links = [], ident_text = "CrossChatLink", channels = "", connect_cmds = [], auto_connect = True, auto_reconnect = True,
-                 mc_rate = 0, pm_rate = 0, op_control = True, users = None):
+                 mc_rate = 0, pm_rate = 0, op_control = True, users = None, pacing = "fixed", filter_policy = "", digest = 0, transitive = False, ignore_links = ""):
         logging.debug("Configuring a new IRC link")
         
-        super(IRC, self).__init__(program, server, nick, passwd, prefix, links, auto_connect, auto_reconnect, mc_rate, pm_rate, op_control, users)
+        super(IRC, self).__init__(program, server, nick, passwd, prefix, links, auto_connect, auto_reconnect, mc_rate, pm_rate, op_control, users,
+                                  pacing, filter_policy, digest, transitive, ignore_links)
 
+        self._session = None
+        #what the server told the session in another process, taken over with the connection
+        self._server_info = None
         self.ident_text = ident_text
         self.channels = channels
         self.connect_cmds = connect_cmds
@@ -299,45 +1459,172 @@ class IRC (Link):
         self._pm_format = "PRIVMSG {0} :{1}\r\n" #to/msg
         self._encoding = "utf-8"
 
-    def send_chat(self, text):
-        """Sends a message to the mainchat queue"""
-        #Split multiline messages
-        msgs = text.split("\r\n")
-        
-        for msg in msgs:
-            #escape and format the message
-            text = self._escape(text)
-            msg = self._mc_format.format(self._channels_no_keys(), text)
+    def send_chat(self, text, trace = None):
+        """
+        Sends a message (a message.Message or str) to the mainchat queue
+        trace is the (source link, received, queued) times of relayed messages (Messages have their own)
+        """
+        if trace == None and isinstance(text, message.Message):
+            trace = text.trace()
+        if self._missed(trace):
+            return
 
-            #encode in ansi
-            self.queues[self.MAIN].put_nowait(msg.encode(self._encoding, "replace"))
+        #the lines are built once per link type, encoding, channels and line limits, links that match share them
+        targets = self._channels_no_keys()
+        if isinstance(text, message.Message):
+            key = ("lines", type(self), self._encoding, tuple(targets)) + self._line_limits()
+            lines = text.encoded(key, lambda msg: self._privmsg_lines(self._mc_format, targets, msg))
+        else:
+            lines = self._privmsg_lines(self._mc_format, targets, text)
+        for line in lines:
+            self._queues[self.MAIN].put_nowait((line, trace))
     
-    def send_PM (self, text, user):
-        """Sends a private message to the PM queue"""
-        #Split multiline messages
-        msgs = text.split("\r\n")
-        
-        for msg in msgs:
-            #escape and format the message
-            text = self._escape(text)
-            msg = self._pm_format.format(user, text)
+    def send_PM (self, text, user, reply = False):
+        """Sends a private message (a message.Message or str) to the PM queue, or the response queue if it's a reply to a command"""
+        for line in self._privmsg_lines(self._pm_format, [user], text):
+            self._queues[self.RESPONSE if reply else self.PM].put_nowait((line, None))
+
+    def _privmsg_lines(self, fmt, targets, text):
+        """
+        Returns the encoded lines (in the format fmt) to send text to the targets. Targets are batched
+        as far as the server's TARGMAX allows and long messages are split to fit in a line
+        """
+        max_targets, budget = self._line_limits()
+        max_targets = max_targets or len(targets)
+
+        utf8 = self._encoding == "utf-8"
+        msgs = self._encoded(text)
+        lines = []
+        for i in range(0, len(targets), max(max_targets, 1)):
+            head = fmt.format(",".join(targets[i:i + max_targets]), "")[:-2].encode(self._encoding, "replace")
+            size = max(budget - len(head) - 2, 1)
+            for msg in msgs:
+                #servers reject PRIVMSGs with no text
+                if not msg:
+                    continue
+                for piece in utils.split_bytes(msg, size, utf8):
+                    lines.append(head + piece + b"\r\n")
+        return lines
+
+    def _line_limits(self):
+        """Returns (the most targets a PRIVMSG can have (None for no limit), bytes a line can use)"""
+        session = self._session
+        if session != None:
+            return (session.max_targets("PRIVMSG"), session.line_budget())
+        return (1, self.LINE_LEN - len(self.nick.encode("utf-8")) - self.PREFIX_LEN)
+
+    def _encode_text(self, text):
+        """Returns a list of the escaped, encoded lines of the text (multiline messages are sent as a line each)"""
+        return [self._escape(x).encode(self._encoding, "replace") for x in text.split("\r\n")]
+
+    def _split_line(self, line):
+        #"PRIVMSG <targets> :<text>\r\n", only lines to the same targets are merged
+        head, sep, body = line.partition(b" :")
+        if not sep or not body.endswith(b"\r\n"):
+            return None
+        return (head + sep, body[:-2], b"\r\n")
+
+    def _line_limit(self):
+        return self._line_limits()[1]
+
+    def _transcode(self, msg):
+        """Converts the BBCode style formatting used by DC clients to IRC formatting codes"""
+        return utils.bbcode_to_irc(msg.text)
+
+    def _escape(self, msg):
+        """Returns an escaped version of msg (IRC has no escapes, but can't have line breaks in a message)"""
+        return msg.replace("\r", "").replace("\n", " ")
+
+    def _unescape(self, msg):
+        """Returns an unescaped version of msg"""
+        return msg
+
+    def _set_channels(self, channels):
+        """Set the channels (property method), the session joins/parts to match"""
+        self._channels = channels
+        self._keys = None
+        self._targets = None
+        if self._session != None:
+            self._session.update_channels()
 
-            #encode in ansi
-            self.queues[self.PM].put_nowait(msg.encode(self._encoding, "replace"))
+    def _get_channels(self):
+        """Get the channels (property method)"""
+        return self._channels
+
+    def _channel_keys(self):
+        """Returns a dict of (lowercase) channel : key (None if there isn't one)"""
+        if self._keys == None:
+            self._keys = dict((name.lower(), key or None) for name, key in _IRC_CHANNEL.findall(self._channels))
+        return self._keys
+
+    def _get_pacer(self):
+        """Get the pacer (property method), IRC links on the same session share its pacer"""
+        session = self._session
+        return session.pacer if session != None else self._pacer
+
+    def _session_key(self):
+        """Links with the same key share a session"""
+        return (self.server, self.nick, self.passwd)
+
+    def import_state(self, state, socks):
+        """Takes over a connection, joining the session for it before any of the links on it start (see run)"""
+        if not super(IRC, self).import_state(state, socks):
+            return False
+        if self._sock != None:
+            self._session = self._program.irc_pool.attach(self, False)
+        return True
+
+    def _session_state(self):
+        """Returns a dict of protocol specific session state (for handing the connection over)"""
+        session = self._session
+        return session.server_info() if session != None and session._sock != None else dict()
+
+    def _restore_session(self, state):
+        """Restores the protocol specific session state returned by _session_state"""
+        #the session takes it over along with the connection (see IRCSession.add_link)
+        self._server_info = state or None
+
+    def reconnect_key(self):
+        """Links on a session share its retries"""
+        session = self._session
+        return session if session != None else self
+
+    def reconnect(self):
+        """Moves the link to the right session (if its server/nick/password changed) or reconnects the session"""
+        logging.debug("Reconnect requested")
+        if self._session == None:
+            return
+        if self._session.key != self._session_key():
+            self.metrics.reconnects.inc()
+            self._program.irc_pool.detach(self, self._session)
+            self._session = self._program.irc_pool.attach(self)
+        else:
+            self._session.reconnect()
+
+    def _send_connect_cmds(self):
+        """Queues the connect commands in the control lane (once the server has welcomed us)"""
+        for cmd in self.connect_cmds:
+            self.send_control((cmd.strip() + "\r\n").encode(self._encoding, "replace"))
 
     def _channels_no_keys(self):
         """Returns a list of channels without the keys"""
-        #done in one line just cause
-        #splits by "#", trims spaces and commas, filters nulls out,
-        #takes each element up to the first space and prefixes it with the "#"
-        return ["#" + i.split(" ")[0] for i in [i.strip(" ,") for i in self.channels.split("#")] if i != ""]
+        if self._targets == None:
+            self._targets = [name for name, key in _IRC_CHANNEL.findall(self.channels)]
+        return self._targets
         
-    def _parseLine(self, line):
+    def _parse_line(self, line):
         """Parses a line recived from the server"""
         #TODO: Implement IRC protocol
 
     def run(self):
         logging.info("IRC thread initilized")
-        #TODO: connect, recieve, and process data
+        #the session does the network IO, so this thread just waits until the link is stopped
+        self._session = self._program.irc_pool.attach(self)
+        self._stop_req.wait()
+        self._program.irc_pool.detach(self, self._session)
+        self._session = None
+
+    channels = property(_get_channels, _set_channels)
+    pacer = property(_get_pacer)
 
 
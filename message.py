@@ -0,0 +1,65 @@
+
+import time
+
+class Message():
+    """
+    A chat message relayed between links. The text is formatted and unescaped once when it's
+    received. The escaped and encoded text for each (link type, encoding), and the lines built from
+    it, are worked out the first time a link sends it, every other link that would build the same
+    bytes shares them.
+    dialect is the formatting used in the text ("dc"/"irc", see Link.DIALECT)
+    """
+
+    __slots__ = ("source", "nick", "text", "received", "timestamp", "flags", "dialect", "_encoded")
+
+    #flags
+    REPLAY = 1 #sent again from the backlog (not a live message, so it isn't traced)
+    REMOTE = 2 #came from a link in another shard
+
+    def __init__(self, source, nick, text, received = None, flags = 0, dialect = None):
+        self.source = source
+        self.nick = nick
+        self.text = text
+        #monotonic time it was received (for latency) and the wall clock time (for the history)
+        self.received = received if received != None else time.monotonic()
+        self.timestamp = time.time()
+        self.flags = flags
+        self.dialect = dialect
+        self._encoded = None
+
+    def encoded(self, key, func):
+        """Returns func(message), computed the first time it's asked for with key"""
+        if self._encoded == None:
+            self._encoded = dict()
+        val = self._encoded.get(key)
+        if val == None:
+            val = func(self)
+            self._encoded[key] = val
+        return val
+
+    def copy(self, text):
+        """Returns a copy of the message with different text (eg. rewritten by a filter)"""
+        msg = Message(self.source, self.nick, text, self.received, self.flags, self.dialect)
+        msg.timestamp = self.timestamp
+        return msg
+
+    def replay(self):
+        """Returns a copy of the message flagged REPLAY (for the backlog), it shares the encoded text with this one"""
+        msg = Message(self.source, self.nick, self.text, self.received, self.flags | self.REPLAY, self.dialect)
+        msg.timestamp = self.timestamp
+        if self._encoded == None:
+            self._encoded = dict()
+        msg._encoded = self._encoded
+        return msg
+
+    def trace(self):
+        """Returns the (source link, received, queued) times used to measure relay latency, None for replays"""
+        if self.flags & self.REPLAY:
+            return None
+        return (self.source, self.received, time.monotonic())
+
+    def __str__(self):
+        return self.text
+
+    def __len__(self):
+        return len(self.text)
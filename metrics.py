@@ -0,0 +1,242 @@
+
+import threading
+import bisect
+import os
+import logging
+
+#Counters and histograms are updated from the link threads on every message, so they
+#don't take locks. Each thread writes to its own cell (a dict item assignment, which is
+#atomic) and readers add up the cells. Locks are only taken when creating metrics.
+
+class Counter():
+    """A value that only goes up"""
+
+    def __init__(self):
+        self._cells = dict()
+
+    def inc(self, amount = 1):
+        """Adds to the counter"""
+        tid = threading.get_ident()
+        self._cells[tid] = self._cells.get(tid, 0) + amount
+
+    def _get_value(self):
+        return sum(list(self._cells.values()))
+
+    value = property(_get_value)
+
+
+class Histogram():
+    """Counts observations into buckets (upper bounds, in seconds)"""
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        #per thread [counts per bucket (+ overflow), total, sum]
+        self._cells = dict()
+
+    def observe(self, val):
+        """Records an observation"""
+        tid = threading.get_ident()
+        cell = self._cells.get(tid)
+        if cell == None:
+            cell = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            self._cells[tid] = cell
+        cell[0][bisect.bisect_left(self.buckets, val)] += 1
+        cell[1] += 1
+        cell[2] += val
+
+    def snapshot(self):
+        """Returns a ([cumulative count per bucket], count, sum) tuple"""
+        counts = [0] * (len(self.buckets) + 1)
+        total, val_sum = 0, 0.0
+        for cell in list(self._cells.values()):
+            for i, x in enumerate(cell[0]):
+                counts[i] += x
+            total += cell[1]
+            val_sum += cell[2]
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        return (counts[:-1], total, val_sum)
+
+
+class LatencyHistogram():
+    """
+    Log-linear histogram of latencies (like HdrHistogram), recorded in microseconds.
+    Each power of two is split into 8 linear buckets so percentiles are within ~12%.
+    Only one thread should record to a histogram
+    """
+
+    SUB_BITS = 3
+    MAX_EXP = 40 #about 12 days in microseconds
+
+    def __init__(self):
+        self._counts = [0] * ((self.MAX_EXP - self.SUB_BITS + 2) << self.SUB_BITS)
+        self.count = 0
+        self.max = 0
+
+    def _index(self, us):
+        """Returns the bucket for a value"""
+        if us < (2 << self.SUB_BITS):
+            return us
+        exp = min(us.bit_length() - 1, self.MAX_EXP)
+        sub = (us >> (exp - self.SUB_BITS)) & ((1 << self.SUB_BITS) - 1)
+        return ((exp - self.SUB_BITS + 1) << self.SUB_BITS) + sub
+
+    def _lower(self, idx):
+        """Returns the lowest value that goes in a bucket"""
+        if idx < (2 << self.SUB_BITS):
+            return idx
+        exp = (idx >> self.SUB_BITS) + self.SUB_BITS - 1
+        sub = idx & ((1 << self.SUB_BITS) - 1)
+        return ((1 << self.SUB_BITS) + sub) << (exp - self.SUB_BITS)
+
+    def record(self, seconds):
+        """Records a latency"""
+        us = max(int(seconds * 1000000), 0)
+        self._counts[self._index(us)] += 1
+        self.count += 1
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, pct):
+        """Returns the (upper bound of the) latency in seconds that pct percent of the values are under"""
+        if self.count == 0:
+            return 0.0
+        target = max(1, int(self.count * pct / 100.0 + 0.5))
+        seen = 0
+        for idx, num in enumerate(self._counts):
+            seen += num
+            if seen >= target:
+                return min(self._lower(idx + 1) - 1, self.max) / 1000000.0
+        return self.max / 1000000.0
+
+
+class LinkMetrics():
+    """The metrics kept for each link"""
+
+    #attribute : (metric name, help text)
+    COUNTERS = {"messages_in": ("ccl_link_messages_in_total", "Chat messages received from the link"),
+                "bytes_in": ("ccl_link_bytes_in_total", "Bytes received from the link"),
+                "messages_out": ("ccl_link_messages_out_total", "Lines sent to the link"),
+                "bytes_out": ("ccl_link_bytes_out_total", "Bytes sent to the link"),
+                "drops": ("ccl_link_drops_total", "Messages that couldn't be delivered"),
+                "reconnects": ("ccl_link_reconnects_total", "Reconnection attempts"),
+                "stalls": ("ccl_link_rate_stalls_total", "Times a message was held back by the post rate"),
+                "floods": ("ccl_link_flood_warnings_total", "Flood warnings, kicks and disconnects from the server"),
+                "echoes": ("ccl_link_echoes_suppressed_total", "Echoes of our own messages that weren't relayed"),
+                "filtered": ("ccl_link_messages_filtered_total", "Relayed messages dropped by the link's filter"),
+                "digested": ("ccl_link_messages_digested_total", "Relayed messages merged into digest lines")}
+
+    def __init__(self):
+        for x in self.COUNTERS:
+            setattr(self, x, Counter())
+
+
+class Registry():
+    """Keeps track of all the metrics and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #name : (type, help, {labels : metric})
+        self._metrics = dict()
+
+    def _add(self, kind, name, help_text, labels, metric):
+        with self._lock:
+            entry = self._metrics.setdefault(name, (kind, help_text, dict()))
+            return entry[2].setdefault(tuple(sorted(labels.items())), metric)
+
+    def counter(self, name, help_text, **labels):
+        """Gets (or creates) a counter"""
+        return self._add("counter", name, help_text, labels, Counter())
+
+    def histogram(self, name, help_text, **labels):
+        """Gets (or creates) a histogram"""
+        return self._add("histogram", name, help_text, labels, Histogram())
+
+    def gauge(self, name, help_text, func, **labels):
+        """Adds a gauge, func is called to get the value when the metrics are read"""
+        return self._add("gauge", name, help_text, labels, func)
+
+    def add_link(self, name, link):
+        """Adds the metrics of a link (labelled with its name)"""
+        for attr, (metric, help_text) in LinkMetrics.COUNTERS.items():
+            self._add("counter", metric, help_text, {"link": name}, getattr(link.metrics, attr))
+        for i, lane in enumerate(link.LANES):
+            self.gauge("ccl_link_queue_depth", "Messages waiting to be sent to the link",
+                       link.queue_depth_func(i), link=name, queue=lane)
+
+    def remove(self, **labels):
+        """Removes all metrics with the specified labels"""
+        labels = set(labels.items())
+        with self._lock:
+            for kind, help_text, metrics in self._metrics.values():
+                for x in [x for x in metrics if labels.issubset(x)]:
+                    del metrics[x]
+
+    def values(self, name):
+        """Returns a dict of {labels: metric} for a metric name"""
+        with self._lock:
+            return dict(self._metrics.get(name, (None, None, dict()))[2])
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        def fmt_labels(labels, extra = ()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+        with self._lock:
+            items = [(x, self._metrics[x][0], self._metrics[x][1], dict(self._metrics[x][2])) for x in sorted(self._metrics)]
+
+        lines = []
+        for name, kind, help_text, metrics in items:
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels in sorted(metrics):
+                metric = metrics[labels]
+                if kind == "counter":
+                    lines.append("{}{} {}".format(name, fmt_labels(labels), metric.value))
+                elif kind == "gauge":
+                    lines.append("{}{} {}".format(name, fmt_labels(labels), metric()))
+                else:
+                    counts, total, val_sum = metric.snapshot()
+                    for bound, count in zip(metric.buckets, counts):
+                        lines.append("{}_bucket{} {}".format(name, fmt_labels(labels, [("le", bound)]), count))
+                    lines.append("{}_bucket{} {}".format(name, fmt_labels(labels, [("le", "+Inf")]), total))
+                    lines.append("{}_sum{} {}".format(name, fmt_labels(labels), val_sum))
+                    lines.append("{}_count{} {}".format(name, fmt_labels(labels), total))
+        return "\n".join(lines) + "\n"
+
+
+class Writer(threading.Thread):
+    """Periodically writes the metrics to a file for a scraper to pick up"""
+
+    def __init__(self, registry, filename, interval = 15):
+        super(Writer, self).__init__()
+        self.daemon = True
+        self._registry = registry
+        self._filename = filename
+        self._interval = interval
+        self._stop_req = threading.Event()
+
+    def write(self):
+        """Writes the metrics to the file (via a temp file so readers never see a partial file)"""
+        temp = self._filename + ".tmp"
+        try:
+            with open(temp, "w") as f:
+                f.write(self._registry.render())
+            os.replace(temp, self._filename)
+        except IOError as e:
+            logging.error("Couldn't write metrics file: %s", e)
+
+    def run(self):
+        while not self._stop_req.wait(self._interval):
+            self.write()
+        self.write()
+
+    def join(self, timeout=None):
+        """Override join to stop the thread"""
+        self._stop_req.set()
+        super(Writer, self).join(timeout)
@@ -71,6 +71,9 @@ UNKNOWN = -1
 ## Cap sockets to 512 on Windows because winsock can only process 512 at time
 ## Cap sockets to 1000 on Linux because you can only have 1024 file descriptors
 MAX_CONNECTIONS = 512 if sys.platform == 'win32' else 1000
+## Most bytes handed to a socket at once, select() reporting a socket as
+## writable doesn't mean send() won't block on a large buffer
+SEND_CHUNK = 4096
 PARA_BREAK = re.compile(r"(\n\s*\n)", re.MULTILINE)
 
 #--[ Telnet Commands ]---------------------------------------------------------
@@ -157,9 +160,11 @@ class TelnetClient(object):
 
     First argument is the socket discovered by the Telnet Server.
     Second argument is the tuple (ip address, port number).
+    Third argument is the most characters that can wait to be sent before
+    the client is disconnected (None for no limit).
     """
 
-    def __init__(self, sock, addr_tup):
+    def __init__(self, sock, addr_tup, max_buffer=None):
         self.protocol = 'telnet'
         self.active = True          # Turns False when the connection is lost
         self.sock = sock            # The connection's socket
@@ -172,6 +177,9 @@ class TelnetClient(object):
         self.rows = 24
         self.send_pending = False
         self.send_buffer = ''
+        self.max_buffer = max_buffer
+        self.overflowed = False     # Turns True if the send buffer went over max_buffer
+        self.send_stalled_since = None  # When the client last accepted data (while some is waiting)
         self.recv_buffer = ''
         self.bytes_sent = 0
         self.bytes_received = 0
@@ -208,9 +216,18 @@ class TelnetClient(object):
         """
         Send raw text to the distant end.
         """
-        if text:
+        if text and self.active:
+            if not self.send_buffer:
+                self.send_stalled_since = time.time()
             self.send_buffer += text.replace('\n', '\r\n')
             self.send_pending = True
+            if self.max_buffer is not None and len(self.send_buffer) > self.max_buffer:
+                ## The client isn't reading, drop it rather than buffering forever
+                logging.warning("Send buffer of {} is over {} characters, disconnecting".format(
+                    self.addrport(), self.max_buffer))
+                self.overflowed = True
+                self.send_buffer = ''
+                self.active = False
 
     def send_wrapped(self, text):
         """
@@ -304,16 +321,18 @@ class TelnetClient(object):
         """
         if len(self.send_buffer):
             try:
-                #convert to ansi before sending
-                sent = self.sock.send(bytes(self.send_buffer, "cp1252"))
+                #convert to ansi before sending (one byte per character)
+                sent = self.sock.send(bytes(self.send_buffer[:SEND_CHUNK], "cp1252"))
             except socket.error as err:
                 logging.error("SEND error '{}' from {}".format(err, self.addrport()))
                 self.active = False
                 return
             self.bytes_sent += sent
             self.send_buffer = self.send_buffer[sent:]
+            self.send_stalled_since = time.time() if self.send_buffer else None
         else:
             self.send_pending = False
+            self.send_stalled_since = None
 
     def socket_recv(self):
         """
@@ -706,7 +725,8 @@ class TelnetServer(object):
     """
     def __init__(self, port=23, address='', on_connect=_on_connect,
             on_disconnect=_on_disconnect, max_connections=MAX_CONNECTIONS,
-            timeout=0.1):
+            timeout=0.1, server_socket=None, max_buffer=None,
+            write_timeout=None, on_slow_client=None):
         """
         Create a new Telnet Server.
 
@@ -728,6 +748,18 @@ class TelnetServer(object):
 
         timeout -- amount of time that Poll() will wait from user input
             before returning.  Also frees a slice of CPU time.
+
+        server_socket -- an already listening socket to use instead of
+            creating one (port and address are ignored if this is given).
+
+        max_buffer -- most characters that can wait to be sent to a client
+            before it's disconnected (None for no limit).
+
+        write_timeout -- seconds a client can go without accepting any of the
+            data waiting for it before it's disconnected (None for no limit).
+
+        on_slow_client -- function to call with a client and the reason
+            ('buffer' or 'timeout') when it's disconnected by the limits above.
         """
 
         self.port = port
@@ -736,16 +768,20 @@ class TelnetServer(object):
         self.on_disconnect = on_disconnect
         self.max_connections = min(max_connections, MAX_CONNECTIONS)
         self.timeout = timeout
+        self.max_buffer = max_buffer
+        self.write_timeout = write_timeout
+        self.on_slow_client = on_slow_client
 
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if server_socket is None:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        try:
-            server_socket.bind((address, port))
-            server_socket.listen(5)
-        except socket.err as err:
-            logging.critical("Unable to create the server socket: " + str(err))
-            raise
+            try:
+                server_socket.bind((address, port))
+                server_socket.listen(5)
+            except socket.error as err:
+                logging.critical("Unable to create the server socket: " + str(err))
+                raise
 
         self.server_socket = server_socket
         self.server_fileno = server_socket.fileno()
@@ -786,7 +822,25 @@ class TelnetServer(object):
         
         del_list = [] # list of clients to delete after polling
         
+        now = time.time()
         for client in self.clients.values():
+            ## Disconnect clients that stopped reading their output
+            reason = None
+            if client.overflowed:
+                reason = 'buffer'
+            elif (self.write_timeout is not None and client.active and
+                    client.send_stalled_since is not None and
+                    now - client.send_stalled_since > self.write_timeout):
+                logging.warning("{} hasn't accepted any data in {}s, disconnecting".format(
+                    client.addrport(), self.write_timeout))
+                reason = 'timeout'
+                client.active = False
+            if reason is not None:
+                client.overflowed = False
+                client.send_stalled_since = None
+                if self.on_slow_client is not None:
+                    self.on_slow_client(client, reason)
+
             if client.active:
                 recv_list.append(client.fileno)
             else:
@@ -831,7 +885,7 @@ class TelnetServer(object):
                     continue
 
                 ## Create the client instance
-                new_client = TelnetClient(sock, addr_tup)
+                new_client = TelnetClient(sock, addr_tup, self.max_buffer)
                 
                 ## Add the connection to our dictionary and call handler
                 self.clients[new_client.fileno] = new_client
@@ -0,0 +1,335 @@
+
+import os
+import importlib.util
+import threading
+import queue
+import time
+import logging
+
+#Plugins: site-specific code (bots, translators, auto-responders) run on the relayed messages
+#and the commands. The on_message/on_command hooks run in a bounded pool of worker threads so a
+#slow plugin can't hold up the links, each call has a time budget and calls that run over it
+#are counted and written off. Filters are the exception: they run on the relay path (so they can
+#change or drop messages) and have a strict budget, a filter that keeps running over it is disabled.
+
+class Plugin():
+    """
+    Base class for plugins, override the hooks needed. Plugins are loaded from the modules in the
+    plugin directory (every subclass of Plugin in a module is created with the PluginAPI)
+    """
+
+    #longest (seconds) a call of on_message/on_command should take
+    budget = 1.0
+    #longest (seconds) a call of filter should take
+    filter_budget = 0.002
+
+    def __init__(self, api):
+        self.api = api
+
+    def _get_name(self):
+        return type(self).__name__.lower()
+
+    name = property(_get_name)
+
+    def on_message(self, msg):
+        """Called (in a worker) with each message.Message relayed from a link in this process"""
+        pass
+
+    def on_command(self, cmd, source, user, usr_lvl, response):
+        """Called (in a worker) with each command run (the tokens) and its response"""
+        pass
+
+    def filter(self, msg):
+        """
+        Called (on the relay path, keep it quick) with each message.Message before it's relayed.
+        Returns the text to relay (msg.text to leave it alone) or None to drop the message
+        """
+        return msg.text
+
+
+class PluginAPI():
+    """What plugins can do to the program"""
+
+    def __init__(self, program):
+        self._program = program
+
+    def connections(self):
+        """Returns the names of the connections"""
+        return sorted(self._program.connections)
+
+    def send_chat(self, connection, text):
+        """Sends text to the mainchat of a connection"""
+        self._link(connection).send_chat(text)
+
+    def send_pm(self, connection, user, text):
+        """Sends text to a user on a connection (for ADC connections, user is the SID)"""
+        self._link(connection).send_PM(text, user)
+
+    def _link(self, connection):
+        link = self._program.connections.get(connection)
+        if link == None:
+            raise KeyError("No connection '{}'".format(connection))
+        return link
+
+
+class _Hook():
+    """One hook of a plugin, with its metrics"""
+
+    def __init__(self, plugin, kind, budget, registry):
+        self.plugin = plugin
+        self.kind = kind
+        self.func = getattr(plugin, kind if kind == "filter" else "on_" + kind)
+        self.budget = budget
+        self.enabled = True
+        #consecutive calls that failed or ran over the budget (filters are disabled after too many),
+        #filters are called from all the link threads
+        self._lock = threading.Lock()
+        self.overruns = 0
+        labels = {"plugin": plugin.name, "hook": kind}
+        self.seconds = registry.histogram("ccl_plugin_hook_seconds", "Time taken by plugin hooks", **labels)
+        self.timeouts = registry.counter("ccl_plugin_timeouts_total", "Plugin hook calls that ran over their time budget", **labels)
+        self.rejected = registry.counter("ccl_plugin_rejected_total", "Plugin hook calls not made because the worker queue was full", **labels)
+        self.errors = registry.counter("ccl_plugin_errors_total", "Plugin hook calls that raised an exception", **labels)
+
+    def call(self, args, default = None):
+        """
+        Calls the hook, returns (result, seconds taken, whether it worked).
+        Exceptions are logged and counted, the result is then default
+        """
+        start = time.perf_counter()
+        rslt, worked = default, True
+        try:
+            rslt = self.func(*args)
+        except Exception:
+            worked = False
+            self.errors.inc()
+            logging.exception("Plugin '%s' failed in %s", self.plugin.name, self.kind)
+        spent = time.perf_counter() - start
+        self.seconds.observe(spent)
+        return rslt, spent, worked
+
+    def strike(self, failed, limit):
+        """Counts a call that failed or ran over the budget (a call that didn't resets the count), returns True when limit is reached"""
+        with self._lock:
+            if not failed:
+                self.overruns = 0
+                return False
+            self.overruns += 1
+            return self.overruns == limit
+
+    def reset(self):
+        """Forgets the calls that failed or ran over the budget"""
+        with self._lock:
+            self.overruns = 0
+
+
+class WorkerPool(threading.Thread):
+    """
+    Runs hook calls in a fixed number of worker threads. The queue of waiting calls is bounded,
+    calls that don't fit are rejected rather than waited for. This thread watches the running calls:
+    a call that runs over its hook's budget is counted as timed out and its worker is written off
+    and replaced (threads can't be stopped), with at most max_stuck workers written off at a time
+    """
+
+    CHECK_INTERVAL = 0.1
+
+    def __init__(self, workers = 4, queue_size = 1000, max_stuck = 4):
+        super(WorkerPool, self).__init__()
+        self.daemon = True
+        self.size = workers
+        self.max_stuck = max_stuck
+        self._queue = queue.Queue(queue_size)
+        self._stop_req = threading.Event()
+        self._lock = threading.Lock()
+        self._workers = set()
+        #worker : (hook, start time) of the calls being run
+        self._running = dict()
+        #workers that ran over a budget
+        self._stuck = set()
+        with self._lock:
+            for i in range(workers):
+                self._start_worker()
+
+    def _start_worker(self):
+        """Starts a worker thread (hold _lock)"""
+        worker = threading.Thread(target = self._work, name = "plugin-worker")
+        worker.daemon = True
+        self._workers.add(worker)
+        worker.start()
+
+    def _get_stuck(self):
+        return len(self._stuck)
+
+    stuck = property(_get_stuck)
+
+    def waiting(self):
+        """Returns the number of calls waiting for a worker"""
+        return self._queue.qsize()
+
+    def submit(self, hook, args):
+        """Queues a call of a hook, returns False (and counts it) if the queue is full"""
+        try:
+            self._queue.put_nowait((hook, args))
+            return True
+        except queue.Full:
+            hook.rejected.inc()
+            return False
+
+    def _work(self):
+        me = threading.current_thread()
+        while not self._stop_req.is_set():
+            try:
+                hook, args = self._queue.get(True, 0.5)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self._running[me] = (hook, time.monotonic())
+            hook.call(args)
+            with self._lock:
+                del self._running[me]
+                if me in self._stuck:
+                    self._stuck.discard(me)
+                    #it was replaced, leave the pool at its size
+                    if len(self._workers) - len(self._stuck) > self.size:
+                        self._workers.discard(me)
+                        return
+        with self._lock:
+            self._workers.discard(me)
+
+    def run(self):
+        while not self._stop_req.wait(self.CHECK_INTERVAL):
+            now = time.monotonic()
+            with self._lock:
+                for worker, (hook, start) in list(self._running.items()):
+                    if worker in self._stuck or now - start <= hook.budget:
+                        continue
+                    hook.timeouts.inc()
+                    self._stuck.add(worker)
+                    if len(self._stuck) <= self.max_stuck:
+                        logging.warning("Plugin '%s' ran over its %.1fs budget in %s, replacing its worker",
+                                        hook.plugin.name, hook.budget, hook.kind)
+                        self._start_worker()
+                    else:
+                        logging.error("Plugin '%s' ran over its %.1fs budget in %s, too many stuck workers to replace it",
+                                      hook.plugin.name, hook.budget, hook.kind)
+
+    def join(self, timeout=None):
+        """Override join to stop the workers and the thread (calls still running are left to finish)"""
+        self._stop_req.set()
+        super(WorkerPool, self).join(timeout)
+
+
+class PluginManager():
+    """
+    The loaded plugins and their hooks. The lists of hooks are replaced (not changed in place)
+    when plugins are added or enabled/disabled, so the link threads read them without locking
+    """
+
+    #a filter is disabled after this many calls in a row that fail or run over its budget
+    FILTER_STRIKES = 3
+
+    def __init__(self, registry, workers = 4, queue_size = 1000, max_stuck = 4):
+        self._registry = registry
+        self._lock = threading.Lock()
+        self.pool = WorkerPool(workers, queue_size, max_stuck)
+        self.pool.start()
+        registry.gauge("ccl_plugin_queue_depth", "Plugin hook calls waiting for a worker", self.pool.waiting)
+        registry.gauge("ccl_plugin_stuck_workers", "Plugin workers still running a call that went over its budget", lambda: self.pool.stuck)
+        #plugin name : [hooks]
+        self._plugins = dict()
+        self._message_hooks = ()
+        self._command_hooks = ()
+        self._filter_hooks = ()
+
+    def load(self, directory, api):
+        """Loads the plugins from the modules in a directory, returns the names of the plugins loaded"""
+        if not os.path.isdir(directory):
+            return []
+        loaded = []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".py") or filename.startswith("_"):
+                continue
+            try:
+                spec = importlib.util.spec_from_file_location("ccl_plugin_" + filename[:-3], os.path.join(directory, filename))
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                for x in vars(module).values():
+                    if isinstance(x, type) and issubclass(x, Plugin) and x is not Plugin and x.__module__ == module.__name__:
+                        plugin = x(api)
+                        self.add(plugin)
+                        loaded.append(plugin.name)
+            except Exception:
+                logging.exception("Couldn't load plugin module %s", filename)
+        return loaded
+
+    def add(self, plugin):
+        """Adds a plugin (only the hooks it overrides are called)"""
+        with self._lock:
+            if plugin.name in self._plugins:
+                raise ValueError("Plugin '{}' is already loaded".format(plugin.name))
+            hooks = []
+            for kind, base in [("message", Plugin.on_message), ("command", Plugin.on_command), ("filter", Plugin.filter)]:
+                if getattr(type(plugin), kind if kind == "filter" else "on_" + kind) is not base:
+                    hooks.append(_Hook(plugin, kind, plugin.filter_budget if kind == "filter" else plugin.budget, self._registry))
+            self._plugins[plugin.name] = hooks
+            self._publish()
+        logging.info("Loaded plugin '%s' (%s)", plugin.name, ", ".join(x.kind for x in hooks) or "no hooks")
+
+    def _publish(self):
+        """Replaces the lists of enabled hooks (hold _lock)"""
+        hooks = [x for name in sorted(self._plugins) for x in self._plugins[name] if x.enabled]
+        self._message_hooks = tuple(x for x in hooks if x.kind == "message")
+        self._command_hooks = tuple(x for x in hooks if x.kind == "command")
+        self._filter_hooks = tuple(x for x in hooks if x.kind == "filter")
+
+    def plugins(self):
+        """Returns a list of (plugin name, [hooks]), sorted by name"""
+        with self._lock:
+            return [(x, list(self._plugins[x])) for x in sorted(self._plugins)]
+
+    def set_enabled(self, name, enabled):
+        """Enables/disables all the hooks of a plugin"""
+        with self._lock:
+            if name not in self._plugins:
+                raise KeyError("No plugin '{}'".format(name))
+            for hook in self._plugins[name]:
+                hook.enabled = enabled
+                hook.reset()
+            self._publish()
+
+    def filter(self, msg):
+        """Runs the filters on a message.Message, returns it (or a copy with the text changed) or None to drop it"""
+        for hook in self._filter_hooks:
+            #errors let the message through unchanged
+            text, spent, worked = hook.call((msg,), msg.text)
+            if worked and text != None and not isinstance(text, str):
+                hook.errors.inc()
+                logging.error("Plugin '%s' filter returned a %s (not text or None)", hook.plugin.name, type(text).__name__)
+                text, worked = msg.text, False
+            if spent > hook.budget:
+                hook.timeouts.inc()
+            if hook.strike(spent > hook.budget or not worked, self.FILTER_STRIKES):
+                logging.error("Disabling the filter of plugin '%s', it failed or ran over its %.1fms budget %d times in a row",
+                              hook.plugin.name, hook.budget * 1000, self.FILTER_STRIKES)
+                with self._lock:
+                    hook.enabled = False
+                    self._publish()
+            if text == None:
+                return None
+            if text != msg.text:
+                msg = msg.copy(text)
+        return msg
+
+    def message(self, msg):
+        """Queues the on_message hooks for a message.Message"""
+        for hook in self._message_hooks:
+            self.pool.submit(hook, (msg,))
+
+    def command(self, cmd, source, user, usr_lvl, response):
+        """Queues the on_command hooks for a command"""
+        for hook in self._command_hooks:
+            self.pool.submit(hook, (list(cmd), source, user, usr_lvl, response))
+
+    def stop(self):
+        """Stops the worker pool"""
+        self.pool.join()
@@ -0,0 +1,136 @@
+
+import threading
+import sys
+import os
+import time
+import collections
+import cProfile
+import marshal
+
+#Profilers that can be attached to the running program from the admin interface.
+#Nothing is hooked into the program while they aren't running.
+
+def _label(code):
+    """Returns a readable name for a code object"""
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Periodically samples the stacks of a set of threads.
+    threads_func should return a dict of thread ident : name for the threads to sample
+    """
+
+    def __init__(self, threads_func, interval = 0.005, duration = 60):
+        super(SamplingProfiler, self).__init__()
+        self.daemon = True
+        self._threads_func = threads_func
+        self._interval = interval
+        self.duration = duration
+        self._stop_req = threading.Event()
+        self._lock = threading.Lock()
+        #collapsed stack (outermost first) : samples
+        self._stacks = collections.Counter()
+        self._labels = dict()
+        self.samples = 0
+        self.started = time.time()
+
+    def _sample(self):
+        frames = sys._current_frames()
+        stacks = []
+        for ident, name in self._threads_func().items():
+            frame = frames.get(ident)
+            if frame == None:
+                continue
+            stack = []
+            while frame != None:
+                code = frame.f_code
+                label = self._labels.get(code)
+                if label == None:
+                    label = _label(code)
+                    self._labels[code] = label
+                stack.append(label)
+                frame = frame.f_back
+            stack.append(name)
+            stacks.append(";".join(reversed(stack)))
+
+        with self._lock:
+            self._stacks.update(stacks)
+            self.samples += 1
+
+    def run(self):
+        end = time.monotonic() + self.duration
+        while time.monotonic() < end and not self._stop_req.wait(self._interval):
+            self._sample()
+
+    def stop(self):
+        """Stops sampling"""
+        self._stop_req.set()
+        if self.is_alive():
+            self.join()
+
+    def _get_running(self):
+        return self.is_alive()
+
+    running = property(_get_running)
+
+    def top(self, num = 10):
+        """Returns the num functions with the most samples as a list of (function, self samples, total samples)"""
+        own = collections.Counter()
+        total = collections.Counter()
+        with self._lock:
+            stacks = list(self._stacks.items())
+        for stack, count in stacks:
+            funcs = stack.split(";")[1:]
+            if funcs:
+                own[funcs[-1]] += count
+            for func in set(funcs):
+                total[func] += count
+        return [(func, count, total[func]) for func, count in own.most_common(num)]
+
+    def write(self, filename):
+        """Writes the collapsed stacks (as used by flamegraph.pl) to a file"""
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        with open(filename, "w") as f:
+            for stack, count in stacks:
+                f.write("{} {}\n".format(stack, count))
+
+
+class CProfileSession():
+    """
+    A deterministic profile of the thread that starts it (cProfile can only trace the thread it's enabled in).
+    check() must be called periodically from that thread to enforce the time limit
+    """
+
+    def __init__(self, duration = 60):
+        self.duration = duration
+        self.started = time.time()
+        self._end = time.monotonic() + duration
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self.running = True
+
+    def check(self):
+        """Stops profiling if the time limit has passed"""
+        if self.running and time.monotonic() >= self._end:
+            self.stop()
+
+    def stop(self):
+        """Stops profiling"""
+        if self.running:
+            self._profile.disable()
+            self.running = False
+
+    def top(self, num = 10):
+        """Returns the num functions with the most internal time as a list of (function, seconds, cumulative seconds)"""
+        #snapshot_stats doesn't stop the profile (create_stats does)
+        self._profile.snapshot_stats()
+        funcs = sorted(self._profile.stats.items(), key=lambda x: x[1][2], reverse=True)[:num]
+        return [("{} ({}:{})".format(func[2], os.path.basename(func[0]), func[1]), data[2], data[3]) for func, data in funcs]
+
+    def write(self, filename):
+        """Writes the stats in the pstats format"""
+        self._profile.snapshot_stats()
+        with open(filename, "wb") as f:
+            marshal.dump(self._profile.stats, f)
@@ -0,0 +1,151 @@
+
+import threading
+import random
+import time
+import logging
+
+import utils
+
+class _Breaker():
+    """Circuit breaker for a host (stops reconnect attempts for a while after repeated failures)"""
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+
+
+class ReconnectScheduler(threading.Thread):
+    """
+    Manages the reconnect timers of all the links on one thread.
+    Retries back off exponentially with full jitter so links don't all retry at once after an outage.
+    The number of attempts in progress per host is limited, and a host that keeps failing
+    has its attempts suspended for a while (circuit breaker)
+    """
+
+    def __init__(self, base_delay = 2, max_delay = 300, per_host = 2, attempt_timeout = 30,
+                 breaker_failures = 5, breaker_cooldown = 60, tick = 0.5):
+        super(ReconnectScheduler, self).__init__()
+        self.daemon = True
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.per_host = per_host
+        self.attempt_timeout = attempt_timeout
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+
+        self._lock = threading.Lock()
+        self._stop_req = threading.Event()
+        self._wheel = utils.TimerWheel(tick)
+        #link : consecutive failed attempts
+        self._attempts = dict()
+        #link : (host, time started) for attempts in progress
+        self._in_progress = dict()
+        #host : _Breaker
+        self._breakers = dict()
+
+    def _host(self, link):
+        return utils.split_server(link.server, link.DEFAULT_PORT)[0]
+
+    def _backoff(self, attempts):
+        """Returns the delay before the next attempt (full jitter)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempts)))
+
+    def connection_lost(self, link):
+        """Called when a link loses its connection (or fails to connect), schedules a retry"""
+        with self._lock:
+            host = self._host(link)
+            if self._in_progress.pop(link, None) != None:
+                self._host_failed(host)
+            attempts = self._attempts.get(link, 0)
+            self._attempts[link] = attempts + 1
+            delay = self._backoff(attempts)
+            self._wheel.add(link, delay, host)
+        logging.info("Reconnecting %s in %.1fs (attempt %d)", link.name, delay, attempts + 1)
+
+    def connected(self, link):
+        """Called when a link connects, resets its backoff"""
+        with self._lock:
+            host = self._in_progress.pop(link, (self._host(link), None))[0]
+            self._attempts.pop(link, None)
+            self._wheel.cancel(link)
+            breaker = self._breakers.get(host)
+            if breaker != None:
+                breaker.state = _Breaker.CLOSED
+                breaker.failures = 0
+                breaker.trips = 0
+
+    def cancel(self, link):
+        """Stops trying to reconnect a link (eg. it was disconnected or deleted)"""
+        with self._lock:
+            self._wheel.cancel(link)
+            self._attempts.pop(link, None)
+            self._in_progress.pop(link, None)
+
+    def _host_failed(self, host):
+        """Records a failed attempt against a host, opening its breaker if it keeps failing"""
+        breaker = self._breakers.setdefault(host, _Breaker())
+        breaker.failures += 1
+        if breaker.state == _Breaker.HALF_OPEN or breaker.failures >= self.breaker_failures:
+            #stay open longer each time it trips
+            cooldown = min(self.max_delay, self.breaker_cooldown * (2 ** breaker.trips))
+            breaker.state = _Breaker.OPEN
+            breaker.open_until = time.monotonic() + cooldown
+            breaker.trips += 1
+            breaker.failures = 0
+            logging.warning("Too many failed connections to %s, waiting %ds before trying again", host, cooldown)
+
+    def _attempt(self, link, host, now):
+        """
+        Records an attempt to reconnect a link, or puts it off if the host is busy or its breaker is open.
+        Returns True if the link should reconnect (done by the caller, without the lock held)
+        """
+        breaker = self._breakers.get(host)
+        if breaker != None and breaker.state != _Breaker.CLOSED:
+            if breaker.state == _Breaker.OPEN and now >= breaker.open_until:
+                #let one attempt through to test the host
+                breaker.state = _Breaker.HALF_OPEN
+            elif breaker.state == _Breaker.OPEN or any(x[0] == host for x in self._in_progress.values()):
+                self._wheel.add(link, max(breaker.open_until - now, 0) + random.uniform(0, self._wheel.tick * 4), host)
+                return False
+
+        if sum(1 for x in self._in_progress.values() if x[0] == host) >= self.per_host:
+            self._wheel.add(link, self._wheel.tick + random.uniform(0, self._wheel.tick * 4), host)
+            return False
+
+        self._in_progress[link] = (host, now)
+        return True
+
+    def next_attempt(self, link):
+        """Returns the seconds until the link's next reconnect attempt (None if there isn't one), and the attempt number"""
+        with self._lock:
+            due = self._wheel.due(link)
+            if due == None:
+                return (None, self._attempts.get(link, 0))
+            return (max(due - time.monotonic(), 0), self._attempts.get(link, 0))
+
+    def run(self):
+        while not self._stop_req.wait(self._wheel.tick):
+            now = time.monotonic()
+            with self._lock:
+                #attempts that didn't report back count as failures
+                for link, (host, started) in list(self._in_progress.items()):
+                    if now - started > self.attempt_timeout:
+                        del self._in_progress[link]
+                        self._host_failed(host)
+                        self._attempts[link] = self._attempts.get(link, 0) + 1
+                        self._wheel.add(link, self._backoff(self._attempts.get(link, 0)), host)
+                due = [link for link, host in self._wheel.advance() if self._attempt(link, host, now)]
+            #reconnecting can report back (connected) straight away, which takes the lock
+            for link in due:
+                link.reconnect()
+
+    def join(self, timeout=None):
+        """Override join to stop the thread"""
+        self._stop_req.set()
+        super(ReconnectScheduler, self).join(timeout)
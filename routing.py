@@ -0,0 +1,93 @@
+
+import threading
+import collections
+
+#Transitive relaying: a link set to relay transitively sends its messages to every link that
+#can be reached by following the links from it, not just the ones it links to directly. The
+#delivery set of each origin is worked out ahead of time (a breadth first search of the link
+#graph, so each link is in it once however many paths lead to it) and only recomputed for the
+#origins that can reach a link whose links or ignore list changed.
+
+class RouteTable():
+    """The link graph and the delivery set of each origin"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #name : names it links to
+        self._graph = dict()
+        #name : names of the origins it doesn't want messages from
+        self._ignores = dict()
+        #origin : names reached by the search (including ones not in the graph, so adding them is noticed)
+        self._reach = dict()
+        #name : origins that reach it
+        self._reached_by = dict()
+        #origin : names of the links to deliver to, in breadth first order.
+        #Entries are replaced as a whole, so they can be read without locking
+        self._sets = dict()
+
+    def names(self):
+        """Returns the names of the links in the graph"""
+        with self._lock:
+            return set(self._graph)
+
+    def delivery_set(self, origin):
+        """Returns the names of the links a message from origin is delivered to"""
+        return self._sets.get(origin, ())
+
+    def update(self, changes):
+        """
+        Changes the graph, changes is a dict of name : (names it links to, names it ignores),
+        or None for links that were removed. Returns the origins whose delivery sets changed
+        """
+        with self._lock:
+            dirty = set()
+            for name, entry in changes.items():
+                if entry == None:
+                    if name not in self._graph:
+                        continue
+                    del self._graph[name]
+                    self._ignores.pop(name, None)
+                else:
+                    targets, ignores = tuple(entry[0]), frozenset(entry[1])
+                    if self._graph.get(name) == targets and self._ignores.get(name) == ignores:
+                        continue
+                    self._graph[name] = targets
+                    self._ignores[name] = ignores
+                dirty.add(name)
+                dirty.update(self._reached_by.get(name, ()))
+
+            changed = set()
+            for origin in dirty:
+                old = self._sets.get(origin, ())
+                self._search(origin)
+                if self._sets.get(origin, ()) != old:
+                    changed.add(origin)
+            return changed
+
+    def _search(self, origin):
+        """Works out the delivery set of an origin (hold _lock)"""
+        seen = set([origin])
+        order = []
+        frontier = collections.deque([origin])
+        while frontier:
+            for x in self._graph.get(frontier.popleft(), ()):
+                if x not in seen:
+                    seen.add(x)
+                    order.append(x)
+                    frontier.append(x)
+        seen.discard(origin)
+
+        old = self._reach.get(origin, frozenset())
+        for x in old - seen:
+            self._reached_by[x].discard(origin)
+            if not self._reached_by[x]:
+                del self._reached_by[x]
+        for x in seen - old:
+            self._reached_by.setdefault(x, set()).add(origin)
+
+        if origin in self._graph:
+            self._reach[origin] = frozenset(seen)
+            self._sets[origin] = tuple(x for x in order if x in self._graph and origin not in self._ignores[x])
+        else:
+            self._reach.pop(origin, None)
+            self._sets.pop(origin, None)
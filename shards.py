@@ -0,0 +1,372 @@
+
+import threading
+import multiprocessing
+import multiprocessing.shared_memory
+import hashlib
+import bisect
+import struct
+import shlex
+import queue
+import time
+import logging
+
+import message
+
+#Sharded mode: the links are spread over worker processes (so relaying isn't limited to one
+#core by the GIL). Each link lives in the shard picked by a consistent hash of its name.
+#Messages for links in other shards go through shared memory rings, one per (from, to) pair
+#of shards so each ring has a single writer and a single reader. The rings also carry the
+#changes to the links of each connection, so every shard's route table covers the whole graph.
+#Admin commands are run in the parent, which passes them on to the shards over pipes and
+#combines the responses (the status and stats tables are built from the data of all the shards).
+
+class HashRing():
+    """Consistent hash of names onto shards"""
+
+    def __init__(self, count, replicas = 64):
+        self.count = count
+        points = sorted((self._hash("{}:{}".format(shard, i)), shard) for shard in range(count) for i in range(replicas))
+        self._keys = [x[0] for x in points]
+        self._shards = [x[1] for x in points]
+
+    def _hash(self, key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def shard(self, name):
+        """Returns the shard a name belongs to"""
+        return self._shards[bisect.bisect(self._keys, self._hash(name)) % len(self._keys)]
+
+
+class Ring():
+    """
+    Ring buffer of messages (bytes) in shared memory, for one writer and one reader.
+    The header holds the read and write positions (total bytes, so they only go up) and the
+    capacity. Each message is a length followed by the data, a length of WRAP (or less than
+    a length's worth of space) means the rest of the buffer is unused and reading continues
+    at the start. The writer only moves the write position once the data is in place
+    """
+
+    _HEADER = struct.Struct("=QQQ")
+    _LEN = struct.Struct("=I")
+    WRAP = 0xFFFFFFFF
+
+    def __init__(self, name = None, size = 4 * 1024 * 1024):
+        if name == None:
+            self._shm = multiprocessing.shared_memory.SharedMemory(create = True, size = size + self._HEADER.size)
+            self._HEADER.pack_into(self._shm.buf, 0, 0, 0, size)
+            self._owner = True
+        else:
+            self._shm = multiprocessing.shared_memory.SharedMemory(name)
+            self._owner = False
+        self.name = self._shm.name
+        self._buf = self._shm.buf
+        self.capacity = self._HEADER.unpack_from(self._buf, 0)[2]
+
+    def _positions(self):
+        return self._HEADER.unpack_from(self._buf, 0)[:2]
+
+    def used(self):
+        """Returns the number of bytes waiting to be read"""
+        head, tail = self._positions()
+        return tail - head
+
+    def put(self, data):
+        """Adds a message, returns False if there isn't room for it"""
+        head, tail = self._positions()
+        need = self._LEN.size + len(data)
+        pos = tail % self.capacity
+        #messages aren't split over the end of the buffer
+        skip = self.capacity - pos if pos + need > self.capacity else 0
+        if tail + skip + need - head > self.capacity:
+            return False
+
+        base = self._HEADER.size
+        if skip:
+            if skip >= self._LEN.size:
+                self._LEN.pack_into(self._buf, base + pos, self.WRAP)
+            tail += skip
+            pos = 0
+        self._LEN.pack_into(self._buf, base + pos, len(data))
+        self._buf[base + pos + self._LEN.size:base + pos + need] = data
+        #publish it
+        struct.pack_into("=Q", self._buf, 8, tail + need)
+        return True
+
+    def get(self):
+        """Takes the next message, returns None if there isn't one"""
+        head, tail = self._positions()
+        if head == tail:
+            return None
+
+        base = self._HEADER.size
+        pos = head % self.capacity
+        if self.capacity - pos < self._LEN.size or self._LEN.unpack_from(self._buf, base + pos)[0] == self.WRAP:
+            head += self.capacity - pos
+            pos = 0
+        length = self._LEN.unpack_from(self._buf, base + pos)[0]
+        data = bytes(self._buf[base + pos + self._LEN.size:base + pos + self._LEN.size + length])
+        struct.pack_into("=Q", self._buf, 0, head + self._LEN.size + length)
+        return data
+
+    def close(self):
+        """Detaches from the ring (and frees it, in the process that created it)"""
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+#kinds of records in the rings
+_MESSAGE = 0
+_ROUTES = 1
+
+#relayed message: kind, received time, flags, dialect, lengths of the source name, the target names (\0 separated) and the text
+_MSG = struct.Struct("=BdBBHHI")
+_DIALECTS = (None, "dc", "irc")
+#changed routes: kind, whether the connection was removed, lengths of its name, the names it links to and the names it ignores
+_ROUTE = struct.Struct("=BBHHH")
+
+def _pack_message(targets, msg):
+    source = msg.source.encode("utf-8")
+    targets = "\0".join(targets).encode("utf-8")
+    text = msg.text.encode("utf-8")
+    return b"".join([_MSG.pack(_MESSAGE, msg.received, msg.flags, _DIALECTS.index(msg.dialect), len(source), len(targets), len(text)),
+                     source, targets, text])
+
+def _unpack_message(data):
+    """Returns the target names and the message.Message"""
+    kind, recv_time, flags, dialect, source_len, targets_len, text_len = _MSG.unpack_from(data, 0)
+    pos = _MSG.size
+    source = data[pos:pos + source_len].decode("utf-8")
+    pos += source_len
+    targets = data[pos:pos + targets_len].decode("utf-8").split("\0")
+    pos += targets_len
+    text = data[pos:pos + text_len].decode("utf-8")
+    return targets, message.Message(source, None, text, recv_time, flags | message.Message.REMOTE, _DIALECTS[dialect])
+
+def _pack_routes(name, entry):
+    links, ignores = entry if entry != None else ((), ())
+    parts = [x.encode("utf-8") for x in [name, "\0".join(links), "\0".join(ignores)]]
+    return b"".join([_ROUTE.pack(_ROUTES, entry == None, *[len(x) for x in parts])] + parts)
+
+def _unpack_routes(data):
+    """Returns the name of the connection and its (links, ignored links), or None if it was removed"""
+    kind, removed, name_len, links_len, ignores_len = _ROUTE.unpack_from(data, 0)
+    pos = _ROUTE.size
+    parts = []
+    for size in [name_len, links_len, ignores_len]:
+        parts.append(data[pos:pos + size].decode("utf-8"))
+        pos += size
+    if removed:
+        return parts[0], None
+    return parts[0], tuple([x for x in part.split("\0") if x] for part in parts[1:])
+
+
+class Router(threading.Thread):
+    """
+    Relays messages between the links in a worker and the links in other shards.
+    rings is a dict of (from shard, to shard) : ring name
+    """
+
+    def __init__(self, program, index, count, rings):
+        super(Router, self).__init__()
+        self.daemon = True
+        self._program = program
+        self.index = index
+        self._hash = HashRing(count)
+        self._out = dict((to, Ring(name)) for (frm, to), name in rings.items() if frm == index)
+        self._in = [Ring(name) for (frm, to), name in rings.items() if to == index]
+        #names of the links in other shards
+        self.remote = set()
+        self._stop_req = threading.Event()
+
+        self._drops = dict((x, program.metrics.counter("ccl_shard_ring_full_total", "Messages dropped because a ring to another shard was full",
+                                                       to=str(x))) for x in self._out)
+        for x, ring in self._out.items():
+            program.metrics.gauge("ccl_shard_ring_bytes", "Bytes waiting in the ring to another shard", ring.used, to=str(x))
+
+    def owns(self, name):
+        """Checks if a link belongs in this shard"""
+        return self._hash.shard(name) == self.index
+
+    def forward(self, targets, msg):
+        """Sends a message.Message to links in other shards (encoded once per shard)"""
+        by_shard = dict()
+        for x in targets:
+            by_shard.setdefault(self._hash.shard(x), []).append(x)
+        for shard, names in by_shard.items():
+            if not self._out[shard].put(_pack_message(names, msg)):
+                self._drops[shard].inc()
+
+    def publish_routes(self, name, entry):
+        """
+        Tells the other shards a connection in this one changed its links or ignored links.
+        entry is (links, ignored links) or None if the connection was removed
+        """
+        data = _pack_routes(name, entry)
+        for shard, ring in self._out.items():
+            if not ring.put(data):
+                self._drops[shard].inc()
+                logging.error("Couldn't tell shard %d about the links of '%s', the ring is full", shard, name)
+
+    def _deliver(self, data):
+        if data[0] == _ROUTES:
+            #the route table belongs to the command thread
+            name, entry = _unpack_routes(data)
+            self._program.post(self._program.remote_routes, name, entry)
+            return
+        targets, msg = _unpack_message(data)
+        decisions = dict()
+        for name in targets:
+            link = self._program.connections.get(name)
+            if link != None:
+                link.deliver(msg, decisions)
+
+    def run(self):
+        idle = 0.001
+        while not self._stop_req.is_set():
+            got = False
+            for ring in self._in:
+                data = ring.get()
+                while data != None:
+                    got = True
+                    self._deliver(data)
+                    data = ring.get()
+            #poll less often while it's quiet
+            idle = 0.001 if got else min(idle * 2, 0.05)
+            if not got:
+                self._stop_req.wait(idle)
+
+    def join(self, timeout=None):
+        """Override join to stop the thread and detach from the rings"""
+        self._stop_req.set()
+        super(Router, self).join(timeout)
+        for ring in list(self._out.values()) + self._in:
+            ring.close()
+
+
+class ShardInterface(threading.Thread):
+    """The admin interface of a worker: runs commands passed on by the parent and sends back the responses"""
+
+    def __init__(self, program, conn):
+        super(ShardInterface, self).__init__()
+        self.daemon = True
+        self._program = program
+        self._conn = conn
+        self._stop_req = threading.Event()
+        self.msg_queue = queue.Queue()
+
+    def disconnect_client(self):
+        pass
+
+    def server_socket(self):
+        return None
+
+    def run(self):
+        while not self._stop_req.is_set():
+            try:
+                if not self._conn.poll(0.5):
+                    continue
+                cmd = self._conn.recv()
+            except (EOFError, OSError):
+                #the parent is gone
+                self._program.stop()
+                break
+            if cmd == None:
+                self._program.stop()
+                break
+            seq, cmd = cmd
+            if isinstance(cmd, str):
+                #the data of a report the parent combines with the other shards'
+                self._program.post(self._report, cmd)
+            else:
+                self._program.parse_command(shlex.join(cmd), None, None, self._program.ADMIN)
+            #wait for the program thread to run it (it could still be starting up)
+            self._conn.send((seq, self.msg_queue.get()))
+
+    def _report(self, kind):
+        self.msg_queue.put(self._program.link_report(kind))
+
+    def join(self, timeout=None):
+        """Override join to stop the thread"""
+        self._stop_req.set()
+        super(ShardInterface, self).join(timeout)
+
+
+class ShardManager():
+    """
+    Starts the workers (in the parent process) and passes admin commands on to them.
+    target is the function run in each worker as target(index, count, rings, conn, *args)
+    """
+
+    def __init__(self, count, target, args = (), ring_size = 4 * 1024 * 1024, timeout = 30):
+        self.count = count
+        self._hash = HashRing(count)
+        self._timeout = timeout
+        #commands are numbered so responses that come in after timing out can be told apart
+        self._seq = 0
+        self._rings = dict(((frm, to), Ring(size = ring_size)) for frm in range(count) for to in range(count) if frm != to)
+        names = dict((key, ring.name) for key, ring in self._rings.items())
+
+        #spawn rather than fork, the parent has threads running
+        ctx = multiprocessing.get_context("spawn")
+        self._conns = []
+        self._procs = []
+        for i in range(count):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target = target, args = (i, count, names, child_conn) + tuple(args), name = "shard{}".format(i))
+            proc.start()
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+        logging.info("Started %d shards", count)
+
+    def command(self, cmd, name = None):
+        """
+        Runs a command in the shards, returns the combined responses.
+        If the command is about a connection (name), it's only run in the shard that has it
+        """
+        shards = [self._hash.shard(name)] if name != None else range(self.count)
+        responses = [x if x != None else "ERROR: No response from shard {}".format(i) for i, x in zip(shards, self._ask(shards, cmd))]
+        if name != None:
+            return responses[0]
+        return "\n\n".join("Shard {}:\n{}".format(i, x) for i, x in zip(shards, responses))
+
+    def gather(self, kind):
+        """
+        Gets a report (see CrossChatLink.link_report) from every shard so they can be combined.
+        Returns the reports and the indexes of the shards that didn't answer
+        """
+        responses = self._ask(range(self.count), kind)
+        return [x for x in responses if x != None], [i for i, x in enumerate(responses) if x == None]
+
+    def _ask(self, shards, request):
+        """Sends a command or report request to the shards, returns their responses (None if one didn't answer in time)"""
+        self._seq += 1
+        for i in shards:
+            self._conns[i].send((self._seq, request))
+        responses = []
+        end = time.monotonic() + self._timeout
+        for i in shards:
+            response = None
+            while self._conns[i].poll(max(end - time.monotonic(), 0)):
+                seq, data = self._conns[i].recv()
+                if seq == self._seq:
+                    response = data
+                    break
+            responses.append(response)
+        return responses
+
+    def stop(self):
+        """Stops the workers and frees the rings"""
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for proc in self._procs:
+            proc.join(self._timeout)
+            if proc.is_alive():
+                logging.error("Shard %s didn't stop, terminating it", proc.name)
+                proc.terminate()
+        for ring in self._rings.values():
+            ring.close()
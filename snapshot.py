@@ -0,0 +1,174 @@
+
+import os
+import mmap
+import struct
+import logging
+
+#Compact binary snapshot of the runtime state of the links, written on shutdown and
+#loaded on startup so learnt users and undelivered messages survive a restart.
+#
+#Layout (all integers big-endian):
+#  header: magic "CCLS", version (H), number of links (H)
+#  per link:
+#    name, type, server, nick (strings)
+#    dynamic users: count (I), then per user: nick (string), pm/mc/ctrl (3 bytes)
+#    session: count (H), then per entry: key (string), value (tagged: None/string/dict of strings)
+#    queues: count (B), then per queue: count (I), then per message: length (I) + bytes
+#  strings are a length (H) followed by utf-8 data
+
+MAGIC = b"CCLS"
+VERSION = 1
+
+_HEADER = struct.Struct("!4sHH")
+_H = struct.Struct("!H")
+_I = struct.Struct("!I")
+_B = struct.Struct("!B")
+
+#session value tags
+_NONE = 0
+_STR = 1
+_DICT = 2
+
+class SnapshotError(Exception):
+    """Raised when a snapshot can't be read"""
+
+
+def _pack_str(out, val):
+    data = val.encode("utf-8")
+    out.append(_H.pack(len(data)))
+    out.append(data)
+
+def _pack_link(out, name, state):
+    for x in [name, state["type"], state["server"], state["nick"]]:
+        _pack_str(out, x)
+
+    out.append(_I.pack(len(state["dynamic_users"])))
+    for user in state["dynamic_users"]:
+        _pack_str(out, user[0])
+        out.append("".join(user[1:4]).encode("ascii"))
+
+    out.append(_H.pack(len(state["session"])))
+    for key, val in sorted(state["session"].items()):
+        _pack_str(out, key)
+        if val == None:
+            out.append(_B.pack(_NONE))
+        elif isinstance(val, dict):
+            out.append(_B.pack(_DICT) + _I.pack(len(val)))
+            for k, v in val.items():
+                _pack_str(out, k)
+                _pack_str(out, v)
+        else:
+            out.append(_B.pack(_STR))
+            _pack_str(out, val)
+
+    out.append(_B.pack(len(state["queues"])))
+    for items in state["queues"]:
+        out.append(_I.pack(len(items)))
+        for x in items:
+            out.append(_I.pack(len(x)))
+            out.append(x)
+
+def dumps(states):
+    """Returns a dict of link name : state (see Link.export_state) as a snapshot (bytes)"""
+    out = [_HEADER.pack(MAGIC, VERSION, len(states))]
+    for name in sorted(states):
+        _pack_link(out, name, states[name])
+    return b"".join(out)
+
+def write(filename, states):
+    """Writes a dict of link name : state (see Link.export_state) to the snapshot file"""
+    #write to a temp file first so a crash doesn't leave a half written snapshot
+    temp = filename + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(dumps(states))
+    os.replace(temp, filename)
+
+
+class _Reader():
+    """Reads values out of a buffer"""
+
+    def __init__(self, buf):
+        self._buf = buf
+        self.pos = 0
+
+    def unpack(self, fmt):
+        val = fmt.unpack_from(self._buf, self.pos)[0]
+        self.pos += fmt.size
+        return val
+
+    def raw(self, size):
+        if self.pos + size > len(self._buf):
+            raise SnapshotError("Snapshot is truncated")
+        val = bytes(self._buf[self.pos:self.pos + size])
+        self.pos += size
+        return val
+
+    def string(self):
+        return self.raw(self.unpack(_H)).decode("utf-8")
+
+def _unpack_link(r):
+    name = r.string()
+    state = {"type": r.string(), "server": r.string(), "nick": r.string(), "sock": None}
+
+    users = []
+    for i in range(r.unpack(_I)):
+        nick = r.string()
+        users.append([nick] + list(r.raw(3).decode("ascii")))
+    state["dynamic_users"] = users
+
+    session = dict()
+    for i in range(r.unpack(_H)):
+        key = r.string()
+        tag = r.unpack(_B)
+        if tag == _NONE:
+            session[key] = None
+        elif tag == _STR:
+            session[key] = r.string()
+        elif tag == _DICT:
+            session[key] = dict((r.string(), r.string()) for j in range(r.unpack(_I)))
+        else:
+            raise SnapshotError("Unknown session value type {}".format(tag))
+    state["session"] = session
+
+    queues = []
+    for i in range(r.unpack(_B)):
+        queues.append([r.raw(r.unpack(_I)) for j in range(r.unpack(_I))])
+    state["queues"] = queues
+    return name, state
+
+def loads(buf):
+    """
+    Reads a snapshot from a buffer, returns a dict of link name : state (see Link.import_state).
+    Raises SnapshotError if it isn't a valid snapshot
+    """
+    if len(buf) < _HEADER.size:
+        raise SnapshotError("Snapshot is truncated")
+    magic, version, count = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise SnapshotError("Not a snapshot file")
+    if version != VERSION:
+        raise SnapshotError("Unsupported snapshot version {}".format(version))
+
+    r = _Reader(buf)
+    r.pos = _HEADER.size
+    states = dict()
+    try:
+        for i in range(count):
+            name, state = _unpack_link(r)
+            states[name] = state
+    except (struct.error, UnicodeDecodeError) as e:
+        raise SnapshotError("Snapshot is corrupt ({})".format(e))
+    return states
+
+def load(filename):
+    """
+    Loads the snapshot file, returns a dict of link name : state (see Link.import_state).
+    Raises SnapshotError if the file isn't a valid snapshot
+    """
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            raise SnapshotError("Snapshot is truncated")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            states = loads(buf)
+    logging.debug("Loaded snapshot of %d links from %s", len(states), filename)
+    return states
@@ -0,0 +1,83 @@
+
+import pytest
+
+import filters
+import message
+import metrics
+
+def _policy(*rules):
+    return filters.Policy("test", [filters.Rule(*x) for x in rules])
+
+def test_no_rules():
+    assert _policy().apply("anything") == "anything"
+
+def test_word_boundaries():
+    policy = _policy(("replace", "word", "ass"))
+    assert policy.apply("you ass!") == "you ***!"
+    assert policy.apply("ASS") == "***"
+    assert policy.apply("class assets") == "class assets"
+
+def test_word_with_symbols():
+    policy = _policy(("replace", "word", "c++", "C"))
+    assert policy.apply("c++ rocks") == "C rocks"
+    assert policy.apply("cc++") == "cc++"
+
+def test_drop():
+    policy = _policy(("drop", "regex", r"https?://\S+"))
+    assert policy.apply("see http://example.com") == None
+    assert policy.apply("nothing to see") == "nothing to see"
+
+def test_drop_wins_over_replace():
+    #the replace rule matches first (and overlaps the drop rule's match)
+    policy = _policy(("replace", "word", "bad"), ("drop", "regex", "bad stuff"))
+    assert policy.apply("bad stuff") == None
+    assert policy.apply("bad things") == "*** things"
+
+def test_drop_after_replace_match():
+    policy = _policy(("replace", "regex", "a b"), ("drop", "regex", "b c"))
+    assert policy.apply("a b c") == None
+
+def test_each_rule_uses_its_replacement():
+    policy = _policy(("replace", "word", "one", "1"), ("drop", "word", "never"), ("replace", "word", "two", "2"),
+                     ("replace", "regex", "t(h)ree", "3"))
+    assert policy.apply("one two three one") == "1 2 3 1"
+
+def test_first_rule_wins_at_same_position():
+    policy = _policy(("replace", "regex", "abc", "first"), ("replace", "regex", "abcdef", "second"))
+    assert policy.apply("abcdef") == "firstdef"
+
+def test_invalid_rules():
+    with pytest.raises(ValueError):
+        filters.Rule("keep", "word", "x")
+    with pytest.raises(ValueError):
+        filters.Rule("drop", "glob", "x")
+    with pytest.raises(ValueError):
+        filters.Rule("drop", "word", "")
+    with pytest.raises(ValueError):
+        filters.Rule("drop", "regex", "(")
+
+def test_filter_set_decisions():
+    filter_set = filters.FilterSet(metrics.Registry())
+    filter_set.add_rule("clean", filters.Rule("replace", "word", "darn"))
+    msg = message.Message("irc", "alice", "<alice> darn it")
+    decisions = dict()
+    rslt = filter_set.apply("clean", msg, decisions)
+    assert rslt.text == "<alice> *** it" and rslt is not msg
+    #the same policy isn't run twice for a message
+    assert filter_set.apply("clean", msg, decisions) is rslt
+    assert filter_set.time_spent("clean")[0] == 1
+    #unknown policies let messages through
+    assert filter_set.apply("other", msg, decisions) is msg
+
+def test_filter_set_saved(tmp_path):
+    filename = str(tmp_path / "filters.json")
+    filter_set = filters.FilterSet(metrics.Registry(), filename)
+    filter_set.add_rule("clean", filters.Rule("replace", "word", "darn", "d***"))
+    filter_set.add_rule("clean", filters.Rule("drop", "regex", "spam+"))
+    filter_set.add_rule("other", filters.Rule("drop", "word", "x"))
+    filter_set.del_rule("other", 0)
+
+    loaded = filters.FilterSet(metrics.Registry(), filename)
+    assert [x.name for x in loaded.policies()] == ["clean"]
+    assert [str(x) for x in loaded.get("clean").rules] == [str(x) for x in filter_set.get("clean").rules]
+    assert loaded.get("clean").apply("darn") == "d***"
@@ -0,0 +1,64 @@
+
+import routing
+
+def _table(graph, ignores = {}):
+    table = routing.RouteTable()
+    table.update(dict((x, (graph[x], ignores.get(x, []))) for x in graph))
+    return table
+
+def test_delivery_sets():
+    table = _table({"a": ["b"], "b": ["c", "d"], "c": ["e"], "d": [], "e": []})
+    assert table.delivery_set("a") == ("b", "c", "d", "e")
+    assert table.delivery_set("b") == ("c", "d", "e")
+    assert table.delivery_set("e") == ()
+    assert table.delivery_set("unknown") == ()
+
+def test_links_not_in_graph():
+    #names not in the graph yet aren't delivered to, but are picked up when they're added
+    table = _table({"a": ["b"], "b": ["c"]})
+    assert table.delivery_set("a") == ("b",)
+    assert table.update({"c": ([], [])}) == set(["a", "b"])
+    assert table.delivery_set("a") == ("b", "c")
+
+def test_cycles():
+    table = _table({"a": ["b"], "b": ["c"], "c": ["a", "b"]})
+    assert table.delivery_set("a") == ("b", "c")
+    assert table.delivery_set("b") == ("c", "a")
+    assert table.delivery_set("c") == ("a", "b")
+
+def test_each_link_once():
+    table = _table({"a": ["b", "c"], "b": ["d"], "c": ["d"], "d": []})
+    assert table.delivery_set("a") == ("b", "c", "d")
+
+def test_incremental_update():
+    table = _table({"a": ["b"], "b": [], "x": ["y"], "y": []})
+    #c isn't in the graph yet, so no delivery set changes
+    assert table.update({"b": (["c"], [])}) == set()
+    assert table.delivery_set("a") == ("b",)
+    #only the origins that reach the changed link are recomputed
+    assert table.update({"c": ([], [])}) == set(["a", "b"])
+    assert table.delivery_set("a") == ("b", "c")
+    assert table.delivery_set("x") == ("y",)
+    #nothing changed
+    assert table.update({"b": (["c"], [])}) == set()
+
+def test_ignores():
+    table = _table({"a": ["b"], "b": ["c"], "c": []}, {"c": ["a"]})
+    assert table.delivery_set("a") == ("b",)
+    assert table.delivery_set("b") == ("c",)
+    #an ignoring link is still passed through
+    table = _table({"a": ["b"], "b": ["c"], "c": []}, {"b": ["a"]})
+    assert table.delivery_set("a") == ("c",)
+    assert table.update({"b": (["c"], [])}) == set(["a"])
+    assert table.delivery_set("a") == ("b", "c")
+
+def test_remove():
+    table = _table({"a": ["b"], "b": ["c"], "c": []})
+    assert table.update({"b": None}) == set(["a", "b"])
+    assert table.delivery_set("a") == ()
+    assert table.delivery_set("b") == ()
+    assert table.names() == set(["a", "c"])
+    #removing it again changes nothing
+    assert table.update({"b": None}) == set()
+    assert table.update({"b": (["c"], [])}) == set(["a", "b"])
+    assert table.delivery_set("a") == ("b", "c")
@@ -1,6 +1,15 @@
 
 import threading
+import re
 import logging
+import logging.handlers
+import queue
+import socket
+import time
+import collections
+import copy
+import math
+import concurrent.futures
 
 class UserData():
     """Data structure for holding user data"""
@@ -37,28 +46,433 @@ class UserData():
             logging.warning("Deleting a user that doesn't exist")
             
 
+    def retain(self, nicks):
+        """Removes all users that aren't in nicks"""
+        nicks = set(nicks)
+        for x in [x for x in self._users if x not in nicks]:
+            del self._users[x]
+
+    def as_list(self):
+        """Returns the users as a sorted list of lists like [[name, pm, mc, ctrl]]"""
+        return [[x] + self._users[x] for x in sorted(self._users)]
+
     def _get_attr(self, nick, idx):
         """get attributes of a user"""
         
         if not idx in [self.PM, self.MC, self.CTRL]:
-            raise "Invalid user attribute"
+            raise ValueError("Invalid user attribute")
         if nick in self._users:
             return self._users[nick][idx]
 
-        logging.warning("Getting attributes for a user that doesn't exist")
-        return UNSET
+        logging.warning("Getting attributes for a user that doesn't exist (%s)", nick)
+        return self.UNSET
     
     def _set_attr(self, nick, idx, val):
         if not idx in [self.PM, self.MC, self.CTRL]:
-            raise "Invalid user attribute"
+            raise ValueError("Invalid user attribute")
         elif not val in [self.YES, self.NO, self.UNSET]:
-            raise "Invalid user attribute value"
+            raise ValueError("Invalid user attribute value")
         if nick not in self._users:
             self._users[nick] = [self.UNSET, self.UNSET, self.UNSET]
         self._users[nick][idx] = val
 
     attr = property(_get_attr, _set_attr)
 
+class RepeatFilter(logging.Filter):
+    """
+    Rate limits repeated log records. Records from the same place with the same message template
+    are let through once per interval, the next one let through says how many were suppressed
+    """
+
+    def __init__(self, interval = 60, level = logging.WARNING):
+        super(RepeatFilter, self).__init__()
+        self._interval = interval
+        self._level = level
+        self._lock = threading.Lock()
+        #(file, line, template) : [time last let through, number suppressed since]
+        self._seen = dict()
+
+    def filter(self, record):
+        if record.levelno < self._level:
+            return True
+        key = (record.pathname, record.lineno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen != None and now - seen[0] < self._interval:
+                seen[1] += 1
+                return False
+            suppressed = seen[1] if seen != None else 0
+            self._seen[key] = [now, 0]
+            #forget about old records so this doesn't grow forever
+            if len(self._seen) > 1000:
+                self._seen = dict((k, v) for k, v in self._seen.items() if now - v[0] < self._interval)
+        if suppressed:
+            record.msg = str(record.msg) + " (repeated %d times)"
+            record.args = (record.args or ()) + (suppressed,)
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands log records to the writer thread, which does the formatting. Records are dropped
+    if the writer falls too far behind rather than blocking the caller (the number dropped
+    is logged once there's room again)
+    """
+
+    def __init__(self, records):
+        super(_QueueHandler, self).__init__(records)
+        #records dropped in total, and since it was last logged
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record):
+        """Merges the arguments into the message now (they could change before the writer gets to them)"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self._unreported:
+                self.queue.put_nowait(logging.LogRecord("root", logging.WARNING, __file__, 0,
+                                                        "Dropped {} log records, the log writer fell behind".format(self._unreported), None, None))
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+
+def setup_logging(filename, level, fmt, max_queued = 10000):
+    """
+    Sets up logging so records are written to the file by a background thread.
+    Repeated warnings are rate limited. Returns the listener (call stop() on it before exiting)
+    """
+    records = queue.Queue(max_queued)
+    handler = _QueueHandler(records)
+    handler.addFilter(RepeatFilter())
+
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(fmt))
+    listener = logging.handlers.QueueListener(records, file_handler)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    listener.start()
+    return listener
+
+
+class Backlog():
+    """
+    Buffer of the most recent messages from a link. The oldest messages are dropped
+    once it holds more than max_msgs messages or max_chars characters
+    """
+
+    def __init__(self, max_msgs = 100, max_chars = 32768):
+        self.max_msgs = max_msgs
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        #(time, message)
+        self._msgs = collections.deque()
+        self._chars = 0
+
+    def add(self, msg):
+        """Adds a message (stored as is, so every link replaying it shares the same object)"""
+        with self._lock:
+            self._msgs.append((time.monotonic(), msg))
+            self._chars += len(msg)
+            while len(self._msgs) > self.max_msgs or (self._chars > self.max_chars and len(self._msgs) > 1):
+                self._chars -= len(self._msgs.popleft()[1])
+
+    def recent(self, count, seconds):
+        """Returns up to the last count messages from the last seconds seconds (oldest first)"""
+        cutoff = time.monotonic() - seconds
+        with self._lock:
+            msgs = list(self._msgs)[-count:] if count > 0 else []
+        return [msg for when, msg in msgs if when >= cutoff]
+
+
+class EchoCache():
+    """
+    Remembers (for ttl seconds) the messages sent to each link, so messages the server echoes
+    back can be recognised. Bounded LRU, adding and checking are O(1)
+    """
+
+    def __init__(self, max_items = 4096, ttl = 30):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        #(link name, fingerprint) : [expiry time, times sent], oldest first
+        self._items = collections.OrderedDict()
+
+    def _key(self, link, msg):
+        #servers can change spacing and case, so compare a normalized version
+        return (link, " ".join(msg.split()).casefold())
+
+    def _expire(self, now):
+        while self._items:
+            key, item = next(iter(self._items.items()))
+            if item[0] > now:
+                break
+            del self._items[key]
+
+    def add(self, link, msg):
+        """Records a message sent to a link"""
+        key = self._key(link, msg)
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.pop(key, None)
+            self._items[key] = [now + self.ttl, item[1] + 1 if item != None else 1]
+            self._expire(now)
+            while len(self._items) > self.max_items:
+                self._items.popitem(False)
+
+    def check(self, link, msg):
+        """Checks if a message received from a link is an echo of one sent to it (each send matches one echo)"""
+        key = self._key(link, msg)
+        with self._lock:
+            item = self._items.get(key)
+            if item == None or item[0] <= time.monotonic():
+                return False
+            item[1] -= 1
+            if item[1] <= 0:
+                del self._items[key]
+            return True
+
+
+class TimerWheel():
+    """
+    Hashed timer wheel. Adding and cancelling timers is O(1) no matter how many there are,
+    timers fire on the first tick after they're due. Not thread safe
+    """
+
+    def __init__(self, tick = 0.5, slots = 256):
+        self.tick = tick
+        self._slots = [dict() for x in range(slots)]
+        self._pos = 0
+        #key : (slot, due time)
+        self._timers = dict()
+
+    def add(self, key, delay, item):
+        """Adds a timer (replacing any existing timer with the same key)"""
+        self.cancel(key)
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        slot = (self._pos + ticks) % len(self._slots)
+        #number of times the wheel has to go round before it fires
+        rounds = (ticks - 1) // len(self._slots)
+        self._slots[slot][key] = [rounds, item]
+        self._timers[key] = (slot, time.monotonic() + delay)
+
+    def cancel(self, key):
+        """Removes a timer, returns False if there wasn't one"""
+        timer = self._timers.pop(key, None)
+        if timer == None:
+            return False
+        del self._slots[timer[0]][key]
+        return True
+
+    def due(self, key):
+        """Returns the (monotonic) time a timer is due, or None if there isn't one"""
+        timer = self._timers.get(key)
+        return timer[1] if timer != None else None
+
+    def advance(self):
+        """Moves the wheel on one tick, returns a list of (key, item) for the timers that fired"""
+        self._pos = (self._pos + 1) % len(self._slots)
+        slot = self._slots[self._pos]
+        fired = []
+        for key, timer in list(slot.items()):
+            if timer[0] > 0:
+                timer[0] -= 1
+            else:
+                del slot[key]
+                del self._timers[key]
+                fired.append((key, timer[1]))
+        return fired
+
+    def __len__(self):
+        return len(self._timers)
+
+
+def split_server(server, default_port):
+    """
+    Splits a "host:port" server string into a (host, port) tuple.
+    Uses default_port if the server string doesn't specify one
+    """
+    host, sep, port = server.rpartition(":")
+    if not sep or "]" in port or (":" in host and not host.endswith("]")):
+        #no port given (or the only colons are inside an unbracketed IPv6 address)
+        return (server.strip("[]"), default_port)
+    return (host.strip("[]"), int(port))
+
+
+class Resolver():
+    """
+    Resolves addresses on a pool of worker threads and caches the results.
+    Lookups for an address that is already being resolved share the same future
+    """
+
+    def __init__(self, ttl = 300, max_workers = 8):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        #(host, port): (expiry time, future)
+        self._cache = dict()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def _lookup(self, host, port):
+        """Does the actual (blocking) lookup, returns the first TCP address found"""
+        info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        return info[0][4]
+
+    def resolve_async(self, host, port):
+        """Returns a future that will hold the resolved (family-specific) socket address"""
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached != None and cached[0] > now:
+                return cached[1]
+            future = self._pool.submit(self._lookup, host, port)
+            self._cache[key] = (now + self._ttl, future)
+
+        #don't cache failures
+        future.add_done_callback(lambda f: f.exception() and self.invalidate(host, port))
+        return future
+
+    def resolve(self, host, port, timeout = None):
+        """Resolves an address, blocking until it is done"""
+        return self.resolve_async(host, port).result(timeout)
+
+    def resolve_all(self, addrs, timeout = None):
+        """
+        Resolves a list of (host, port) tuples concurrently, waiting up to timeout for all of them.
+        Returns a dict of (host, port): address (None for failed lookups)
+        """
+        futures = dict((x, self.resolve_async(*x)) for x in set(addrs))
+        done = concurrent.futures.wait(futures.values(), timeout)[0]
+        ret = dict()
+        for addr, future in futures.items():
+            if future not in done:
+                logging.warning("Couldn't resolve %s:%s in time", addr[0], addr[1])
+                ret[addr] = None
+                continue
+            try:
+                ret[addr] = future.result()
+            except Exception as e:
+                logging.warning("Couldn't resolve %s:%s (%s)", addr[0], addr[1], e)
+                ret[addr] = None
+        return ret
+
+    def invalidate(self, host, port):
+        """Removes an address from the cache"""
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+    def stop(self):
+        """Stops the worker threads"""
+        self._pool.shutdown(False)
+
+
+class StartupScheduler(threading.Thread):
+    """
+    Brings up a set of links in the background with a bounded number of connection attempts in
+    progress. Limits attempts globally and per host, and spaces out attempts to the same host
+    so hubs don't see a burst of logins. An attempt is over when the link reports the result
+    (see attempt_finished), its thread exits or it runs out of time.
+    on_done is called with (number connected, number of links, seconds taken) at the end
+    """
+
+    #how often to check for links whose threads exited without reporting a result (seconds)
+    CHECK_INTERVAL = 0.5
+
+    def __init__(self, resolver, links, per_host = 2, max_active = 16, host_interval = 1.0, timeout = 30, on_done = None):
+        super(StartupScheduler, self).__init__()
+        self.daemon = True
+        self._resolver = resolver
+        self._links = list(links)
+        self.total = len(self._links)
+        self.per_host = per_host
+        self.max_active = max_active
+        self.host_interval = host_interval
+        self.timeout = timeout
+        self._on_done = on_done
+        self._cond = threading.Condition()
+        self._stop_req = threading.Event()
+        #link : whether it connected, for the attempts that have finished
+        self._results = dict()
+        self.connected = 0
+        self.finished = 0
+
+    def attempt_finished(self, link, ok):
+        """Called when a link connects (ok) or its connection attempt fails"""
+        with self._cond:
+            self._results.setdefault(link, ok)
+            self._cond.notify()
+
+    def run(self):
+        start = time.monotonic()
+
+        #resolve everything up front so lookups happen in parallel
+        addrs = dict((x, split_server(x.server, x.DEFAULT_PORT)) for x in self._links)
+        resolved = self._resolver.resolve_all(addrs.values(), self.timeout)
+
+        #group the links by host
+        pending = collections.OrderedDict()
+        for link in self._links:
+            link.address = resolved[addrs[link]]
+            pending.setdefault(addrs[link][0], collections.deque()).append(link)
+
+        active = dict((x, 0) for x in pending)
+        next_start = dict((x, 0) for x in pending)
+        #link : (host, deadline) of the attempts in progress
+        attempts = dict()
+        with self._cond:
+            while (pending or attempts) and not self._stop_req.is_set():
+                now = time.monotonic()
+                #finished attempts free up their slots
+                for link, (host, deadline) in list(attempts.items()):
+                    if link in self._results or not link.is_alive() or now >= deadline:
+                        del attempts[link]
+                        active[host] -= 1
+                        self.finished += 1
+                        if self._results.get(link) == True:
+                            self.connected += 1
+
+                wake = now + self.CHECK_INTERVAL
+                for host in list(pending):
+                    if len(attempts) >= self.max_active:
+                        break
+                    if active[host] >= self.per_host:
+                        continue
+                    if next_start[host] > now:
+                        wake = min(wake, next_start[host])
+                        continue
+
+                    link = pending[host].popleft()
+                    if len(pending[host]) == 0:
+                        del pending[host]
+                    active[host] += 1
+                    next_start[host] = now + self.host_interval
+                    attempts[link] = (host, now + self.timeout)
+                    link.start()
+                for host, deadline in attempts.values():
+                    wake = min(wake, deadline)
+                if pending or attempts:
+                    self._cond.wait(max(wake - now, 0))
+
+        if self._on_done != None:
+            self._on_done(self.connected, self.total, time.monotonic() - start)
+
+    def join(self, timeout=None):
+        """Override join to stop starting links and stop the thread"""
+        self._stop_req.set()
+        with self._cond:
+            self._cond.notify()
+        super(StartupScheduler, self).join(timeout)
+
 #############################################################################
 ##class RepeatTimer(threading.Thread):
 ##    """Repeatedly calls a function every interval"""
@@ -82,6 +496,28 @@ class UserData():
 ##        self.event.clear()
 
 
+def split_bytes(data, size, utf8 = True):
+    """
+    Splits encoded text into pieces of at most size bytes, at a space if there's one near the end of
+    the piece. utf8 makes sure multibyte characters aren't split
+    """
+    pieces = []
+    while len(data) > size:
+        end = size
+        if utf8:
+            #back up to the start of a character
+            while end > 0 and data[end] & 0xC0 == 0x80:
+                end -= 1
+        space = data.rfind(b" ", size // 2, end)
+        if space > 0:
+            end = space
+        if end <= 0:
+            end = size
+        pieces.append(data[:end])
+        data = data[end + 1:] if data[end:end + 1] == b" " else data[end:]
+    pieces.append(data)
+    return pieces
+
 def escape_replace(msg, esc_char, esc_data):
     """
     Replaces escape sequences with the corrisponding characters
@@ -117,26 +553,38 @@ def escape_replace(msg, esc_char, esc_data):
             i += 1
     return "".join(temp)
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-    
+#mIRC formatting: bold, colour (with optional foreground,background numbers), hex colour,
+#italic, monospace, reverse, strikethrough, underline and reset
+_IRC_FORMATTING = re.compile(r"\x03(?:\d{1,2}(?:,\d{1,2})?)?|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?|[\x02\x0f\x11\x16\x1d\x1e\x1f]")
+
+def strip_irc_formatting(msg):
+    """Removes mIRC formatting codes from msg"""
+    return _IRC_FORMATTING.sub("", msg)
+
+#BBCode style tags used by DC clients and the mIRC codes they turn into
+_BBCODE = re.compile(r"\[(/?)(b|i|u|s|color)(?:=([^\]]*))?\]", re.IGNORECASE)
+_BBCODE_IRC = {"b": "\x02", "i": "\x1d", "u": "\x1f", "s": "\x1e"}
+_IRC_COLOURS = {"white": "00", "black": "01", "navy": "02", "blue": "02", "green": "03", "red": "04", "brown": "05",
+                "maroon": "05", "purple": "06", "orange": "07", "yellow": "08", "lime": "09", "teal": "10",
+                "cyan": "11", "aqua": "11", "royalblue": "12", "pink": "13", "fuchsia": "13", "grey": "14",
+                "gray": "14", "silver": "15"}
+
+def bbcode_to_irc(msg):
+    """Converts BBCode style formatting ([b], [i], [u], [s], [color=red]) in msg to mIRC codes"""
+    def replace(match):
+        tag = match.group(2).lower()
+        if tag != "color":
+            return _BBCODE_IRC[tag]
+        if match.group(1):
+            code = "\x03"
+        else:
+            #colours IRC doesn't have are dropped
+            colour = _IRC_COLOURS.get((match.group(3) or "").strip("\"' ").lower())
+            if colour == None:
+                return ""
+            code = "\x03" + colour
+        #a digit or comma after the code would be read as part of it, an empty bold toggle ends the code
+        if match.string[match.end():match.end() + 1] in set("0123456789,"):
+            code += "\x02\x02"
+        return code
+    return _BBCODE.sub(replace, msg)